@@ -0,0 +1,77 @@
+import ctypes
+import threading
+import time
+import numpy
+
+from nionswift_plugin.IVG.camera.VGCameraYves import FrameBufferRing
+
+"""
+Frame integrity of the FrameBufferRing under a simulated fast writer. A thread plays Cameras.dll: it takes a buffer
+pointer as the data locker does, fills the frame through the pointer with its frame number, row by row, and publishes
+it. The reader plays acquire_image at a display rate: each image it gets must hold a single frame number and must not
+change while it is used, as read hands it over and a new buffer takes its place. The same run with a single shared
+array (previous scheme) shows the torn frames.
+"""
+
+SHAPE = (256, 1024)
+DURATION = 3.0
+READ_PERIOD = 0.005  # s, time the reader keeps each image
+
+
+def check(ring):
+    running = True
+    written = 0
+
+    def writer():
+        nonlocal written
+        while running:
+            index = ring.acquire_write()
+            pointer = ctypes.cast(ring.pointers[index], ctypes.POINTER(ctypes.c_float))
+            frame = numpy.ctypeslib.as_array(pointer, SHAPE)
+            written += 1
+            for row in range(0, SHAPE[0], 32):
+                frame[row:row + 32] = written
+            ring.publish(index)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    torn = changed = images = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        image = ring.read()
+        if image is None: continue
+        images += 1
+        value = image[0, 0]
+        torn += int(not (image == value).all())
+        time.sleep(READ_PERIOD)
+        changed += int(not (image == value).all())
+    running = False
+    thread.join()
+    return written, images, torn, changed
+
+
+class SingleBuffer:
+    """
+    Previous scheme: the DLL always writes in the array returned by acquire_image.
+    """
+
+    def __init__(self, shape):
+        self.buffers = [numpy.zeros(shape, dtype=numpy.float32)]
+        self.pointers = [self.buffers[0].ctypes.data_as(ctypes.c_void_p)]
+        self.__published = False
+
+    def acquire_write(self):
+        return 0
+
+    def publish(self, index):
+        self.__published = True
+
+    def read(self):
+        if not self.__published: return None
+        self.__published = False
+        return self.buffers[0]
+
+
+for name, ring in [('Single buffer', SingleBuffer(SHAPE)), ('FrameBufferRing', FrameBufferRing(SHAPE))]:
+    written, images, torn, changed = check(ring)
+    print(f'{name}: {written} frames written, {images} read, {torn} torn when read, {changed} changed while used.')
@@ -0,0 +1,26 @@
+from nion.typeshed import API_1_0 as API
+from nion.typeshed import UI_1_0 as UI
+
+from nionswift_plugin.IVG.tp3.tp3raw import RawTpx3File
+
+api = api_broker.get_api(API.version, UI.version)  # type: API
+
+"""
+Replays a raw .tpx3 file saved by serval ('Save Locally' port) as a spectrum image. Line starts are the TDC1 rising
+edges, as set by StartSpimFromScan. Pixel time is in ns; if None, it is estimated from the line start period.
+"""
+
+raw_file = RawTpx3File('/media/asi/Data2/TP3_Data/raw000000.tpx3')
+
+height = 64
+width = 64
+pixel_time = None
+
+spim = raw_file.spim(width, height, pixel_time)
+
+si_data_descriptor = api.create_data_descriptor(is_sequence=False, collection_dimension_count=2, datum_dimension_count=1)
+si_xdata = api.create_data_and_metadata(spim, data_descriptor=si_data_descriptor)
+data_item = api.library.create_data_item_from_data_and_metadata(si_xdata)
+
+spectrum_xdata = api.create_data_and_metadata(raw_file.spectrum())
+api.library.create_data_item_from_data_and_metadata(spectrum_xdata)
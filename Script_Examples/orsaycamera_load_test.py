@@ -0,0 +1,87 @@
+import ctypes
+import time
+import numpy
+
+from nionswift_plugin.IVG.virtual_instruments import orsaycamera_vi as orsaycamera
+
+"""
+Load test of the locker/unlocker paths against the simulated orsay camera, without Cameras.dll. Lockers hand out
+numpy buffers as the CameraDevice does; frames (Focus), spectra (Chrono, 1D spim of ACCUMULATION rows) and the time
+spent in the callbacks are measured for the KURO and the ProEM at increasing frame rates.
+"""
+
+DURATION = 2.0
+ACCUMULATION = 100
+
+
+class Receiver:
+    def __init__(self, camera):
+        self.camera = camera
+        sx, sy = camera.getImageSize()
+        self.image = numpy.zeros((sy, sx), dtype=numpy.float32)
+        self.spectrum = numpy.zeros(sx, dtype=numpy.float32)
+        self.spim = numpy.zeros((ACCUMULATION, sx), dtype=numpy.float32)
+        self.frames = self.spectra = 0
+        self.callback_time = 0
+        self.callbacks = [orsaycamera.DATALOCKFUNC(self.data_locker), orsaycamera.DATAUNLOCKFUNC(self.data_unlocker),
+                          orsaycamera.SPIMLOCKFUNC(self.spim_locker), orsaycamera.SPIMUNLOCKFUNC(self.spim_unlocker),
+                          orsaycamera.SPECTLOCKFUNC(self.spectrum_locker),
+                          orsaycamera.SPECTUNLOCKFUNC(self.spectrum_unlocker)]
+        camera.registerDataLocker(self.callbacks[0])
+        camera.registerDataUnlocker(self.callbacks[1])
+        camera.registerSpimDataLocker(self.callbacks[2])
+        camera.registerSpimDataUnlocker(self.callbacks[3])
+        camera.registerSpectrumDataLocker(self.callbacks[4])
+        camera.registerSpectrumDataUnlocker(self.callbacks[5])
+
+    def data_locker(self, gene, data_type, sx, sy, sz):
+        start = time.perf_counter_ns()
+        sy[0], sx[0] = self.image.shape
+        sz[0] = 1
+        data_type[0] = 11
+        self.callback_time += time.perf_counter_ns() - start
+        return self.image.ctypes.data_as(ctypes.c_void_p).value
+
+    def data_unlocker(self, gene, new_data):
+        self.frames += 1
+
+    def spim_locker(self, gene, data_type, sx, sy, sz):
+        sy[0], sx[0] = self.spim.shape
+        sz[0] = 1
+        data_type[0] = 111
+        return self.spim.ctypes.data_as(ctypes.c_void_p).value
+
+    def spim_unlocker(self, gene, new_data, running):
+        self.spectra += 1
+
+    def spectrum_locker(self, gene, data_type, sx):
+        sx[0] = len(self.spectrum)
+        data_type[0] = 11
+        return self.spectrum.ctypes.data_as(ctypes.c_void_p).value
+
+    def spectrum_unlocker(self, gene, new_data):
+        pass
+
+
+for model in ["KURO: 2048B", "ProEM+: 1600xx(2)B eXcelon"]:
+    camera = orsaycamera.orsayCamera(1, model, "", True, seed=0)
+    for frame_rate in [100., 1000., None]:
+        receiver = Receiver(camera)
+        camera.frame_rate = frame_rate
+        camera.startFocus(0.001, "2d", 0)
+        time.sleep(DURATION)
+        status = camera.getCCDStatus()
+        camera.stopFocus()
+        print(f'{model} Focus 2d at {frame_rate or "exposure"} fps: {receiver.frames / DURATION:.0f} frames/s, '
+              f'{status["frames/seconds"]:.0f} reported, {receiver.image.sum():.3g} counts in the last frame.')
+    camera.setBinning(1, camera.getCCDSize()[1])
+    receiver = Receiver(camera)
+    camera.frame_rate = None
+    camera.setSpimMode(orsaycamera.SPIMONLINE)
+    camera.startSpim(ACCUMULATION, 1, 0.0005, False)
+    time.sleep(DURATION)
+    camera.stopSpim(True)
+    print(f'{model} Chrono at 2000 spectra/s: {receiver.spectra / DURATION:.0f} spectra/s, '
+          f'{int(numpy.count_nonzero(receiver.spim.sum(axis=1)))} of {ACCUMULATION} rows written.')
+    camera.setBinning(1, 1)
+    camera.close()
@@ -0,0 +1,94 @@
+import time
+import numpy
+
+from nionswift_plugin.IVG.scan import VGScanYves
+
+"""
+Drift-corrected frame averaging of VGScanYves (DriftCorrectedAverager). A noisy sample drifting by DRIFT pixels per frame
+is averaged with and without drift correction and compared to the noiseless sample at the position of the first frame.
+The averaging is then run on the device, against the simulated scan when Scan.dll is not available.
+"""
+
+SIZE = 512
+FRAMES = 16
+DRIFT = (0.8, -1.3)  # pixels per frame (y, x)
+DOSE = 20  # mean counts per pixel
+
+
+class Instrument:
+    is_subscan_f = [False, 1, 1]
+    spim_trigger_f = 0
+
+    def fov_change(self, fov):
+        pass
+
+
+def sample(size, seed=0):
+    rng = numpy.random.default_rng(seed)
+    spectrum = numpy.fft.rfft2(rng.random((size, size)))
+    fy, fx = numpy.fft.fftfreq(size)[:, None], numpy.fft.rfftfreq(size)[None, :]
+    image = numpy.fft.irfft2(spectrum * numpy.exp(-(fx ** 2 + fy ** 2) / (2 * 0.03 ** 2)), s=(size, size))
+    image -= image.min()
+    return image / image.mean()
+
+
+def add_and_wait(averager, images):
+    sequence = averager.sequence
+    averager.add(images)
+    while averager.sequence == sequence:
+        time.sleep(0.001)
+
+
+margin = int(numpy.ceil(max(abs(d) for d in DRIFT) * FRAMES)) + 1
+specimen = sample(SIZE + 2 * margin)
+truth = specimen[margin:margin + SIZE, margin:margin + SIZE]
+rng = numpy.random.default_rng(1)
+frames = list()
+for frame in range(FRAMES):
+    y, x = (margin + int(round(d * frame)) for d in DRIFT)
+    frames.append(rng.poisson(DOSE * specimen[y:y + SIZE, x:x + SIZE]).astype(numpy.uint16))
+
+inside = (slice(margin, SIZE - margin), slice(margin, SIZE - margin))
+
+
+def error(image):
+    return numpy.std(image[inside] / DOSE - truth[inside])
+
+
+print(f'{SIZE}x{SIZE}, {FRAMES} frames drifting by {DRIFT} pixels per frame. Relative error to the sample:')
+print(f'    Single frame: {error(frames[0].astype(numpy.float32)):.3f}')
+print(f'    Plain average: {error(numpy.mean(frames, axis=0)):.3f}')
+for mode in VGScanYves.DriftCorrectedAverager.MODES:
+    averager = VGScanYves.DriftCorrectedAverager(FRAMES, mode)
+    times = list()
+    for frame in frames:
+        start = time.perf_counter()
+        add_and_wait(averager, [frame])
+        times.append(time.perf_counter() - start)
+    result = averager.result(0) / (averager.count if mode == 'sum' else 1)
+    expected = tuple(d * (FRAMES - 1) for d in DRIFT)
+    print(f'    Drift corrected {mode}: {error(result):.3f}, drift {averager.drift[0]:.2f}, {averager.drift[1]:.2f} '
+          f'pixels (expected {expected[0]:.1f}, {expected[1]:.1f}), {numpy.median(times) * 1e3:.1f} ms per frame.')
+    averager.shutdown()
+
+device = VGScanYves.Device(Instrument())
+device.p0 = device.p1 = device.p3 = device.p5 = 256
+device.p2 = device.p4 = 0
+device.Image_area = [256, 256, 0, 256, 0, 256]
+device.pixel_time = 1.
+device.averaging_frames = 8
+device.start_frame(True)
+frame_number, pixels_to_skip, averages = None, 0, 0
+start = time.perf_counter()
+while time.perf_counter() - start < 3.:
+    data_elements, complete, bad, sub_area, frame_number, pixels_to_skip = device.read_partial(frame_number,
+                                                                                               pixels_to_skip)
+    if data_elements:
+        averages += 1
+        properties = data_elements[0]["properties"]
+    if complete:
+        frame_number, pixels_to_skip = None, 0
+    time.sleep(0.05)
+device.stop()
+print(f'Device: {averages} averages sent in 3 s, last of {properties["averaged_frames"]} frames with drift '
+      f'{properties["drift_pixels"]}.')
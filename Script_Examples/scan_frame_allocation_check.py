@@ -0,0 +1,85 @@
+import ctypes
+import sys
+import tracemalloc
+import types
+import numpy
+
+"""
+Memory allocated by VGScanYves.Device.read_partial, measured with tracemalloc. Scan.dll is replaced by FakeOrsayScan,
+which writes each image LINES_PER_CALL lines at a time through the registered locker and unlockerA callbacks, as the
+DLL does, and read_partial is called after each block. The per-channel frames are allocated when the image area
+changes, so reading must not allocate anything proportional to the image size.
+"""
+
+LINES_PER_CALL = 32
+FRAMES = 5
+
+
+class FakeOrsayScan:
+    def __init__(self, gene, scandllobject=0, vg=False):
+        self.orsayscan = scandllobject or 1
+        self.pixelTime = 1e-6
+        self.locker = self.unlocker = None
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: True
+
+    def registerLocker(self, fn):
+        self.locker = fn
+
+    def registerUnlockerA(self, fn):
+        self.unlocker = fn
+
+    def write_lines(self, imagenb, first_line, lines):
+        data_type, sx, sy, sz = [ctypes.c_int() for _ in range(4)]
+        pointer = self.locker(1, data_type, sx, sy, sz)
+        buffer = numpy.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_int16)),
+                                          (sz.value * sx.value, sy.value))
+        for channel in range(sz.value):
+            buffer[channel * sy.value + first_line:channel * sy.value + first_line + lines] = imagenb
+        rect = (ctypes.c_int * 4)(0, first_line, sx.value, lines)
+        self.unlocker(1, True, imagenb, rect)
+
+
+orsayscan = types.ModuleType('nionswift_plugin.IVG.scan.orsayscan')
+orsayscan.orsayScan = FakeOrsayScan
+orsayscan.LOCKERFUNC = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int),
+                                        ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+                                        ctypes.POINTER(ctypes.c_int))
+orsayscan.UNLOCKERFUNCA = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int))
+sys.modules['nionswift_plugin.IVG.scan.orsayscan'] = orsayscan
+
+from nionswift_plugin.IVG.scan import VGScanYves
+
+
+class Instrument:
+    is_subscan_f = [False, 1, 1]
+    spim_trigger_f = 0
+
+    def fov_change(self, fov):
+        pass
+
+
+device = VGScanYves.Device(Instrument())
+for size in [512, 2048]:
+    device.p0 = device.p1 = device.p3 = device.p5 = size
+    device.p2 = device.p4 = 0
+    device.Image_area = [size, size, 0, size, 0, size]
+    device.start_frame(True)
+    tracemalloc.start()
+    peaks = list()
+    frame_number, pixels_to_skip = None, 0
+    for imagenb in range(1, FRAMES + 1):
+        for line in range(0, size, LINES_PER_CALL):
+            device.scan.write_lines(imagenb, line, LINES_PER_CALL)
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            data_elements, complete, bad, sub_area, frame_number, pixels_to_skip = device.read_partial(frame_number,
+                                                                                                       pixels_to_skip)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        assert complete and data_elements[0]["data"].min() == imagenb
+    tracemalloc.stop()
+    device.stop()
+    frame_bytes = sum(element["data"].nbytes for element in data_elements)
+    print(f'{size}x{size}: {len(peaks)} reads, at most {max(peaks) / 1e3:.1f} kB allocated per read '
+          f'(mean {numpy.mean(peaks) / 1e3:.1f} kB). Whole frames of all channels are {frame_bytes / 1e6:.1f} MB.')
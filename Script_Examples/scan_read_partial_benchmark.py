@@ -0,0 +1,67 @@
+import time
+import numpy
+
+from nionswift_plugin.IVG.scan import VGScanYves
+
+"""
+Frame rate and read latency of VGScanYves.Device.read_partial against the simulated scan (used without Scan.dll).
+read_partial is called in a loop at most every 50 ms, as scan_base does. Latency is the time between a block of lines
+being written by the scan and read_partial returning it. Frames scanned faster than they are read are skipped, and the
+scanned frame rate is compared to the one expected from the pixel time (GetImageTime).
+"""
+
+DURATION = 5.0
+MIN_PERIOD = 0.05
+
+
+class Instrument:
+    is_subscan_f = [False, 1, 1]
+    spim_trigger_f = 0
+
+    def fov_change(self, fov):
+        pass
+
+
+def written_at(unit, imagenb, first_row):
+    for block in reversed(unit.block_times):
+        if block[0] == imagenb and block[1] == first_row:
+            return block[2]
+    return None
+
+
+def run(device, size, pixel_time_us):
+    device.p0 = device.p1 = device.p3 = device.p5 = size
+    device.p2 = device.p4 = 0
+    device.Image_area = [size, size, 0, size, 0, size]
+    device.pixel_time = pixel_time_us
+    unit = device.scan.orsayscan
+    latencies, frames = list(), 0
+    frame_number, pixels_to_skip = None, 0
+    scans = device.scan.getScanCount()
+    device.start_frame(True)
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        read_start = time.perf_counter()
+        data_elements, complete, bad, sub_area, frame_number, pixels_to_skip = device.read_partial(frame_number,
+                                                                                                   pixels_to_skip)
+        now = time.perf_counter()
+        if sub_area[1][0] > 0 and sub_area[1][0] < size:
+            written = written_at(unit, frame_number, sub_area[0][0])
+            if written is not None: latencies.append(now - written)
+        if complete:
+            frames += 1
+            frame_number, pixels_to_skip = None, 0
+        delay = read_start + MIN_PERIOD - time.perf_counter()
+        if delay > 0: time.sleep(delay)
+    device.stop()
+    scanned = (device.scan.getScanCount() - scans) / DURATION
+    print(f'{size}x{size} at {pixel_time_us} us: {scanned:.2f} frames/s scanned ({1 / device.scan.GetImageTime():.2f} '
+          f'expected), {frames / DURATION:.2f} frames/s read.')
+    if latencies:
+        print(f'    Latency median {numpy.median(latencies) * 1e3:.1f} ms, max {numpy.max(latencies) * 1e3:.1f} ms '
+              f'over {len(latencies)} partial reads.')
+
+
+device = VGScanYves.Device(Instrument())
+for size, pixel_time_us in [(128, 1.), (512, 0.5), (512, 5.), (2048, 1.)]:
+    run(device, size, pixel_time_us)
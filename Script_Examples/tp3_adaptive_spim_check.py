@@ -0,0 +1,32 @@
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import AdaptiveSpimAccumulator
+
+"""
+Memory and overflow behaviour of AdaptiveSpimAccumulator on a synthetic high-dynamic-range event stream. A strong
+zero-loss peak is added on every pixel and, in the last chunks, a single hot bin receives millions of counts. The
+result must match an exact int64 histogram.
+"""
+
+x_size, y_size = 64, 64
+rng = numpy.random.default_rng(0)
+accumulator = AdaptiveSpimAccumulator(x_size, y_size, hot_pixels=4)
+reference = numpy.zeros(x_size * y_size * 1025, dtype=numpy.int64)
+hot_bin = (5 * x_size + 3) * 1025 + 50
+
+for chunk in range(400):
+    pixels = rng.integers(0, x_size * y_size, 32000)
+    energies = numpy.clip(rng.exponential(80, 32000) + 100, 0, 1024).astype(numpy.uint32)
+    energies[:4000] = 50  # Zero-loss peak
+    event_list = (pixels * 1025 + energies).astype(numpy.uint32)
+    if chunk > 300:
+        event_list = numpy.concatenate([event_list, numpy.full(500000, hot_bin, dtype=numpy.uint32)])
+    accumulator.accumulate(event_list)
+    reference += numpy.bincount(event_list, minlength=reference.size)
+
+data = accumulator.create_array()
+assert numpy.array_equal(data.ravel().astype(numpy.int64), numpy.minimum(reference, numpy.iinfo(numpy.uint32).max))
+dtypes = {str(dt): accumulator.line_dtypes.count(dt) for dt in set(accumulator.line_dtypes)}
+print(f'Line dtypes: {dtypes}. Overflow table: {accumulator.overflow}.')
+print(f'Memory: {accumulator.nbytes / 1e6:.1f} MB (uint32 cube is {reference.size * 4 / 1e6:.1f} MB). '
+      f'Maximum count is {reference.max()} and no count was lost.')
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import threading
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import TimePix3
+
+"""
+Runs the asyncio TimePix3 client against a local asyncio stand-in for serval. The stand-in answers the HTTP control
+requests (dashboard, detector config, measurement start and stop) and streams jsonimage frames on port 8088 while a
+measurement is running. The whole session must use a single HTTP connection, and the dashboard must keep answering
+while frames are streamed. The stand-in does not implement the time-resolved mode (tp3mode 8), so startTimeResolved
+must raise and leave the detector idle. HTTP requests per start, status calls and stop are counted without the status cache, with it
+and with the status poller, and the status transitions published by the poller are printed.
+"""
+
+HTTP_PORT = 8080
+DATA_PORT = 8088
+WIDTH = 1024
+
+
+class ServalStandIn():
+    def __init__(self):
+        self.recording = False
+        self.http_connections = 0
+        self.http_requests = 0
+        self.detector_config = {'TriggerMode': 'CONTINUOUS', 'nTriggers': 99999, 'ExposureTime': 1.0}
+
+    async def handle_http(self, reader, writer):
+        self.http_connections += 1
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode().split()
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                key, _, value = line.decode().partition(':')
+                if key.lower() == 'content-length':
+                    content_length = int(value)
+            body = await reader.readexactly(content_length)
+            self.http_requests += 1
+            if path == '/dashboard':
+                reply = json.dumps({'Measurement': {'Status': 'DA_RECORDING'} if self.recording else None})
+            elif path == '/detector/config' and method == 'GET':
+                reply = json.dumps(self.detector_config)
+            elif path == '/detector/config':
+                self.detector_config = json.loads(body)
+                reply = 'Detector configuration updated.'
+            elif path == '/measurement/start':
+                self.recording = True
+                reply = 'Measurement started.'
+            elif path == '/measurement/stop':
+                self.recording = False
+                reply = 'Measurement stopped.'
+            else:
+                reply = 'OK'
+            writer.write(f'HTTP/1.1 200 OK\r\nContent-Length: {len(reply)}\r\n\r\n{reply}'.encode())
+            await writer.drain()
+        writer.close()
+
+    async def handle_data(self, reader, writer):
+        config_bytes = await reader.readexactly(16)
+        frame = 0
+        payload = numpy.random.randint(0, 100, WIDTH, dtype=numpy.uint32).tobytes()
+        try:
+            while self.recording:
+                header = json.dumps({"timeAtFrame": frame * 0.001, "frameNumber": frame, "measurementID": "null",
+                                     "dataSize": len(payload), "bitDepth": 32, "width": WIDTH, "height": 1},
+                                    separators=(',', ':'))
+                writer.write(header.encode() + b'\n' + payload + b'\n')
+                await writer.drain()
+                await asyncio.sleep(0.001)
+                frame += 1
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def run(self, started):
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(asyncio.start_server(self.handle_http, '127.0.0.1', HTTP_PORT))
+        loop.run_until_complete(asyncio.start_server(self.handle_data, '127.0.0.1', DATA_PORT))
+        started.set()
+        loop.run_forever()
+
+
+serval = ServalStandIn()
+started = threading.Event()
+threading.Thread(target=serval.run, args=(started,), daemon=True).start()
+started.wait()
+
+messages = list()
+camera = TimePix3(f'http://127.0.0.1:{HTTP_PORT}', False, messages.append)
+assert camera.success, 'Initialization against the stand-in failed.'
+
+def session(poller, ttl=0.2):
+    """
+    Starts and stops a 1d Focus, requesting the status 50 times while streaming. Returns the number of HTTP requests
+    of the start, of the status calls and of the stop.
+    """
+    camera.setStatusTTL(ttl)
+    camera.invalidate_status()
+    time.sleep(0.1)
+    if poller:
+        camera.startStatusPoller(0.05)
+    requests = serval.http_requests
+    camera.startFocus(0.01, '1d', 0)
+    start_requests = serval.http_requests - requests
+    requests = serval.http_requests
+    status_latencies.clear()
+    for _ in range(50):
+        start = time.perf_counter()
+        assert camera.getCCDStatus() == 'DA_RECORDING'
+        status_latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    status_requests = serval.http_requests - requests
+    requests = serval.http_requests
+    camera.stopFocus()
+    stop_requests = serval.http_requests - requests
+    assert camera.getCCDStatus() == 'DA_IDLE'
+    if poller:
+        camera.stopStatusPoller()
+    return start_requests, status_requests, stop_requests
+
+
+transitions = list()
+listener = camera.status_changed_event.listen(lambda old, new: transitions.append((old, new)))
+status_latencies = list()
+
+for name, poller, ttl in [('no cache (TTL 0)', False, 0.), ('cache (TTL 0.2 s)', False, 0.2),
+                          ('cache and poller', True, 0.2)]:
+    start_requests, status_requests, stop_requests = session(poller, ttl)
+    print(f'{name}: {start_requests} HTTP requests to start, {status_requests} for 50 getCCDStatus while streaming '
+          f'(median {numpy.median(status_latencies) * 1e3:.2f} ms), {stop_requests} to stop.')
+    if poller:
+        print(f'    Status TTL after the poller stopped: {camera._TimePix3__statusTTL} s.')
+
+camera.startFocus(0.01, '1d', 0)
+time.sleep(0.1)
+prop, image = camera.get_last_image()
+metrics = camera.get_frame_metrics()
+camera.stopFocus()
+
+try:
+    camera.startTimeResolved(0.01, '1d', 100)
+    time_resolved = 'started'
+except ConnectionError as e:
+    time_resolved = str(e)
+assert camera.getCCDStatus() == 'DA_IDLE'
+
+print(f'{len(messages)} frames received, last one is {prop}, image shape is {image.shape}.')
+print(f'Frame metrics are {metrics}.')
+print(f'Time-resolved start against a server without tp3mode 8: {time_resolved}')
+print(f'Status transitions: {transitions}.')
+print(f'{serval.http_requests} HTTP requests over {serval.http_connections} connection(s).')
+assert serval.http_connections == 1
+assert len(messages) > 0 and image.shape == (1, WIDTH)
+assert time_resolved != 'started'
@@ -0,0 +1,42 @@
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import CoincidenceEngine
+
+"""
+Throughput of the CoincidenceEngine on synthetic EELS-CL data. Electrons arrive at ELECTRON_RATE with a zero-loss
+spectrum, photons at PHOTON_RATE, and a fraction of the photons is emitted 5 ns after an electron that lost the
+photon energy (channel 600). Data is pushed in batches of BATCH_TIME, photons of a batch before its electrons. The
+coincidence peak must show up at +5 ns in the histogram and at channel 600 in the correlated spectrum.
+"""
+
+ELECTRON_RATE = 1e7  # per s
+PHOTON_RATE = 2e5  # per s
+CORRELATED = 0.3
+DURATION = 1.0  # s
+BATCH_TIME = 1e-3  # s
+
+rng = numpy.random.default_rng(0)
+electrons = int(ELECTRON_RATE * DURATION)
+toa = numpy.sort(rng.uniform(0, DURATION * 1e9, electrons))
+channel = numpy.clip(rng.normal(100, 5, electrons), 0, 1023).astype(numpy.uint32)
+photons = numpy.sort(rng.uniform(0, DURATION * 1e9, int(PHOTON_RATE * DURATION)))
+correlated = rng.random(len(photons)) < CORRELATED
+emitters = numpy.clip(numpy.searchsorted(toa, photons[correlated] - 5.), 0, electrons - 1)
+photons[correlated] = toa[emitters] + 5. + rng.normal(0, 1., len(emitters))
+channel[emitters] = 600
+photons = numpy.sort(photons)
+
+engine = CoincidenceEngine(window=50., bins=100)
+electron_edges = numpy.searchsorted(toa, numpy.arange(0, DURATION * 1e9 + 1, BATCH_TIME * 1e9))
+photon_edges = numpy.searchsorted(photons, numpy.arange(0, DURATION * 1e9 + 1, BATCH_TIME * 1e9))
+start = time.perf_counter()
+for batch in range(len(electron_edges) - 1):
+    engine.push_tdc(photons[photon_edges[batch]:photon_edges[batch + 1]])
+    engine.push_electrons(toa[electron_edges[batch]:electron_edges[batch + 1]],
+                          channel[electron_edges[batch]:electron_edges[batch + 1]])
+engine.flush()
+elapsed = time.perf_counter() - start
+peak = engine.delays[numpy.argmax(engine.time_histogram)]
+print(f'{electrons / elapsed / 1e6:.1f} Mevents/s. {engine.pairs} pairs, peak at {peak:.1f} ns, correlated spectrum '
+      f'maximum at channel {numpy.argmax(engine.correlated_spectrum[200:]) + 200}.')
@@ -0,0 +1,44 @@
+import time
+import tracemalloc
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import FrameBufferPool
+
+"""
+Per-frame cost of converting a jsonimage payload to the displayed array. The former create_image_from_bytes (numpy.array
+of the sliced bytes, then frombuffer and reshape) is compared with the FrameBufferPool decoding, for a full 2D frame and
+for a soft binned one. Allocated memory is followed with tracemalloc.
+"""
+
+NFRAMES = 2000
+LAYOUTS = [(16, 1024, 256), (32, 1024, 1)]
+
+
+def create_image_from_bytes(frame_data, bitDepth, width, height):
+    frame_data = numpy.array(frame_data[:-1])
+    dt = FrameBufferPool.DTYPES[bitDepth]
+    frame_int = numpy.frombuffer(frame_data, dtype=dt)
+    return numpy.reshape(frame_int, (height, width))
+
+
+def run(function, payload, layout):
+    tracemalloc.start()
+    latencies = numpy.empty(NFRAMES)
+    for frame in range(NFRAMES):
+        start = time.perf_counter()
+        image = function(payload, *layout)
+        latencies[frame] = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return latencies, peak
+
+
+for layout in LAYOUTS:
+    bitDepth, width, height = layout
+    payload = numpy.random.randint(0, 100, width * height, dtype=FrameBufferPool.DTYPES[bitDepth]).tobytes() + b'\n'
+    pool = FrameBufferPool()
+    for name, function in [('create_image_from_bytes', create_image_from_bytes), ('FrameBufferPool', pool.decode)]:
+        latencies, peak = run(function, payload, layout)
+        print(f'{name} {layout}: median {numpy.median(latencies) * 1e6:.1f} us, 99% {numpy.percentile(latencies, 99) * 1e6:.1f} us '
+              f'per frame. Peak traced memory {peak / 1e6:.2f} MB.')
+    print(f'FrameBufferPool {layout}: {pool.allocations} arrays allocated for {NFRAMES} frames.')
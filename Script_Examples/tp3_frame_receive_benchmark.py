@@ -0,0 +1,85 @@
+import json
+import socket
+import threading
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import FrameRingBuffer
+
+"""
+Throughput of the jsonimage frame reassembly. A fake serval server streams frames over localhost and they are received
+either by the old bytes concatenation loop or by FrameRingBuffer.
+"""
+
+WIDTH, HEIGHT, BITDEPTH = 1024, 256, 16
+NFRAMES = 2000
+
+
+def fake_serval(server):
+    conn, _ = server.accept()
+    payload = numpy.random.randint(0, 100, WIDTH * HEIGHT, dtype=numpy.uint16).tobytes()
+    for frame in range(NFRAMES):
+        header = json.dumps({"timeAtFrame": frame * 0.001, "frameNumber": frame, "measurementID": "null",
+                             "dataSize": len(payload), "bitDepth": BITDEPTH, "width": WIDTH,
+                             "height": HEIGHT}, separators=(',', ':'))
+        conn.sendall(header.encode() + b'\n' + payload + b'\n')
+    conn.close()
+    server.close()
+
+
+def connect():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    threading.Thread(target=fake_serval, args=(server,)).start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(server.getsockname())
+    return client
+
+
+def receive_concatenation():
+    client = connect()
+    frames = 0
+    packet_data = b''
+    while True:
+        temp = client.recv(2 * 64000)
+        if temp == b'': return frames
+        packet_data += temp
+        while True:
+            begin_header = packet_data.find(b'{"time')
+            end_header = packet_data.find(b'}\n', begin_header)
+            if begin_header == -1 or end_header == -1: break
+            data_size = json.loads(packet_data[begin_header:end_header + 1])['dataSize']
+            if len(packet_data) < end_header + 2 + data_size + 1: break
+            frame = numpy.frombuffer(numpy.array(packet_data[end_header + 2:end_header + 2 + data_size]),
+                                     dtype=numpy.uint16)
+            packet_data = packet_data[end_header + 2 + data_size + 1:]
+            frames += 1
+
+
+def receive_ring_buffer():
+    client = connect()
+    ring_buffer = FrameRingBuffer()
+    frames = 0
+    data_size = None
+    while True:
+        if ring_buffer.receive(client) == 0: return frames
+        while True:
+            if data_size is None:
+                header = ring_buffer.read_header()
+                if header is None: break
+                data_size = json.loads(bytes(header))['dataSize']
+            frame_data = ring_buffer.read(data_size + 1)
+            if frame_data is None: break
+            frame = numpy.frombuffer(frame_data, dtype=numpy.uint16, count=WIDTH * HEIGHT).copy()
+            data_size = None
+            frames += 1
+
+
+for function in [receive_concatenation, receive_ring_buffer]:
+    start = time.perf_counter()
+    frames = function()
+    elapsed = time.perf_counter() - start
+    mbytes = frames * WIDTH * HEIGHT * BITDEPTH / 8 / 1e6
+    print(f'{function.__name__}: {frames} frames in {elapsed:.3f} s. {frames / elapsed:.1f} frames/s, '
+          f'{mbytes / elapsed:.1f} MB/s.')
@@ -0,0 +1,56 @@
+import timeit
+
+from nionswift_plugin.IVG.tp3.tp3func import JsonImageHeaderDecoder
+
+"""
+Per-frame cost of decoding a serval jsonimage header. The former check_string_value parsing is compared with
+JsonImageHeaderDecoder, both for the first frame of a measurement and for the following ones (cached layout). At 1 kHz
+a frame has 1 ms to be received, decoded and displayed.
+"""
+
+NUMBER = 100000
+HEADERS = [('{"timeAtFrame":' + str(frame * 0.001) + ',"frameNumber":' + str(frame) +
+            ',"measurementID":"null","dataSize":524288,"bitDepth":16,"width":1024,"height":256}').encode()
+           for frame in range(NUMBER)]
+
+
+def check_string_value(header, prop):
+    start_index = header.index(prop)
+    end_index = start_index + len(prop)
+    begin_value = header.index(':', end_index, len(header)) + 1
+    if prop == 'height':
+        end_value = header.index('}', end_index, len(header))
+    else:
+        end_value = header.index(',', end_index, len(header))
+    try:
+        if prop == 'timeAtFrame':
+            value = float(header[begin_value:end_value])
+        else:
+            value = int(header[begin_value:end_value])
+    except ValueError:
+        value = str(header[begin_value:end_value])
+    return value
+
+
+def check_string_value_all():
+    cam_properties = dict()
+    for header in HEADERS:
+        header = header.decode('latin-1')
+        for properties in ["timeAtFrame", "frameNumber", "measurementID", "dataSize", "bitDepth", "width", "height"]:
+            cam_properties[properties] = (check_string_value(header, properties))
+
+
+def decoder_first_frame():
+    for header in HEADERS:
+        JsonImageHeaderDecoder(bitDepth=16, width=1024).decode(header)
+
+
+def decoder_cached():
+    decoder = JsonImageHeaderDecoder(bitDepth=16, width=1024)
+    for header in HEADERS:
+        decoder.decode(header)
+
+
+for function in [check_string_value_all, decoder_first_frame, decoder_cached]:
+    per_frame = timeit.timeit(function, number=1) / NUMBER
+    print(f'{function.__name__}: {per_frame * 1e6:.2f} us per frame, {per_frame / 1e-3 * 100:.3f}% of a 1 kHz frame.')
@@ -0,0 +1,48 @@
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import SpimAccumulator, rust_accumulate_available
+
+"""
+Compares SpimAccumulator backends on synthetic event streams. Events are flat spim indexes (pixel * 1025 + energy
+channel) with an EELS-like energy distribution, received in chunks as in acquire_streamed_frame_from_scan. The rust
+backend (rust2swift.accumulate_spim) is only run when swift_rust is built, and must give the same cube. bincount is
+skipped for chunks too small for auto to choose it, where each chunk would cost a pass over the whole spim.
+"""
+
+TOTAL_EVENTS = 10_000_000
+BACKENDS = [('unique', 0), ('add_at', 0), ('bincount', 0), ('rust', 0), ('auto', 0), ('auto', 1_000_000)]
+if not rust_accumulate_available():
+    print('swift_rust is not built with accumulate_spim. Skipping the rust backend.')
+    BACKENDS.remove(('rust', 0))
+
+
+def synthetic_stream(x_size, y_size, chunk_size):
+    rng = numpy.random.default_rng(0)
+    nchunks = TOTAL_EVENTS // chunk_size
+    for _ in range(nchunks):
+        pixels = rng.integers(0, x_size * y_size, chunk_size)
+        energies = numpy.clip(rng.exponential(60, chunk_size) + 100, 0, 1024).astype(numpy.uint32)
+        yield (pixels * 1025 + energies).astype(numpy.uint32)
+
+
+for (x_size, y_size) in [(64, 64), (256, 256)]:
+    for chunk_size in [1_000, 32_000, 1_000_000]:
+        chunks = list(synthetic_stream(x_size, y_size, chunk_size))
+        reference = None
+        for backend, coalesce in BACKENDS:
+            size = x_size * y_size * 1025
+            if backend == 'bincount' and chunk_size * SpimAccumulator.BINCOUNT_RATIO <= size:
+                continue
+            data = numpy.zeros(size, dtype=numpy.uint32)
+            accumulator = SpimAccumulator(data, backend, coalesce)
+            start = time.perf_counter()
+            for chunk in chunks:
+                accumulator.accumulate(chunk)
+            accumulator.flush()
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = data
+            assert numpy.array_equal(reference, data)
+            print(f'spim {x_size}x{y_size}, chunk {chunk_size}, {accumulator.backend} (coalesce {coalesce}): '
+                  f'{TOTAL_EVENTS / elapsed / 1e6:.1f} Mevents/s.')
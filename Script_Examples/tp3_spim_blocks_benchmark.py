@@ -0,0 +1,57 @@
+import time
+import tracemalloc
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import SpimBlocks
+
+"""
+Peak memory and copy volume when receiving FRAMES spim frames of FRAME_SHAPE, with the data displayed every
+display_every frames (or never) and saved at the end. Previous policy (numpy.append of an array of zeros of the same size when the
+frame number passes the capacity) is compared to SpimBlocks.
+"""
+
+FRAMES = 100000
+FRAME_SHAPE = (1, 1024)
+INITIAL_FRAMES = 10
+DISPLAY_EVERIES = [1000, None]
+
+frame = numpy.ones(FRAME_SHAPE, dtype=numpy.float32)
+final_bytes = FRAMES * frame.nbytes
+
+
+def run_append(display_every):
+    data = numpy.zeros((INITIAL_FRAMES,) + FRAME_SHAPE, dtype=numpy.float32)
+    copied = 0
+    for index in range(FRAMES):
+        while index >= len(data):
+            copied += data.nbytes
+            data = numpy.append(data, numpy.zeros(data.shape, dtype=data.dtype), axis=0)
+        data[index] = frame
+        if display_every and index % display_every == 0:
+            displayed = data
+    saved = data[:FRAMES]
+    return copied
+
+
+def run_blocks(display_every):
+    data = SpimBlocks(FRAME_SHAPE)
+    for index in range(FRAMES):
+        data.write(index, frame)
+        if display_every and index % display_every == 0:
+            displayed = data.contiguous()
+    saved = data.contiguous()
+    assert saved.shape == (FRAMES,) + FRAME_SHAPE and saved.all()
+    return data.copied_bytes
+
+
+for display_every in DISPLAY_EVERIES:
+    for name, run in [('numpy.append', run_append), ('SpimBlocks', run_blocks)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        copied = run(display_every)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        display = f'display every {display_every} frames' if display_every else 'no display'
+        print(f'{name}, {display}: {elapsed:.2f} s, peak memory {peak / final_bytes:.2f} x '
+              f'data ({peak / 1e6:.0f} MB), {copied / final_bytes:.2f} x data copied ({copied / 1e6:.0f} MB).')
@@ -0,0 +1,58 @@
+import time
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import TimePix3
+from nionswift_plugin.IVG.virtual_instruments.tp3_vi import Tp3DataServer
+
+"""
+Throughput and latency of the TimePix3 streaming paths against the simulated data port. acquire_streamed_frame is
+measured in Focus (1d and 2d) with frames sent as fast as possible and at a fixed rate; latency is the time between
+the frame being sent (timeAtFrame) and its decoding in the callback. acquire_streamed_frame_from_scan is measured with
+a spim event stream.
+"""
+
+DURATION = 3.0
+
+latencies = list()
+
+
+def message(message):
+    if message == 1:
+        prop, image = camera.get_last_image()
+        latencies.append(time.time() - prop.timeAtFrame)
+
+
+def run_focus(server, displaymode):
+    latencies.clear()
+    sent_frames, sent_bytes = server.sent_frames, server.sent_bytes
+    camera.startFocus(0.01, displaymode, 0)
+    time.sleep(DURATION)
+    metrics = camera.get_frame_metrics()
+    camera.stopFocus()
+    frames = server.sent_frames - sent_frames
+    mbytes = (server.sent_bytes - sent_bytes) / 1e6
+    print(f'Focus {displaymode} at {server.frame_rate or "max"} fps: {frames / DURATION:.1f} frames/s, '
+          f'{mbytes / DURATION:.1f} MB/s. Latency median {numpy.median(latencies) * 1e3:.2f} ms, '
+          f'99% {numpy.percentile(latencies, 99) * 1e3:.2f} ms. {metrics}')
+
+
+def run_spim(server):
+    sent_events = server.sent_events
+    camera.StartSpimFromScan()
+    time.sleep(DURATION)
+    camera.stopSpim(True)
+    events = server.sent_events - sent_events
+    spim = camera.create_spimimage_from_events()
+    print(f'Spim: {events / DURATION / 1e6:.2f} Mevents/s sent, {int(spim.sum())} of {events} accumulated. '
+          f'{camera.get_spim_metrics()}')
+
+
+for frame_rate in [None, 100.]:
+    server = Tp3DataServer(frame_rate=frame_rate, event_rate=2e7)
+    server.start()
+    camera = TimePix3('http://127.0.0.1:8080', True, message)
+    run_focus(server, '1d')
+    run_focus(server, '2d')
+    if frame_rate is None:
+        run_spim(server)
+    server.stop()
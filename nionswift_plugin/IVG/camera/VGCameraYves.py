@@ -8,6 +8,7 @@ import typing
 import time
 import json
 import os
+import sys
 from enum import Enum
 import logging
 
@@ -66,6 +67,100 @@ class Orsay_Data(Enum):
     real = 12
 
 
+class CallbackMonitor:
+    """
+    Call counter and duration histogram of a Cameras.dll callback.
+
+    Durations are binned by powers of two of nanoseconds, so record only costs a subtraction, a bit_length and an
+    increment. Each callback is invoked by a single DLL thread, so no lock is needed.
+    """
+
+    BINS = 40
+
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.counts = [0] * self.BINS
+
+    def record(self, start_ns):
+        elapsed = time.perf_counter_ns() - start_ns
+        self.calls += 1
+        self.total_ns += elapsed
+        self.counts[min(elapsed.bit_length(), self.BINS - 1)] += 1
+
+    def histogram(self):
+        """
+        Returns the bin upper edges in us and the number of calls in each bin, up to the last non-empty one.
+        """
+        last = max((index for index, count in enumerate(self.counts) if count), default=-1) + 1
+        return [2 ** index / 1000. for index in range(last)], self.counts[:last]
+
+    def metrics(self):
+        edges, counts = self.histogram()
+        return {'calls': self.calls, 'mean_us': self.total_ns / self.calls / 1000. if self.calls else 0.,
+                'histogram_us': dict(zip(edges, counts))}
+
+    def clear(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.counts = [0] * self.BINS
+
+
+class FrameBufferRing:
+    """
+    Rotation of count image buffers shared with Cameras.dll. The data locker writes in a buffer from acquire_write and
+    the unlocker publishes it. read hands the last published buffer over and puts a new one in its place, so images are
+    neither torn nor copied.
+    """
+
+    def __init__(self, shape, dtype=numpy.float32, count=3):
+        assert count >= 2, "***CAMERA***: FrameBufferRing needs at least 2 buffers."
+        self.buffers = [numpy.zeros(shape, dtype=dtype) for _ in range(count)]
+        self.pointers = [buffer.ctypes.data_as(ctypes.c_void_p) for buffer in self.buffers]
+        self.__free = list(range(count))
+        self.__published = None
+        self.__lock = threading.Lock()
+        self.published = 0
+        self.superseded = 0
+        self.allocations = count
+
+    def acquire_write(self):
+        """
+        Returns the index of a free buffer, which is not free anymore until published or cancelled.
+        """
+        with self.__lock:
+            return self.__free.pop(0)
+
+    def publish(self, index):
+        with self.__lock:
+            if self.__published is not None:
+                self.__free.append(self.__published)
+                self.superseded += 1
+            self.__published = index
+            self.published += 1
+
+    def cancel(self, index):
+        with self.__lock:
+            self.__free.append(index)
+
+    def read(self):
+        """
+        Returns the last published buffer, which now belongs to the caller, or None if nothing was published since the
+        previous read.
+        """
+        with self.__lock:
+            index = self.__published
+            if index is None:
+                return None
+            self.__published = None
+            image = self.buffers[index]
+            self.buffers[index] = numpy.empty_like(image)
+            self.pointers[index] = self.buffers[index].ctypes.data_as(ctypes.c_void_p)
+            self.allocations += 1
+            self.__free.append(index)
+            return image
+
+
 class CameraDevice(camera_base.CameraDevice):
 
     def __init__(self, manufacturer, model, sn, simul, instrument: ivg_inst.ivgInstrument, id, name, type):
@@ -77,6 +172,9 @@ class CameraDevice(camera_base.CameraDevice):
         if manufacturer == 4:
             self.camera_callback = tp3func.SENDMYMESSAGEFUNC(self.sendMessageFactory())
             self.camera = tp3func.TimePix3(sn, simul, self.sendMessageFactory())
+        elif simul and sys.platform != "win32":
+            from nionswift_plugin.IVG.virtual_instruments import orsaycamera_vi as orsaycamera
+            self.camera = orsaycamera.orsayCamera(manufacturer, model, sn, simul)
         else:
             from nionswift_plugin.IVG.camera import orsaycamera
             self.camera = orsaycamera.orsayCamera(manufacturer, model, sn, simul)
@@ -118,6 +216,19 @@ class CameraDevice(camera_base.CameraDevice):
         self.spimimagedata_ptr = None
         self.has_spim_data_event = threading.Event()
 
+        # state read by the DLL callbacks, resolved once per acquisition in start_live
+        self.__hardware_source = None
+        self.__image_ring = None
+        self.__writing = None
+        self.__imagedata_type = (None, None)
+        self.__spimimagedata_type = (None, None)
+        self.__spectrum_display = False
+        self.__is_chrono = False
+        self.__check_status = False
+        self.__callback_monitors = {name: CallbackMonitor() for name in
+                                    ("data_locker", "data_unlocker", "spim_data_locker", "spim_data_unlocker",
+                                     "spectrum_data_locker", "spectrum_data_unlocker")}
+
         bx, by = self.camera.getBinning()
         port = self.camera.getCurrentPort()
 
@@ -275,53 +386,111 @@ class CameraDevice(camera_base.CameraDevice):
         else:
             print("Data connection changed: " + changed)
 
+    """
+    The lockers and unlockers below are called by Cameras.dll for every frame or spectrum, so they only use the state
+    prepared in start_live (array types, hardware source, acquisition mode): no call back to the DLL and no lookup. The
+    acquisition status is read by acquire_image instead, when an unlocker reports no new data or nothing arrived.
+    """
+
     def __data_locker(self, gene, data_type, sx, sy, sz):
+        start = time.perf_counter_ns()
+        if self.__writing is None:
+            self.__writing = self.__image_ring.acquire_write()
         sx[0] = self.sizex
         sy[0] = self.sizey
         sz[0] = 1
-        data_type[0] = self.__numpy_to_orsay_type(self.imagedata)
-        return self.imagedata_ptr.value
+        data_type[0] = self.__image_type()
+        self.__callback_monitors["data_locker"].record(start)
+        return self.__image_ring.pointers[self.__writing].value
 
     def __data_unlocker(self, gene, new_data):
+        start = time.perf_counter_ns()
         self.frame_number += 1
-        status = self.camera.getCCDStatus()
+        if self.__writing is not None:
+            if new_data:
+                self.__image_ring.publish(self.__writing)
+            else:
+                self.__image_ring.cancel(self.__writing)
+            self.__writing = None
         if new_data:
             self.has_data_event.set()
-        if status["mode"] == "Cumul":
-            self.frame_number = status["accumulation_count"]
-        if status["mode"] == "idle":
-            hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                self.camera_id)
-            hardware_source.stop_playing()
+        else:
+            self.__check_status = True
+        self.__callback_monitors["data_unlocker"].record(start)
 
     def __spim_data_locker(self, gene, data_type, sx, sy, sz):
+        start = time.perf_counter_ns()
         sx[0] = self.sizex
         sy[0] = self.sizey
         sz[0] = self.sizez
-        data_type[0] = 100 + self.__numpy_to_orsay_type(self.spimimagedata)
+        data_type[0] = self.__spim_image_type()
+        self.__callback_monitors["spim_data_locker"].record(start)
         return self.spimimagedata_ptr.value
 
     def __spim_data_unlocker(self, gene: int, new_data: bool, running: bool):
-        status = self.camera.getCCDStatus()
-        if new_data:
-            self.has_spim_data_event.set()
-        if not running:
+        start = time.perf_counter_ns()
+        if new_data or not running:
             self.has_spim_data_event.set()
-            hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                self.camera_id)
-            hardware_source.stop_playing()
+        if not running and self.__hardware_source is not None:
+            self.__hardware_source.stop_playing()
+        self.__callback_monitors["spim_data_unlocker"].record(start)
 
     def __spectrum_data_locker(self, gene, data_type, sx) -> None:
-        if self.__acqon and self.__acqspimon and (self.current_camera_settings.exposure_ms >= 10):
+        start = time.perf_counter_ns()
+        if self.__spectrum_display:
             sx[0] = self.sizex
-            data_type[0] = self.__numpy_to_orsay_type(self.imagedata)
+            data_type[0] = self.__image_type()
+            self.__callback_monitors["spectrum_data_locker"].record(start)
             return self.imagedata_ptr.value
         else:
             return None
 
     def __spectrum_data_unlocker(self, gene, newdata):
-        if "Chrono" in self.current_camera_settings.acquisition_mode:
+        start = time.perf_counter_ns()
+        if self.__is_chrono:
             self.has_data_event.set()
+        self.__callback_monitors["spectrum_data_unlocker"].record(start)
+
+    def get_callback_metrics(self):
+        """
+        Returns, for each DLL callback, the number of calls of the current acquisition, their mean duration and the
+        histogram of their durations (upper bin edge in us: number of calls).
+        """
+        return {name: monitor.metrics() for name, monitor in self.__callback_monitors.items()}
+
+    def __image_type(self):
+        dtype, orsay_type = self.__imagedata_type
+        if dtype != self.imagedata.dtype:
+            orsay_type = self.__numpy_to_orsay_type(self.imagedata)
+            self.__imagedata_type = (self.imagedata.dtype, orsay_type)
+        return orsay_type
+
+    def __spim_image_type(self):
+        dtype, orsay_type = self.__spimimagedata_type
+        if dtype != self.spimimagedata.dtype:
+            orsay_type = 100 + self.__numpy_to_orsay_type(self.spimimagedata)
+            self.__spimimagedata_type = (self.spimimagedata.dtype, orsay_type)
+        return orsay_type
+
+    def __prepare_callbacks(self, hardware_source):
+        """
+        Called by start_live before the acquisition starts. __spectrum_display is updated once it started.
+        """
+        for monitor in self.__callback_monitors.values():
+            monitor.clear()
+        self.__hardware_source = hardware_source
+        self.__check_status = False
+        self.__is_chrono = "Chrono" in self.current_camera_settings.acquisition_mode
+        self.__spectrum_display = False
+
+    def __check_acquisition_status(self):
+        """
+        Called by acquire_image, outside of the DLL callbacks. Stops the hardware source if the camera went idle.
+        """
+        self.__check_status = False
+        status = self.camera.getCCDStatus()
+        if status.get("mode") == "idle" and self.__hardware_source is not None:
+            self.__hardware_source.stop_playing()
 
     @property
     def sensor_dimensions(self) -> (int, int):
@@ -359,6 +528,7 @@ class CameraDevice(camera_base.CameraDevice):
         self.camera.setAccumulationNumber(self.current_camera_settings.spectra_count)
         hardware_source = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
             self.camera_id)
+        self.__prepare_callbacks(hardware_source)
 
         if "Chrono" in self.current_camera_settings.acquisition_mode:
             if self.current_camera_settings.acquisition_mode == '2D-Chrono':
@@ -399,6 +569,14 @@ class CameraDevice(camera_base.CameraDevice):
                                                       self.__y_pix_spim)  # This must finish before calling the rest
             self.camera.resumeSpim(4)
 
+        elif "Time-Resolved" in self.current_camera_settings.acquisition_mode:
+            self.sizey = self.current_camera_settings.spectra_count
+            self.sizez = 1
+            self.spimimagedata = numpy.zeros((self.sizey, self.sizex), dtype=numpy.float32)
+            sb = "1d" if self.current_camera_settings.soft_binning else "2d"
+            self.__acqon = self.camera.startTimeResolved(self.current_camera_settings.exposure_ms / 1000, sb,
+                                                         self.current_camera_settings.spectra_count)
+
         elif "SpimTP" in self.current_camera_settings.acquisition_mode:
             self.sizey = self.sizez = self.sizey = self.current_camera_settings.spectra_count
             self.camera.stopFocus()
@@ -415,8 +593,12 @@ class CameraDevice(camera_base.CameraDevice):
                 acqmode = 1
             self.imagedata = numpy.zeros((self.sizey, self.sizex), dtype=numpy.float32)
             self.imagedata_ptr = self.imagedata.ctypes.data_as(ctypes.c_void_p)
+            self.__image_ring = FrameBufferRing((self.sizey, self.sizex), numpy.float32)
+            self.__writing = None
             self.__acqon = self.camera.startFocus(self.current_camera_settings.exposure_ms / 1000, sb, acqmode)
 
+        self.__spectrum_display = self.__acqon and self.__acqspimon and \
+                                  (self.current_camera_settings.exposure_ms >= 10)
         self._last_time = time.time()
 
     def stop_live(self) -> None:
@@ -457,6 +639,13 @@ class CameraDevice(camera_base.CameraDevice):
             collection_dimensions = 2
             datum_dimensions = 1
 
+        elif "Time-Resolved" in acquisition_mode:
+            self.has_spim_data_event.wait(1.0)
+            self.has_spim_data_event.clear()
+            self.acquire_data = self.spimimagedata
+            collection_dimensions = 1
+            datum_dimensions = 1
+
         elif "SpimTP" in acquisition_mode:
             self.has_spim_data_event.wait(1.0)
             self.acquire_data = self.spimimagedata
@@ -465,8 +654,21 @@ class CameraDevice(camera_base.CameraDevice):
             self.has_spim_data_event.clear()
 
         else:  # Cumul and Focus
-            self.has_data_event.wait(1.0)  # wait until True
+            if not self.has_data_event.wait(1.0) and not self.isTimepix:  # wait until True
+                self.__check_status = True
             self.has_data_event.clear()  # Puts back false
+            if self.__check_status:
+                self.__check_acquisition_status()
+            if self.isTimepix and self.camera.has_new_data():
+                self.read_last_timepix_frame()
+            elif not self.isTimepix and self.__image_ring is not None:
+                image = self.__image_ring.read()  # Ours now: the DLL never writes in it again.
+                if image is not None:
+                    self.imagedata = image
+                    if acquisition_mode == "Cumul":
+                        status = self.camera.getCCDStatus()
+                        if status.get("mode") == "cumul":
+                            self.frame_number = status["accumulation_count"]
             self.acquire_data = self.imagedata
             if self.acquire_data.shape[0] == 1:  # fully binned
                 collection_dimensions = 1
@@ -555,6 +757,12 @@ class CameraDevice(camera_base.CameraDevice):
                 "storage_memory": storage_memory}
     """
 
+    def read_last_timepix_frame(self):
+        decoded = self.camera.get_last_decoded_frame()
+        self.imagedata = self.camera.take_image(decoded)  # Swift keeps the array, so it leaves the decode pool.
+        self.frame_number = int(decoded.properties.frameNumber)
+        self.current_event.fire(format(decoded.current, ".5f"))
+
     def sendMessageFactory(self):
         """
         Notes
@@ -571,25 +779,21 @@ class CameraDevice(camera_base.CameraDevice):
 
         The callback are basically events that tell acquire_image that a new data is available for displaying. In my case,
         message equals to 01 is equivalent to Marcel's data locker, while message equals to 02 is equivalent to spim data
-        locker. Data locker (message==1) gets data from a LIFOQueue, which is a tuple in which first element is the frame
-        properties and second is the data (in bytes). You can see what is available in dict 'prop' checking either
-        serval manual or tp3func. create_image_from_bytes simply convert my bytes to a int8 array. A soft binning attribute
-        is defined in tp3 so the idea is that image always come in the right way.
+        locker. Data locker (message==1) only tells a new frame was decoded, which read_last_timepix_frame reads. You can
+        see what is available in 'prop' checking either serval manual or tp3func. A soft binning attribute is defined
+        in tp3 so the idea is that image always come in the right way.
 
         For message==2, it is exactly the same. Difference is simply dimensionality (datum and collection dimensions) and,
         if array is complete, i double the size in order to always show more data. A personal choice to never limit data
         arrival.
+
+        Message==3 is Chrono, a copy of the tp3func ChronoBuffer rows.
+
+        Message==4 is the time-resolved histogram of tp3func.
         """
 
         def sendMessage(message):
             if message == 1:
-                prop, last_bytes_data = self.camera.get_last_data()
-                self.frame_number = int(prop['frameNumber'])
-                self.imagedata = self.camera.create_image_from_bytes(last_bytes_data,
-                                                                     prop['bitDepth'], prop['width'], prop['height'])
-                self.current_event.fire(
-                    format(self.camera.get_current(self.imagedata, self.frame_number), ".5f")
-                )
                 self.has_data_event.set()
 
             elif message == 2:
@@ -597,12 +801,14 @@ class CameraDevice(camera_base.CameraDevice):
                 self.spimimagedata = self.camera.create_spimimage_from_events()
                 self.has_spim_data_event.set()
 
+            elif message == 4:
+                self.spimimagedata = self.camera.get_time_resolved_image()
+                self.has_spim_data_event.set()
+
             elif message == 3:
-                prop, last_bytes_data = self.camera.get_last_data()
-                self.frame_number = int(prop['frameNumber'])
-                self.spimimagedata = self.camera.create_image_from_bytes(last_bytes_data,
-                                                                     prop['bitDepth'], prop['width'], prop['height'])
-                self.has_data_event.set()
+                self.spimimagedata = self.camera.get_chrono_image()
+                self.frame_number = self.camera.get_chrono_buffer().count
+                self.has_spim_data_event.set()
 
         return sendMessage
 
@@ -617,7 +823,7 @@ class CameraFrameParameters(dict):
         self.v_binning = self.get("v_binning", 1)
         self.soft_binning = self.get("soft_binning", True)  # 1d, 2d
         self.acquisition_mode = self.get("acquisition_mode",
-                                         "Focus")  # Focus, Cumul, 1D-Chrono, 1D-Chrono-Live, 2D-Chrono
+                                         "Focus")  # Focus, Cumul, 1D-Chrono, 1D-Chrono-Live, 2D-Chrono, Time-Resolved
         self.spectra_count = self.get("spectra_count", 1)
         self.speed = self.get("speed", 1)
         self.gain = self.get("gain", 0)
@@ -690,6 +896,8 @@ class CameraSettings:
         self.modes = ["Focus", "Cumul", "1D-Chrono", "1D-Chrono-Live", "SpimTP"]
         if self.__camera_device.isTimepix:
             self.modes = ["Focus", "Cumul", "1D-Chrono", "1D-Chrono-Live"]
+            if self.__camera_device.camera.isTimeResolvedAvailable():
+                self.modes.append("Time-Resolved")
 
 
         self.settings_id = camera_device.camera_id
@@ -1,4 +1,5 @@
 # standard libraries
+import concurrent.futures
 import copy
 import math
 import ctypes
@@ -18,7 +19,10 @@ from nion.instrumentation import scan_base
 from nion.instrumentation import stem_controller
 from nion.swift.model import HardwareSource
 
-from nionswift_plugin.IVG.scan.orsayscan import orsayScan, LOCKERFUNC, UNLOCKERFUNCA
+try:
+    from nionswift_plugin.IVG.scan import orsayscan
+except (ImportError, OSError):  # No Scan.dll (for instance on Linux). The scan is simulated.
+    from nionswift_plugin.IVG.virtual_instruments import orsayscan_vi as orsayscan
 from nionswift_plugin.IVG.scan.ConfigVGLumDialog import ConfigDialog
 
 from nionswift_plugin.IVG import ivg_inst
@@ -76,6 +80,9 @@ scan_base.update_scan_data_element = test_update_scan_data_element
 
 
 
+TPX3_CHANNELS = ('TPX3', 'TPX3 Sum')  # Spectrum image of the TimePix3 and its total counts per pixel.
+
+
 class Channel:
     def __init__(self, channel_id: int, name: str, enabled: bool):
         self.channel_id = channel_id
@@ -97,9 +104,159 @@ class Frame:
         self.start_time = time.time()
         self.scan_data = None
 
+
+class DriftCorrectedAverager:
+    """
+    Running average (or sum) of scan frames, corrected for the drift between frames. add takes the frames over and a
+    worker thread shifts them by the drift of the first channel (see estimate_shift); frames arriving while it is busy
+    are skipped. 'average' forgets old frames with a time constant of frames frames and 'sum' restarts every frames
+    frames.
+    """
+    MODES = ['average', 'sum']
+
+    def __init__(self, frames=10, mode='average', downsample=4):
+        assert mode in self.MODES, f'***SCAN***: Averaging mode must be one of {self.MODES}.'
+        self.frames = max(1, int(frames))
+        self.mode = mode
+        self.downsample = max(1, int(downsample))
+        self.count = 0
+        self.skipped = 0
+        self.sequence = 0
+        self.drift = (0., 0.)  # Total drift (y, x) in pixels since the first frame.
+        self.__sums = None
+        self.__weights = None
+        self.__spare = None
+        self.__results = None
+        self.__published = 0
+        self.__restart = True
+        self.__lock = threading.Lock()
+        self.__busy = False
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def add(self, images):
+        """
+        Queues a finished frame, a list of 2D images (one per channel), without copying it. The images must not be
+        written any more; the returned images, of the same shapes and dtypes, are free to read the next frame into.
+        Returns None if the frame is skipped, in which case the images are not kept.
+        """
+        with self.__lock:
+            if self.__busy:
+                self.skipped += 1
+                return None
+            self.__busy = True
+        spare = self.__spare
+        if spare is None or len(spare) != len(images) or \
+                any(free.shape != image.shape or free.dtype != image.dtype for free, image in zip(spare, images)):
+            spare = [numpy.empty_like(image) for image in images]
+        self.__spare = list(images)
+        self.__executor.submit(self.__add, self.__spare)
+        return spare
+
+    def result(self, index):
+        """
+        Last averaged (or summed) image of channel index, None before the first frame.
+        """
+        with self.__lock:
+            if self.__results is None or index >= len(self.__results[self.__published]):
+                return None
+            return self.__results[self.__published][index]
+
+    def reset(self):
+        """
+        Starts a new average with the next frame.
+        """
+        self.__restart = True
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=True)
+
+    def __add(self, images):
+        try:
+            shape = images[0].shape
+            if self.__restart or self.__sums[0].shape != shape or len(self.__sums) != len(images) or \
+                    (self.mode == 'sum' and self.count >= self.frames):
+                self.__restart = False
+                self.drift = (0., 0.)
+                self.__sums = [numpy.zeros(shape, numpy.float32) for _ in images]
+                self.__weights = numpy.zeros(shape, numpy.float32)
+                self.__results = [[numpy.zeros(shape, numpy.float32) for _ in images] for _ in range(2)]
+                self.count = 0
+                shift = (0, 0)
+            else:
+                dy, dx = self.estimate_shift(self.__sums[0] / numpy.maximum(self.__weights, 1.), images[0])
+                self.drift = (dy, dx)
+                shift = (int(round(dy)), int(round(dx)))
+            if self.mode == 'average' and self.count >= self.frames:
+                forget = (self.frames - 1) / self.frames
+                for total in self.__sums:
+                    total *= forget
+                self.__weights *= forget
+            target, source = self.overlap(shape, shift)
+            for total, image in zip(self.__sums, images):
+                total[target] += image[source]
+            self.__weights[target] += 1.
+            self.count += 1
+            results = self.__results[1 - self.__published]
+            weights = numpy.maximum(self.__weights, 1e-3)
+            for result, total in zip(results, self.__sums):
+                if self.mode == 'sum':
+                    numpy.copyto(result, total)
+                else:
+                    numpy.divide(total, weights, out=result)
+            with self.__lock:
+                self.__published = 1 - self.__published
+                self.sequence += 1
+        except Exception as e:
+            logging.info(f'***SCAN***: Error averaging frame: {e}.')
+        finally:
+            with self.__lock:
+                self.__busy = False
+
+    @staticmethod
+    def overlap(shape, shift):
+        """
+        Slices of the accumulated image (target) and of the frame (source) that overlap when the frame is moved by
+        shift (dy, dx) pixels.
+        """
+        target, source = list(), list()
+        for size, delta in zip(shape, shift):
+            delta = max(-size, min(size, delta))
+            target.append(slice(max(delta, 0), size + min(delta, 0)))
+            source.append(slice(max(-delta, 0), size - max(delta, 0)))
+        return tuple(target), tuple(source)
+
+    def estimate_shift(self, reference, image):
+        """
+        Shift (dy, dx) in pixels that moves image onto reference, from the peak of their cross-correlation computed
+        on downsampled and windowed copies.
+        """
+        factor = self.downsample
+        height, width = (reference.shape[0] // factor) * factor, (reference.shape[1] // factor) * factor
+        if height < 2 * factor or width < 2 * factor:
+            return 0., 0.
+        small = [array[:height, :width].reshape((height // factor, factor, width // factor, factor)).mean(axis=(1, 3))
+                 for array in (reference, image)]
+        window = numpy.outer(numpy.hanning(height // factor), numpy.hanning(width // factor))
+        spectra = [numpy.fft.rfft2((array - array.mean()) * window) for array in small]
+        cross = spectra[0] * numpy.conj(spectra[1])
+        cross /= numpy.abs(cross) + 1e-9
+        correlation = numpy.fft.irfft2(cross, s=small[0].shape)
+        peak = numpy.unravel_index(numpy.argmax(correlation), correlation.shape)
+        shift = list()
+        for axis, (position, size) in enumerate(zip(peak, correlation.shape)):
+            before = list(peak)
+            after = list(peak)
+            before[axis] = (position - 1) % size
+            after[axis] = (position + 1) % size
+            left, center, right = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+            denominator = left - 2 * center + right
+            offset = 0.5 * (left - right) / denominator if denominator != 0 else 0.
+            shift.append(float(((position + size // 2) % size - size // 2 + offset) * factor))
+        return tuple(shift)
+
 class Device:
 
-    def __init__(self, instrument: ivg_inst.ivgInstrument):
+    def __init__(self, instrument: ivg_inst.ivgInstrument, simul=False):
         self.scan_device_id = "orsay_scan_device"
         self.scan_device_name = _("VG Lumiere")
         self.stem_controller_id = "VG_Lum_controller"
@@ -119,17 +276,23 @@ class Device:
         self.__buffer = list()
         self.bottom_blanker = 0
 
-        self.orsayscan = orsayScan(1, vg=True)
-        self.spimscan = orsayScan(2, self.orsayscan.orsayscan, vg=True)
+        scan_library = orsayscan
+        if simul:
+            logging.info('***SCAN***: Simulation is configured. Using the simulated scan.')
+            from nionswift_plugin.IVG.virtual_instruments import orsayscan_vi as scan_library
+        self.orsayscan = scan_library.orsayScan(1, vg=True)
+        self.spimscan = scan_library.orsayScan(2, self.orsayscan.orsayscan, vg=True)
 
         self.orsayscan.SetInputs([1, 0])
         self.spimscan.SetInputs([1, 0])
 
         self.has_data_event = threading.Event()
+        self.__new_rows = dict()  # image number: [first row, end row, last line written] not read yet.
+        self.__rows_lock = threading.Lock()
 
-        self.fnlock = LOCKERFUNC(self.__data_locker)
+        self.fnlock = scan_library.LOCKERFUNC(self.__data_locker)
         self.orsayscan.registerLocker(self.fnlock)
-        self.fnunlock = UNLOCKERFUNCA(self.__data_unlockerA)
+        self.fnunlock = scan_library.UNLOCKERFUNCA(self.__data_unlockerA)
         self.orsayscan.registerUnlockerA(self.fnunlock)
 
         self.orsayscan.setScanScale(0, 5.0, 5.0)
@@ -145,10 +308,19 @@ class Device:
 
         self.__tpx3_spim = False
         self.__tpx3_data = None
+        self.__tpx3_sum = None
+        self.__tpx3_lines = None  # Spim lines (first, end) that received events and were not sent yet.
+        self.__tpx3_turn = False
         self.__tpx3_camera = None
         self.__tpx3_calib = dict()
         self.__tpx3_frameStop = 0
 
+        self.__averaging_frames = 1
+        self.__averaging_mode = 'average'
+        self.__averager = None
+        self.__averaged_sequence = 0
+        self.__averaged_channels = None
+
         self.p0 = 512
         self.p1 = 512
         self.p2 = 0
@@ -200,6 +372,7 @@ class Device:
         for camera in cameras:
             if camera["manufacturer"] == 4:
                 channels.append(Channel(2, "TPX3", False))
+                channels.append(Channel(3, "TPX3 Sum", False))
         return channels
 
     def __get_initial_profiles(self) -> typing.List[scan_base.ScanFrameParameters]:
@@ -278,23 +451,33 @@ class Device:
 
     def no_prepare_timepix3(self):
         self.__tpx3_data = None
+        self.__tpx3_sum = None
+        self.__tpx3_lines = None
+        self.__tpx3_turn = False
 
     def start_frame(self, is_continuous: bool) -> int:
         """Start acquiring. Return the frame number."""
         if not self.__is_scanning:
             self.__buffer = list()
+            with self.__rows_lock:
+                self.__new_rows.clear()
+            self.__frame = None
             self.__start_next_frame()
 
             logging.info(f"***SCAN***: Starting acquisition. Spim is {self.__spim}")
             if not self.__spim:
                 #self.imagedata = numpy.empty((self.__sizez * (self.__scan_area[0]), (self.__scan_area[1])), dtype=numpy.int16)
                 #self.imagedata_ptr = self.imagedata.ctypes.data_as(ctypes.c_void_p)
-                for channel in self.__channels:
-                    if channel.name == 'TPX3':
-                        if channel.enabled:
-                            self.prepare_timepix3()
-                        else:
-                            self.no_prepare_timepix3()
+                if any(channel.enabled for channel in self.__channels if channel.name in TPX3_CHANNELS):
+                    self.prepare_timepix3()
+                else:
+                    self.no_prepare_timepix3()
+                if self.__averager is not None:
+                    self.__averager.shutdown()
+                self.__averager = DriftCorrectedAverager(self.__averaging_frames, self.__averaging_mode) \
+                    if self.__averaging_frames > 1 else None
+                self.__averaged_sequence = 0
+                self.__averaged_channels = None
                 #Scan must be started after timepix3 so we are ready for receiving TDC's
                 self.__is_scanning = self.orsayscan.startImaging(0, 1)
 
@@ -305,13 +488,57 @@ class Device:
         frame_parameters = copy.deepcopy(self.__frame_parameters)
         self.__scan_context = stem_controller.ScanContext()
         channels = [copy.deepcopy(channel) for channel in self.__channels if channel.enabled]  # channel enabled is here
-        size = Geometry.IntSize.make(
-            frame_parameters.subscan_pixel_size if frame_parameters.subscan_pixel_size else frame_parameters.size)
         for channel in channels:
-            channel.data = numpy.zeros(tuple(size), numpy.float32)
+            if channel.name not in TPX3_CHANNELS:
+                channel.data = (self.__spim_frames if self.__spim else self.__frames)[channel.channel_id]
         #self.__frame_number += 1 #This is updated in the self.__frame_number
         self.__frame = Frame(self.__frame_number, channels, frame_parameters)
 
+    def __allocate_frames(self):
+        """
+        Frames given to Swift for each channel. They are kept from frame to frame and only allocated again when the
+        image area or the spim size change.
+        """
+        self.__frames = [numpy.zeros(self.__imaging_view(channel_id).shape, numpy.uint16)
+                         for channel_id in range(self.__sizez)]
+        self.__spim_frames = [numpy.zeros((self.__spim_pixels[1], self.__spim_pixels[0]), numpy.float32)
+                              for channel_id in range(self.__sizez)]
+
+    def __imaging_view(self, channel_id):
+        """
+        View of the scan buffer (self.imagedata) that is displayed for channel_id, cropped to the subscan if any.
+        """
+        data_array = self.imagedata[channel_id * (self.__scan_area[1]):(channel_id + 1) * (self.__scan_area[1]),
+                     0 + 1: (self.__scan_area[0] - 1)]
+        if self.subscan_status:  # Marcel programs returns 0 pixels without the sub scan region so i just crop
+            data_array = data_array[self.p4:self.p5, self.p2:self.p3]
+        return data_array
+
+    def __take_new_rows(self):
+        """
+        Number of the oldest unread image, its rows written since the last read, in displayed image coordinates, and
+        whether its last line was written. An image followed by another one is finished. All images share the same
+        buffer, so if images are scanned faster than they are read, an unread image may already be partly overwritten
+        by the next ones: older images are then skipped and the newest one is read, whole if finished and otherwise as
+        a frame in progress.
+        """
+        with self.__rows_lock:
+            if not self.__new_rows:
+                return None, 0, 0, False
+            imagenb = min(self.__new_rows)
+            top, bottom, done = self.__new_rows[imagenb]
+            overwritten = any(rows[0] < bottom and rows[1] > top for number, rows in self.__new_rows.items()
+                              if number != imagenb)
+            if len(self.__new_rows) > 2 or overwritten:
+                imagenb = max(self.__new_rows)
+                top, bottom, done = self.__new_rows[imagenb]
+                self.__new_rows.clear()
+            else:
+                del self.__new_rows[imagenb]
+                done = done or len(self.__new_rows) > 0
+        offset = self.p4 if self.subscan_status else 0
+        return imagenb, max(top - offset, 0), max(bottom - offset, 0), done
+
     def read_partial(self, frame_number, pixels_to_skip) -> (typing.Sequence[dict], bool, bool, tuple, int, int):
         """Read or continue reading a frame.
         The `frame_number` may be None, in which case a new frame should be read.
@@ -326,7 +553,22 @@ class Device:
         a 'channel_id' indicating the index of the channel (may be an int or float).
         """
 
+        # TimePix3 spim lines and image rows have their own extents, so they are sent in separate reads. TimePix3
+        # lines left by the last read go first.
+        if self.__tpx3_spim:
+            tpx3_top, tpx3_bottom = self.__tpx3_camera.camera.camera.take_spim_lines()
+            if tpx3_bottom > tpx3_top:
+                self.__tpx3_lines = (tpx3_top, tpx3_bottom) if self.__tpx3_lines is None else \
+                    (min(self.__tpx3_lines[0], tpx3_top), max(self.__tpx3_lines[1], tpx3_bottom))
+        if self.__tpx3_lines is not None and self.__tpx3_turn:
+            self.__tpx3_turn = False
+            if self.__frame is None:
+                self.__start_next_frame()
+            data_elements, sub_area = self.__read_tpx3_lines(self.__frame)
+            return data_elements, False, False, sub_area, self.__frame.frame_number, pixels_to_skip
+
         gotit = self.has_data_event.wait(1.0)
+        self.has_data_event.clear()
 
         if self.__frame is None:
             self.__start_next_frame()
@@ -335,47 +577,70 @@ class Device:
         assert current_frame is not None
         data_elements = list()
 
+        # Only the rows written since the last read are copied. Spim is read as a whole.
+        if self.__spim:
+            shape = (self.__spim_pixels[1], self.__spim_pixels[0])
+            top, bottom, current_frame.complete = 0, shape[0], True
+        else:
+            shape = self.__imaging_view(0).shape
+            imagenb, top, bottom, complete = self.__take_new_rows()
+            if any(channel.data is not None and channel.data.shape != shape for channel in current_frame.channels):
+                logging.info(f'***SCAN***: Image area changed during frame {current_frame.frame_number}. Restarting it.')
+                self.__start_next_frame()
+                current_frame = self.__frame
+                top, bottom = 0, shape[0]
+            current_frame.complete = complete
+            if imagenb is not None:
+                current_frame.frame_number = imagenb
+            bottom = min(bottom, shape[0])
+            top = min(top, bottom)
+
+        # When averaging, imaging channels are sent whole, only when the worker has finished a new average.
+        averaging = self.__averager is not None and not self.__spim
+        imaging_channels = [channel for channel in current_frame.channels if channel.name not in TPX3_CHANNELS]
+        new_average = False
+        if averaging:
+            sequence = self.__averager.sequence
+            new_average = sequence != self.__averaged_sequence
+            self.__averaged_sequence = sequence
+        image_top, image_bottom = ((0, shape[0]) if new_average else (0, 0)) if averaging else (top, bottom)
+
+        sub_area = ((image_top, 0), (image_bottom - image_top, shape[1]))
+
         for channel in current_frame.channels:
             data_element = dict()
 
-            #Timepix3 Spim channel
-            if channel.name == 'TPX3':
-                if self.__frame_number % 10 == 0:
-                    data_array = self.__tpx3_data
-                    data_element["data"] = data_array
-                    properties = current_frame.frame_parameters.as_dict()
-                    properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
-                    properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
-                    properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
-                    properties["channel_id"] = channel.channel_id
-                    properties["eels_dispersion"] = self.__tpx3_calib["dispersion"]
-                    properties["eels_offset"] = self.__tpx3_calib["offset"]
-                    data_element["properties"] = properties
-                    if data_array is not None:
-                        data_elements.append(data_element)
+            # TimePix3 channels are sent by __read_tpx3_lines.
+            if channel.name in TPX3_CHANNELS:
+                pass
 
             else:
                 if not self.__spim:
                 #if not self.__spim and self.__isplaying:
-                    data_array = self.imagedata[channel.channel_id * (self.__scan_area[1]):(channel.channel_id + 1) * (
-                    self.__scan_area[1]),
-                                 0+1: (self.__scan_area[0]-1)].astype(numpy.uint16)
-                    if self.subscan_status:  # Marcel programs returns 0 pixels without the sub scan region so i just crop
-                        data_array = data_array[self.p4:self.p5, self.p2:self.p3]
+                    numpy.copyto(channel.data[top:bottom], self.__imaging_view(channel.channel_id)[top:bottom],
+                                 casting='unsafe')
+                    data_array = channel.data
+                    if averaging:
+                        data_array = self.__averager.result(imaging_channels.index(channel)) if new_average else None
                     data_element["data"] = data_array
                     properties = current_frame.frame_parameters.as_dict()
                     properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
                     properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
                     properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
                     properties["channel_id"] = channel.channel_id
+                    if averaging:
+                        properties["averaging_mode"] = self.__averager.mode
+                        properties["averaged_frames"] = min(self.__averager.count, self.__averager.frames)
+                        properties["drift_pixels"] = self.__averager.drift
                     data_element["properties"] = properties
                     if data_array is not None:
                         data_elements.append(data_element)
 
                 elif self.__spim:
-                    data_array = self.imagedata[channel.channel_id * (self.__scan_area[1]):channel.channel_id * (
-                        self.__scan_area[1]) + self.__spim_pixels[1],
-                                 0: (self.__spim_pixels[0])].astype(numpy.float32)
+                    first_row = channel.channel_id * (self.__scan_area[1])
+                    numpy.copyto(channel.data, self.imagedata[first_row:first_row + self.__spim_pixels[1],
+                                               0: (self.__spim_pixels[0])], casting='unsafe')
+                    data_array = channel.data
                     #data_array = self.imagedata.astype(numpy.float32)
                     #if self.subscan_status:  # Marcel programs returns 0 pixels without the sub scan region so i just crop
                     #    data_array = data_array[self.p4:self.p5, self.p2:self.p3]
@@ -389,9 +654,26 @@ class Device:
                     if data_array is not None:
                         data_elements.append(data_element)
 
-        self.has_data_event.clear()
+        # Finished frames are given to the averager, which starts again if the channels changed.
+        if averaging and current_frame.complete and imaging_channels:
+            channel_ids = [channel.channel_id for channel in imaging_channels]
+            if channel_ids != self.__averaged_channels:
+                self.__averager.reset()
+                self.__averaged_channels = channel_ids
+            spare = self.__averager.add([channel.data for channel in imaging_channels])
+            if spare is not None:  # The averager owns the frame now. The next one is read into the spare images.
+                for channel, data in zip(imaging_channels, spare):
+                    self.__frames[channel.channel_id] = data
+
+        # Without new image rows, pending TimePix3 lines are sent now. Otherwise they go in the next read.
+        if self.__tpx3_lines is not None:
+            if image_bottom <= image_top and not current_frame.complete:
+                data_elements, sub_area = self.__read_tpx3_lines(current_frame)
+            else:
+                self.__tpx3_turn = True
 
-        current_frame.complete = True
+        frame_number = current_frame.frame_number
+        pixels_to_skip = 0 if current_frame.complete else bottom * shape[1]
         if current_frame.complete:
             self.__frame = None
 
@@ -401,11 +683,35 @@ class Device:
                          f"of frames are {self.__frame_number}.")
             self.stop()
 
-
-
-
         # return data_elements, complete, bad_frame, sub_area, frame_number, pixels_to_skip
-        return data_elements, current_frame.complete, False, ((0, 0), data_array.shape), None, 0
+        return data_elements, current_frame.complete, False, sub_area, frame_number, pixels_to_skip
+
+    def __read_tpx3_lines(self, current_frame):
+        """
+        Data elements of the TimePix3 channels for the pending spim lines, and their sub area.
+        """
+        tpx3_top, tpx3_bottom = self.__tpx3_lines
+        self.__tpx3_lines = None
+        camera = self.__tpx3_camera.camera.camera
+        if any(channel.name == 'TPX3' for channel in current_frame.channels):
+            self.__tpx3_data = camera.create_spimimage_from_events((tpx3_top, tpx3_bottom))
+        self.__tpx3_sum = camera.get_spim_summed_image()
+        data_elements = list()
+        for channel in current_frame.channels:
+            data_array = self.__tpx3_data if channel.name == 'TPX3' else \
+                self.__tpx3_sum if channel.name == 'TPX3 Sum' else None
+            if data_array is None:
+                continue
+            properties = current_frame.frame_parameters.as_dict()
+            properties["center_x_nm"] = current_frame.frame_parameters.center_nm[1]
+            properties["center_y_nm"] = current_frame.frame_parameters.center_nm[0]
+            properties["rotation_deg"] = math.degrees(current_frame.frame_parameters.rotation_rad)
+            properties["channel_id"] = channel.channel_id
+            if channel.name == 'TPX3':
+                properties["eels_dispersion"] = self.__tpx3_calib["dispersion"]
+                properties["eels_offset"] = self.__tpx3_calib["offset"]
+            data_elements.append({"data": data_array, "properties": properties})
+        return data_elements, ((tpx3_top, 0), (tpx3_bottom - tpx3_top, self.__tpx3_sum.shape[1]))
 
     #This one is called in scan_base
     def prepare_synchronized_scan(self, scan_frame_parameters: scan_base.ScanFrameParameters, *, camera_exposure_ms, **kwargs) -> None:
@@ -467,6 +773,7 @@ class Device:
                                     self.__scan_area[4], self.__scan_area[5])
         self.imagedata = numpy.empty((self.__sizez * (self.__scan_area[0]), (self.__scan_area[1])), dtype=numpy.int16)
         self.imagedata_ptr = self.imagedata.ctypes.data_as(ctypes.c_void_p)
+        self.__allocate_frames()
 
     @property
     def probe_pos(self):
@@ -538,6 +845,28 @@ class Device:
                 if value: pmts.append(counter)
             self.__instrument.warn_Scan_instrument_spim_over(self.imagedata, self.__spim_pixels, pmts)
 
+    @property
+    def averaging_frames(self):
+        """
+        Number of frames averaged (or summed) with drift correction, see DriftCorrectedAverager. Taken into account
+        when the acquisition starts. 1 disables averaging.
+        """
+        return self.__averaging_frames
+
+    @averaging_frames.setter
+    def averaging_frames(self, value):
+        self.__averaging_frames = max(1, int(value))
+
+    @property
+    def averaging_mode(self):
+        return self.__averaging_mode
+
+    @averaging_mode.setter
+    def averaging_mode(self, value):
+        assert value in DriftCorrectedAverager.MODES, f'***SCAN***: Averaging mode must be one of ' \
+                                                      f'{DriftCorrectedAverager.MODES}.'
+        self.__averaging_mode = value
+
     @property
     def set_spim_pixels(self):
         return self.__spim_pixels
@@ -548,6 +877,7 @@ class Device:
             self.__spim_pixels = value
             self.spimscan.setImageArea(self.__spim_pixels[0], self.__spim_pixels[1], self.__scan_area[2], self.__scan_area[3], self.__scan_area[4],
                                    self.__scan_area[5])
+            self.__allocate_frames()
 
     def __data_locker(self, gene, datatype, sx, sy, sz):
         sx[0] = self.__scan_area[0]
@@ -561,6 +891,12 @@ class Device:
 
     def __data_unlockerA(self, gene, newdata, imagenb, rect):
         if newdata:
+            # rect is x, y, width and height of the region written in this call.
+            top, bottom = rect[1], rect[1] + rect[3]
+            with self.__rows_lock:
+                rows = self.__new_rows.setdefault(imagenb, [top, bottom, False])
+                rows[0], rows[1] = min(rows[0], top), max(rows[1], bottom)
+                rows[2] = rows[2] or bottom >= self.__scan_area[5]
             self.__frame_number = imagenb
             self.has_data_event.set()
 
@@ -572,6 +908,7 @@ class Device:
 
 
 def run(instrument: ivg_inst.ivgInstrument):
-    scan_device = Device(instrument)
+    simul = ivg_inst.set_file.settings.get("SCAN", dict()).get("SIMULATION", 0)
+    scan_device = Device(instrument, simul)
     component_types = {"scan_device"}  # the set of component types that this component represents
     Registry.register_component(scan_device, component_types)
\ No newline at end of file
@@ -30,6 +30,8 @@ class Camera(camera_base.CameraDevice):
         self.__readout_area = (0, 0, 256, 1024)
 
         self.has_data_event = threading.Event()
+        self.spimimagedata = None
+        self.has_spim_data_event = threading.Event()
 
         assert manufacturer==4 #This tp3_camera is a demo for TimePix3. Manufacturer must be 4
         if manufacturer==4:
@@ -137,6 +139,7 @@ class Camera(camera_base.CameraDevice):
         """Start live acquisition. Required before using acquire_image."""
         if not self.__is_playing:
             self.__frame_number = 0
+            self.spimimagedata = None
             self.__is_playing = True
             logging.info('***TP3***: Starting acquisition...')
             self.camera.startFocus(None, None, None)
@@ -146,6 +149,12 @@ class Camera(camera_base.CameraDevice):
         self.__is_playing = False
         self.camera.stopFocus()
 
+    def get_spim_data(self):
+        """Return the spim frames received so far as a single array, built only when asked."""
+        if self.spimimagedata is None:
+            return None
+        return self.spimimagedata.contiguous()
+
     def acquire_image(self):
         """Acquire the most recent data."""
 
@@ -181,31 +190,33 @@ class Camera(camera_base.CameraDevice):
         The callback are basically events that tell acquire_image that a new data is available for displaying. In my case,
         message equals to 01 is equivalent to Marcel's data locker, while message equals to 02 is equivalent to spim data
         locker. Data locker (message==1) gets data from a LIFOQueue, which is a tuple in which first element is the frame
-        properties and second is the data (in bytes). You can see what is available in dict 'prop' checking either
+        properties and second is the data (in bytes). You can see what is available in 'prop' checking either
         serval manual or tp3func. create_image_from_bytes simply convert my bytes to a int8 array. A soft binning attribute
         is defined in tp3 so the idea is that image always come in the right way.
 
-        For message==2, it is exactly the same. Difference is simply dimensionality (datum and collection dimensions) and,
-        if array is complete, i double the size in order to always show more data. A personal choice to never limit data
-        arrival.
+        For message==2, it is exactly the same. Difference is simply dimensionality (datum and collection dimensions).
+        Frames go in a tp3func.SpimBlocks, so arrival is never limited.
         """
 
         def sendMessage(message):
             if message == 1:
-                prop, last_bytes_data = self.camera.get_last_data()
-                self.__frame_number = int(prop['frameNumber'])
-                self.imagedata = self.camera.create_image_from_bytes(last_bytes_data, prop['bitDepth'])
+                last = self.camera.get_last_data()
+                if last is None: return
+                prop, last_bytes_data = last
+                self.__frame_number = int(prop.frameNumber)
+                self.imagedata = self.camera.create_image_from_bytes(last_bytes_data, prop.bitDepth)
                 self.current_event.fire(
                     format(self.camera.get_current(self.imagedata, self.__frame_number), ".7f")
                 )
                 self.has_data_event.set()
             if message == 2:
-                prop, last_bytes_data = self.camera.get_last_data()
-                self.__frame_number = int(prop['frameNumber'])
-                try:
-                    self.spimimagedata[self.__frame_number] = self.camera.create_spimimage_from_bytes(last_bytes_data)
-                except IndexError:
-                    self.spimimagedata = numpy.append(self.spimimagedata, numpy.zeros(self.spimimagedata.shape), axis=0)
+                last = self.camera.get_last_image()
+                if last is None: return
+                prop, frame = last
+                self.__frame_number = int(prop.frameNumber)
+                if self.spimimagedata is None:
+                    self.spimimagedata = tp3func.SpimBlocks(frame.shape)
+                self.spimimagedata.write(self.__frame_number, frame)
                 self.has_spim_data_event.set()
             if message == 3:
                 self.imagedata = self.camera.create_image_from_events()
@@ -1,5 +1,5 @@
 import json
-import requests
+import asyncio
 import threading
 import logging
 import queue
@@ -9,21 +9,1260 @@ import struct
 import pathlib
 import os
 import select
+import time
+import urllib.parse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from nion.swift.model import HardwareSource
-#from swift_rust.target.release import rust2swift
+from nion.utils import Event
+try:
+    from swift_rust.target.release import rust2swift
+except ImportError:
+    rust2swift = None
 
 def SENDMYMESSAGEFUNC(sendmessagefunc):
     return sendmessagefunc
 
 
 class Response():
-    def __init__(self):
-        self.text = '***TP3***: This is simul mode.'
+    def __init__(self, text='***TP3***: This is simul mode.', status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+
+class ServalSession():
+    """
+    Persistent HTTP/1.1 connection to serval, used from the TimePix3 event loop. Requests are serialized by a lock and
+    the connection is opened again after any failure.
+    """
+
+    def __init__(self, url, timeout=5.0):
+        address = urllib.parse.urlsplit(url)
+        self.host = address.hostname
+        self.port = address.port or 80
+        self.timeout = timeout
+        self.__reader = None
+        self.__writer = None
+        self.__lock = None
+        self.connections = 0
+        self.requests = 0
+
+    async def request(self, method, url, data=None):
+        """
+        Sends the request to the path of url and returns a Response with the status code and the decoded body. Any
+        failure closes the connection; the request is sent again only if it failed before being written.
+        """
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        address = urllib.parse.urlsplit(url)
+        path = address.path or '/'
+        if address.query:
+            path += '?' + address.query
+        body = b'' if data is None else data.encode() if isinstance(data, str) else data
+        async with self.__lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self.__reader is not None and self.__reader.at_eof():
+                        self.__discard()  # Closed by serval while idle.
+                    if self.__writer is None:
+                        await self.__connect()
+                    sent = True
+                    self.__writer.write(f'{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+                                        f'Connection: keep-alive\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+                                        + body)
+                    await self.__writer.drain()
+                    response = await asyncio.wait_for(self.__read_response(), self.timeout)
+                    self.requests += 1
+                    return response
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    self.__discard()
+                    if attempt or sent:
+                        raise ConnectionError(f'***TP3***: Lost connection to serval: {e}.')
+                except BaseException:
+                    self.__discard()
+                    raise
+
+    def __discard(self):
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__reader = None
+        self.__writer = None
+
+    async def __connect(self):
+        self.__reader, self.__writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                              self.timeout)
+        self.connections += 1
+
+    async def __read_response(self):
+        status_line = await self.__reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by serval')
+        status_code = int(status_line.split()[1])
+        headers = dict()
+        while True:
+            line = await self.__reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                chunk_size = int((await self.__reader.readline()).split(b';')[0], 16)
+                chunk = await self.__reader.readexactly(chunk_size + 2)
+                if chunk_size == 0:
+                    break
+                body += chunk[:-2]
+        elif 'content-length' in headers:
+            body = await self.__reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.__reader.read()
+        if headers.get('connection', '').lower() == 'close' or 'content-length' not in headers and \
+                headers.get('transfer-encoding', '').lower() != 'chunked':
+            await self.close()
+        return Response(body.decode('utf-8', errors='replace'), status_code)
+
+    async def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            try:
+                await self.__writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.__reader = None
+        self.__writer = None
 
 
 SAVE_FILE = False
 
+TIME_EVENT_DTYPE = numpy.dtype([('pixel', '<u4'), ('toa', '<u8'), ('delta', '<u4')])
+TIME_EVENT_TDC = 0xffffffff  # pixel of the time-resolved records carrying a TDC (toa is the TDC time).
+TIME_RESOLVED_TIMEOUT = 5.  # s. Time to wait for the first time-resolved event.
+
+
+class FrameRingBuffer():
+    """
+    Preallocated receive buffer for the jsonimage stream. Data is received with recv_into and headers and payloads are
+    returned as memoryview slices, valid until the next call to receive. The buffer grows if a frame is bigger than its
+    size.
+    """
+
+    MAX_HEADER_SIZE = 4096
+
+    def __init__(self, size=4 * 1024 * 1024):
+        self.__buffer = bytearray(size)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0
+        self.__end = 0
+
+    @property
+    def available(self):
+        return self.__end - self.__start
+
+    def receive(self, sock):
+        """
+        Receives data from sock into the free part of the buffer. Returns the number of bytes received (0 if the
+        connection was closed).
+        """
+        nbytes = sock.recv_into(self.__free_view())
+        self.__end += nbytes
+        return nbytes
+
+    async def receive_async(self, loop, sock):
+        """
+        Same as receive, for a non-blocking sock read by the event loop.
+        """
+        nbytes = await loop.sock_recv_into(sock, self.__free_view())
+        self.__end += nbytes
+        return nbytes
+
+    def __free_view(self):
+        if self.__start == self.__end:
+            self.__start = self.__end = 0
+        elif self.__end == len(self.__buffer):
+            self.__make_room()
+        return self.__view[self.__end:]
+
+    def __make_room(self):
+        remaining = self.__end - self.__start
+        if self.__start == 0:
+            new_buffer = bytearray(2 * len(self.__buffer))
+            new_buffer[:remaining] = self.__view[:remaining]
+            self.__buffer = new_buffer
+            self.__view = memoryview(self.__buffer)
+        else:
+            self.__view[:remaining] = self.__view[self.__start:self.__end]
+        self.__start = 0
+        self.__end = remaining
+
+    def read_header(self):
+        """
+        Returns the next jsonimage header (from '{"time' up to the closing brace) and consumes it, together with the
+        newline that follows it. Returns None if no complete header is in the buffer yet.
+        """
+        begin_header = self.__buffer.find(b'{"time', self.__start, self.__end)
+        if begin_header == -1:
+            # Keeps only the bytes that could still be the beginning of a header.
+            self.__start = max(self.__start, self.__end - 5)
+            return None
+        end_header = self.__buffer.find(b'}\n', begin_header, self.__end)
+        if end_header == -1:
+            # A header longer than MAX_HEADER_SIZE is garbage: skips it so the buffer does not grow.
+            self.__start = begin_header if self.__end - begin_header < self.MAX_HEADER_SIZE else begin_header + 1
+            return None
+        self.__start = end_header + 2
+        return self.__view[begin_header:end_header + 1]
+
+    def read(self, size):
+        """
+        Returns a zero-copy view of the next size bytes and consumes them. Returns None if they are not all received.
+        """
+        if self.available < size:
+            return None
+        data = self.__view[self.__start:self.__start + size]
+        self.__start += size
+        return data
+
+    def clear(self):
+        self.__start = 0
+        self.__end = 0
+
+
+class JsonImageHeader():
+    """
+    Properties of a single jsonimage frame, as sent by serval in the frame header.
+    """
+    __slots__ = ('timeAtFrame', 'frameNumber', 'measurementID', 'dataSize', 'bitDepth', 'width', 'height')
+
+    def __init__(self):
+        self.timeAtFrame = 0.
+        self.frameNumber = 0
+        self.measurementID = None
+        self.dataSize = 0
+        self.bitDepth = 0
+        self.width = 0
+        self.height = 0
+
+    def __repr__(self):
+        return str({prop: getattr(self, prop) for prop in self.__slots__})
+
+
+class JsonImageHeaderDecoder():
+    """
+    Decodes serval jsonimage headers from bytes into JsonImageHeader records. The layout of the last header is reused
+    when only timeAtFrame and frameNumber changed. bitDepth, width and height are the expected values (None is not
+    checked); decode returns the record and whether it is valid.
+    """
+
+    def __init__(self, bitDepth=None, width=None, height=None):
+        self.__expected = (bitDepth, width, height)
+        self.__cached_tail = None
+        self.__cached_layout = None
+
+    def decode(self, header):
+        header = bytes(header)
+        first_comma = header.find(b',')
+        tail_index = header.find(b',', first_comma + 1)
+        if header.startswith(b'{"timeAtFrame"') and tail_index != -1 and self.__cached_tail is not None \
+                and header[tail_index:] == self.__cached_tail:
+            record = JsonImageHeader()
+            try:
+                record.timeAtFrame = float(header[header.find(b':') + 1:first_comma])
+                record.frameNumber = int(header[header.find(b':', first_comma) + 1:tail_index])
+            except ValueError:
+                return record, False
+            record.measurementID, record.dataSize, record.bitDepth, record.width, record.height = \
+                self.__cached_layout
+            return record, True
+
+        record = JsonImageHeader()
+        for item in header.strip(b'{}').split(b','):
+            key, _, value = item.partition(b':')
+            key = key.strip(b' "').decode('latin-1')
+            if key not in JsonImageHeader.__slots__:
+                continue
+            try:
+                value = float(value) if key == 'timeAtFrame' else int(value)
+            except ValueError:
+                value = value.strip(b' "').decode('latin-1')
+            setattr(record, key, value)
+
+        if not self.check(record):
+            self.__cached_tail = None
+            return record, False
+        self.__cached_layout = (record.measurementID, record.dataSize, record.bitDepth, record.width, record.height)
+        self.__cached_tail = header[tail_index:] if header.startswith(b'{"timeAtFrame"') else None
+        return record, True
+
+    def check(self, record):
+        if not isinstance(record.timeAtFrame, float) or not isinstance(record.frameNumber, int):
+            return False
+        if not all(isinstance(value, int) and value > 0
+                   for value in (record.dataSize, record.bitDepth, record.width, record.height)):
+            return False
+        for value, expected in zip((record.bitDepth, record.width, record.height), self.__expected):
+            if expected is not None and value != expected:
+                return False
+        return record.width * record.height * record.bitDepth // 8 == record.dataSize
+
+
+class LatestFrameSlot():
+    """
+    Double buffered slot holding only the last received frame. The network thread overwrites the back buffer and
+    increments the sequence; readers copy the front buffer and retry if the sequence changed. superseded counts frames
+    overwritten before being read and dropped counts frames rejected by the client.
+    """
+
+    def __init__(self):
+        self.__buffers = [bytearray(), bytearray()]
+        self.__sizes = [0, 0]
+        self.__properties = [None, None]
+        self.__sequence = 0
+        self.__read_sequence = 0
+        self.superseded = 0
+        self.dropped = 0
+
+    @property
+    def sequence(self):
+        return self.__sequence
+
+    @property
+    def has_new_frame(self):
+        return self.__sequence > self.__read_sequence
+
+    def write(self, properties, frame):
+        back = (self.__sequence + 1) % 2
+        size = len(frame)
+        if len(self.__buffers[back]) < size:
+            self.__buffers[back] = bytearray(size)
+        self.__buffers[back][:size] = frame
+        self.__sizes[back] = size
+        self.__properties[back] = properties
+        if self.__sequence > self.__read_sequence:
+            self.superseded += 1
+        self.__sequence += 1
+
+    def read(self, decode=None):
+        """
+        Returns the tuple (properties, data) of the last published frame, or None if nothing was published yet. Data
+        is a bytes copy, so it stays valid when the network thread writes next frames. If decode is given, data is
+        decode(properties, buffer) instead, avoiding the intermediate bytes copy.
+        """
+        while True:
+            sequence = self.__sequence
+            if sequence == 0:
+                return None
+            front = sequence % 2
+            properties = self.__properties[front]
+            buffer = memoryview(self.__buffers[front])[:self.__sizes[front]]
+            data = bytes(buffer) if decode is None else decode(properties, buffer)
+            if sequence == self.__sequence:
+                self.__read_sequence = sequence
+                return properties, data
+
+    def clear(self):
+        self.__sequence = 0
+        self.__read_sequence = 0
+        self.superseded = 0
+        self.dropped = 0
+
+
+class FrameBufferPool():
+    """
+    Recycled image arrays for the jsonimage frames, keyed by (bitDepth, width, height). An array is handed out again
+    after depth frames, so arrays that are kept (given to Swift) must be detached first.
+    """
+
+    DTYPES = {8: numpy.dtype('<u1'), 16: numpy.dtype('<u2'), 32: numpy.dtype('<u4')}
+
+    def __init__(self, depth=4):
+        self.depth = depth
+        self.__buffers = dict()
+        self.__index = dict()
+        self.__lock = threading.Lock()
+        self.allocations = 0
+
+    def get(self, bitDepth, width, height):
+        key = (bitDepth, width, height)
+        with self.__lock:
+            buffers = self.__buffers.setdefault(key, [])
+            if len(buffers) < self.depth:
+                buffers.append(numpy.empty((height, width), dtype=self.DTYPES[bitDepth]))
+                self.allocations += 1
+                return buffers[-1]
+            index = (self.__index.get(key, -1) + 1) % self.depth
+            self.__index[key] = index
+            return buffers[index]
+
+    def detach(self, array):
+        """
+        Removes array from the pool, so it is never written again and the caller owns it. Returns array.
+        """
+        with self.__lock:
+            for buffers in self.__buffers.values():
+                for index, buffer in enumerate(buffers):
+                    if buffer is array:
+                        buffers[index] = numpy.empty_like(buffer)
+                        self.allocations += 1
+                        return array
+        return array
+
+    def decode(self, frame_data, bitDepth, width, height):
+        frame_int = self.get(bitDepth, width, height)
+        source = numpy.frombuffer(frame_data, dtype=self.DTYPES[bitDepth], count=width * height)
+        numpy.copyto(frame_int.reshape(-1), source)
+        return frame_int
+
+    def clear(self):
+        with self.__lock:
+            self.__buffers = dict()
+            self.__index = dict()
+
+
+class DecodedFrame():
+    """
+    Frame produced by the FrameDecodePool. image is the (height, width) frame, spectrum its vertical sum as a (1, width)
+    uint32 array (the image itself for soft binned frames), counts the total number of electrons and current the beam
+    current in pA. Arrays are recycled by the pools, so detach them (TimePix3.take_image) if they must be kept.
+    """
+    __slots__ = ('properties', 'image', 'spectrum', 'counts', 'current')
+
+    def __init__(self, properties, image, spectrum, counts, current=0.):
+        self.properties = properties
+        self.image = image
+        self.spectrum = spectrum
+        self.counts = counts
+        self.current = current
+
+
+class FrameDecodePool():
+    """
+    Decodes jsonimage payloads in recycled arrays on a pool of threads. Each worker copies a band of rows and sums its
+    partial spectrum in the same pass. Soft binned frames are a single band.
+    """
+
+    MIN_BAND_ROWS = 16
+
+    def __init__(self, workers=2, depth=4):
+        self.workers = max(1, int(workers))
+        self.images = FrameBufferPool(depth)
+        self.spectra = FrameBufferPool(depth)
+        self.__partials = dict()
+        self.__executor = None
+        self.decoded = 0
+        self.decode_time = 0.
+
+    def decode(self, properties, frame_data):
+        start = time.perf_counter()
+        bitDepth, width, height = properties.bitDepth, properties.width, properties.height
+        image = self.images.get(bitDepth, width, height)
+        source = numpy.frombuffer(frame_data, dtype=FrameBufferPool.DTYPES[bitDepth], count=width * height)
+        source = source.reshape((height, width))
+        if height == 1:
+            numpy.copyto(image, source)
+            spectrum = image if bitDepth == 32 else image.astype(numpy.uint32)
+        else:
+            spectrum = self.spectra.get(32, width, 1)
+            bands = max(1, min(self.workers, height // self.MIN_BAND_ROWS))
+            partials = self.__partials.get((bands, width))
+            if partials is None:
+                partials = self.__partials[(bands, width)] = numpy.empty((bands, width), dtype=numpy.uint32)
+            edges = numpy.linspace(0, height, bands + 1).astype(int)
+
+            def decode_band(band):
+                rows = slice(edges[band], edges[band + 1])
+                numpy.copyto(image[rows], source[rows])
+                numpy.add.reduce(image[rows], axis=0, dtype=numpy.uint32, out=partials[band])
+
+            if bands == 1:
+                decode_band(0)
+            else:
+                if self.__executor is None:
+                    self.__executor = ThreadPoolExecutor(max_workers=self.workers - 1)
+                futures = [self.__executor.submit(decode_band, band) for band in range(1, bands)]
+                decode_band(0)
+                for future in futures:
+                    future.result()
+            numpy.add.reduce(partials, axis=0, out=spectrum[0])
+        counts = int(spectrum.sum(dtype=numpy.uint64))
+        self.decoded += 1
+        self.decode_time += time.perf_counter() - start
+        return DecodedFrame(properties, image, spectrum, counts)
+
+    def clear(self):
+        self.images.clear()
+        self.spectra.clear()
+        self.__partials = dict()
+        self.decoded = 0
+        self.decode_time = 0.
+
+    def shutdown(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+
+class ChronoBuffer():
+    """
+    Circular buffer of the last rows spectra of a Chrono acquisition. Rows are written twice, so ordered returns them in
+    time order as a view, valid until the next push. If spill_path is given, rows are appended to this file before being
+    overwritten, see read_spilled.
+    """
+
+    def __init__(self, rows, width, dtype=numpy.float32, spill_path=None):
+        self.rows = max(1, int(rows))
+        self.width = width
+        self.__data = numpy.zeros((2 * self.rows, width), dtype=dtype)
+        self.__head = 0
+        self.__lastFrame = None
+        self.count = 0
+        self.spill_path = spill_path
+        self.__spill = open(spill_path, 'ab') if spill_path is not None else None
+        self.spilled = 0
+
+    def push(self, spectrum):
+        head = self.__head
+        if self.__spill is not None and self.count >= self.rows:
+            self.__spill.write(self.__data[head].tobytes())
+            self.spilled += 1
+        self.__data[head] = spectrum
+        self.__data[head + self.rows] = spectrum
+        self.__head = (head + 1) % self.rows
+        self.count += 1
+
+    def push_frame(self, image, frame_number):
+        """
+        Pushes a Chrono frame received from the TimePix3. A single line frame is the next spectrum. A frame of several
+        lines is the chrono kept by the server, whose row frame_number % height is the newest spectrum, so only the
+        rows newer than the previous frame are pushed (at most height, older ones are lost).
+        """
+        height = image.shape[0]
+        if height == 1:
+            self.push(image[0])
+        else:
+            first = frame_number - height + 1 if self.__lastFrame is None else self.__lastFrame + 1
+            for frame in range(max(first, frame_number - height + 1, 0), frame_number + 1):
+                self.push(image[frame % height])
+        self.__lastFrame = frame_number
+
+    def ordered(self):
+        if self.count < self.rows:
+            return self.__data[:self.rows]
+        return self.__data[self.__head:self.__head + self.rows]
+
+    def last(self):
+        return self.__data[(self.__head - 1) % self.rows]
+
+    def read_spilled(self):
+        if self.__spill is not None:
+            self.__spill.flush()
+        return numpy.fromfile(self.spill_path, dtype=self.__data.dtype).reshape((-1, self.width))
+
+    def close(self):
+        if self.__spill is not None:
+            self.__spill.close()
+            self.__spill = None
+
+
+class SpimBlocks():
+    """
+    Growing sequence of frames stored in blocks of block_frames frames, so frames past the end never copy the ones
+    received. contiguous returns them as one array, built only when asked; copied_bytes counts the bytes it copied.
+    """
+
+    def __init__(self, frame_shape, dtype=numpy.float32, block_frames=1024):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = numpy.dtype(dtype)
+        self.block_frames = block_frames
+        self.__blocks = dict()
+        self.__contiguous = None
+        self.frames = 0
+        self.copied_bytes = 0
+
+    def __len__(self):
+        return self.frames
+
+    @property
+    def capacity(self):
+        return 0 if self.__contiguous is None else len(self.__contiguous)
+
+    @property
+    def nbytes(self):
+        return sum(block.nbytes for block in self.__blocks.values()) + \
+               (0 if self.__contiguous is None else self.__contiguous.nbytes)
+
+    def write(self, index, frame):
+        if index < self.capacity:
+            self.__contiguous[index] = frame
+        else:
+            block, row = divmod(index, self.block_frames)
+            if block not in self.__blocks:
+                self.__blocks[block] = numpy.zeros((self.block_frames,) + self.frame_shape, dtype=self.dtype)
+            self.__blocks[block][row] = frame
+        self.frames = max(self.frames, index + 1)
+
+    def append(self, frame):
+        self.write(self.frames, frame)
+
+    def __getitem__(self, index):
+        if index < self.capacity:
+            return self.__contiguous[index]
+        block, row = divmod(index, self.block_frames)
+        if index >= self.frames or block not in self.__blocks:
+            return numpy.zeros(self.frame_shape, dtype=self.dtype)
+        return self.__blocks[block][row]
+
+    def contiguous(self):
+        if self.__contiguous is None and self.frames <= self.block_frames and 0 in self.__blocks:
+            return self.__blocks[0][:self.frames]
+        written = self.capacity  # Frames below were written straight in the contiguous array.
+        if self.capacity < self.frames:
+            capacity = max(self.frames, 2 * self.capacity)
+            data = numpy.zeros((capacity,) + self.frame_shape, dtype=self.dtype)
+            if self.__contiguous is not None:
+                data[:self.capacity] = self.__contiguous
+                self.copied_bytes += self.__contiguous.nbytes
+            self.__contiguous = data
+        for block in sorted(self.__blocks):
+            first = block * self.block_frames
+            rows = slice(max(first, written), min(first + self.block_frames, self.frames))
+            if rows.stop > rows.start:
+                self.__contiguous[rows] = self.__blocks[block][rows.start - first:rows.stop - first]
+                self.copied_bytes += self.__contiguous[rows].nbytes
+        self.__blocks = dict()
+        return self.__contiguous[:self.frames]
+
+    def clear(self):
+        self.__blocks = dict()
+        self.__contiguous = None
+        self.frames = 0
+        self.copied_bytes = 0
+
+
+def rust_accumulate_available():
+    """
+    Whether the built rust2swift has accumulate_spim (older builds only decode events with update_spim).
+    """
+    return rust2swift is not None and hasattr(rust2swift, 'accumulate_spim')
+
+
+class SpimAccumulator():
+    """
+    Accumulates electron events (flat spim indexes) into the spim array. backend is 'unique', 'add_at', 'bincount',
+    'rust' (rust2swift.accumulate_spim, uint32 spims only, saturating, never chosen by auto) or 'auto' (add_at or
+    bincount depending on the chunk size). If coalesce is bigger than zero, chunks are kept until coalesce events are
+    pending. Call flush before reading the spim.
+    """
+    BACKENDS = ['auto', 'unique', 'add_at', 'bincount', 'rust']
+    BINCOUNT_RATIO = 16  # bincount is used if chunk has more than size / BINCOUNT_RATIO events
+
+    def __init__(self, data, backend='auto', coalesce=0):
+        assert backend in self.BACKENDS, f'***TP3***: Accumulation backend must be one of {self.BACKENDS}.'
+        if backend == 'rust' and not self.rust_available(data):
+            logging.info('***TP3***: Rust accumulation is not available. Using auto.')
+            backend = 'auto'
+        self.data = data
+        self.backend = backend
+        self.coalesce = coalesce
+        self.__pending = list()
+        self.__pending_events = 0
+
+    def accumulate(self, event_list):
+        if self.coalesce > 0:
+            self.__pending.append(event_list)
+            self.__pending_events += len(event_list)
+            if self.__pending_events >= self.coalesce:
+                self.flush()
+        else:
+            self.__accumulate(event_list)
+
+    def flush(self):
+        if self.__pending:
+            event_list = self.__pending[0] if len(self.__pending) == 1 else numpy.concatenate(self.__pending)
+            self.__pending = list()
+            self.__pending_events = 0
+            self.__accumulate(event_list)
+
+    @staticmethod
+    def rust_available(data):
+        return data.dtype == numpy.uint32 and rust_accumulate_available()
+
+    def select_backend(self, nevents):
+        if self.backend != 'auto':
+            return self.backend
+        if nevents * self.BINCOUNT_RATIO > self.data.size:
+            return 'bincount'
+        return 'add_at'
+
+    def __accumulate(self, event_list):
+        backend = self.select_backend(len(event_list))
+        if backend == 'rust':
+            events = numpy.ascontiguousarray(event_list, dtype=numpy.dtype('<u4')).view(numpy.uint8)
+            if rust2swift.accumulate_spim(events, self.data):
+                logging.info(f'***TP3***: Indexing error.')
+            return
+        if len(event_list) and event_list.max() >= self.data.size:
+            logging.info(f'***TP3***: Indexing error.')
+            event_list = event_list[event_list < self.data.size]
+        if backend == 'unique':
+            unique, counts = numpy.unique(event_list, return_counts=True)
+            self.data[unique] += counts.astype(self.data.dtype)
+        elif backend == 'add_at':
+            numpy.add.at(self.data, event_list, 1)
+        elif backend == 'bincount':
+            self.data += numpy.bincount(event_list, minlength=self.data.size).astype(self.data.dtype, copy=False)
+
+
+class AdaptiveSpimAccumulator():
+    """
+    Spim accumulator whose dtype (uint8, uint16 or uint32) is chosen per scan line. A line is promoted only when more
+    than hot_pixels of its bins would saturate; below that, extra counts go to an overflow table, so no count is lost.
+    create_array builds the cube with the widest dtype in use.
+    """
+    DTYPES = [numpy.uint8, numpy.uint16, numpy.uint32]
+    STAGING_BINS = 1 << 22
+    backend = 'adaptive'
+    coalesce = 0
+
+    def __init__(self, x_size, y_size, channels=1025, hot_pixels=16):
+        self.x_size = x_size
+        self.y_size = y_size
+        self.channels = channels
+        self.hot_pixels = hot_pixels
+        self.__line_size = x_size * channels
+        self.__lines = [numpy.zeros(self.__line_size, dtype=numpy.uint8) for _ in range(y_size)]
+        self.__overflow = [dict() for _ in range(y_size)]
+        self.__staging_lines = max(1, min(y_size, self.STAGING_BINS // self.__line_size))
+        self.__staging = numpy.zeros(self.__staging_lines * self.__line_size, dtype=numpy.uint32)
+        self.__array = None
+        self.__lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(line.nbytes for line in self.__lines)
+
+    @property
+    def line_dtypes(self):
+        return [line.dtype for line in self.__lines]
+
+    @property
+    def overflow(self):
+        return {y * self.__line_size + index: value for y, table in enumerate(self.__overflow)
+                for index, value in table.items()}
+
+    def accumulate(self, event_list):
+        event_list = event_list[event_list < self.__line_size * self.y_size]
+        if not len(event_list):
+            return
+        touched = numpy.flatnonzero(numpy.bincount(event_list // self.__line_size, minlength=self.y_size))
+        with self.__lock:
+            for first in range(touched[0], touched[-1] + 1, self.__staging_lines):
+                end = min(first + self.__staging_lines, self.y_size)
+                band = event_list
+                if first > touched[0] or end <= touched[-1]:
+                    band = event_list[(event_list >= first * self.__line_size) & (event_list < end * self.__line_size)]
+                band = band - numpy.uint32(first * self.__line_size)
+                lines = touched[(touched >= first) & (touched < end)]
+                if len(band) * SpimAccumulator.BINCOUNT_RATIO > len(lines) * self.__line_size:
+                    self.__accumulate_dense(first, lines, band)
+                else:
+                    self.__accumulate_sparse(first, band)
+
+    def __accumulate_dense(self, first, lines, band):
+        staging = self.__staging[:(lines[-1] + 1 - first) * self.__line_size]
+        SpimAccumulator(staging, 'bincount').accumulate(band)
+        staging = staging.reshape((-1, self.__line_size))
+        for y in lines:
+            staged = staging[y - first]
+            index = numpy.flatnonzero(staged)
+            self.__accumulate_line(y, index, staged[index])
+            staged[index] = 0
+
+    def __accumulate_sparse(self, first, band):
+        staging = self.__staging
+        staging[band] = numpy.arange(len(band), dtype=numpy.uint32)
+        representative = staging[band]
+        staging[band] = 0
+        counts = numpy.bincount(representative, minlength=len(band))
+        distinct = numpy.flatnonzero(counts)
+        index, counts = band[distinct], counts[distinct]
+        lines = (index // self.__line_size).astype(numpy.uint16)
+        order = numpy.argsort(lines, kind='stable')  # Radix sort of the line numbers.
+        index, counts, lines = index[order], counts[order], lines[order]
+        boundaries = numpy.flatnonzero(numpy.diff(lines)) + 1
+        for begin, end in zip(numpy.concatenate(([0], boundaries)), numpy.concatenate((boundaries, [len(lines)]))):
+            y = int(lines[begin])
+            self.__accumulate_line(first + y, index[begin:end] - numpy.uint32(y * self.__line_size), counts[begin:end])
+
+    def __accumulate_line(self, y, index, counts):
+        line = self.__lines[y]
+        overflow = self.__overflow[y]
+        counts = counts.astype(numpy.uint64)
+        new_values = line[index].astype(numpy.uint64) + counts
+        saturated = new_values > numpy.iinfo(line.dtype).max
+        while saturated.any() and line.dtype != self.DTYPES[-1] and \
+                len(overflow) + sum(1 for local_index in index[saturated].tolist() if local_index not in overflow) > \
+                self.hot_pixels:
+            line = self.__promote(y)
+            new_values = line[index].astype(numpy.uint64) + counts
+            saturated = new_values > numpy.iinfo(line.dtype).max
+        if saturated.any():
+            limit = numpy.iinfo(line.dtype).max
+            for local_index, value in zip(index[saturated].tolist(), new_values[saturated].tolist()):
+                overflow[local_index] = overflow.get(local_index, 0) + value - limit
+            new_values = numpy.minimum(new_values, limit)
+        line[index] = new_values
+
+    def __promote(self, y):
+        dtype = self.DTYPES[self.DTYPES.index(self.__lines[y].dtype.type) + 1]
+        line = self.__lines[y].astype(dtype)
+        overflow = self.__overflow[y]
+        limit = numpy.iinfo(dtype).max
+        for local_index in list(overflow.keys()):
+            value = int(line[local_index]) + overflow.pop(local_index)
+            line[local_index] = min(value, limit)
+            if value > limit:
+                overflow[local_index] = value - limit
+        self.__lines[y] = line
+        return line
+
+    def flush(self):
+        pass
+
+    def create_array(self, first=0, end=None):
+        """
+        Cube (y_size, x_size, channels) in which lines [first, end) are up to date. The other lines are the ones of the
+        previous call, unless the dtype changed or the whole cube is asked (the default): a new cube is then built.
+        """
+        end = self.y_size if end is None else min(end, self.y_size)
+        with self.__lock:
+            has_overflow = any(self.__overflow)
+            dtype = numpy.uint32 if has_overflow else max(self.line_dtypes, key=lambda dt: dt.itemsize)
+            limit = numpy.iinfo(numpy.uint32).max
+            if self.__array is None or self.__array.dtype != dtype or (first <= 0 and end == self.y_size):
+                self.__array = numpy.empty((self.y_size, self.__line_size), dtype=dtype)
+                first, end = 0, self.y_size
+            data = self.__array
+            for y in range(first, end):
+                data[y] = self.__lines[y]
+                for local_index, value in self.__overflow[y].items():
+                    data[y, local_index] = min(int(data[y, local_index]) + value, limit)
+        return data.reshape((self.y_size, self.x_size, self.channels))
+
+
+class SpimFile():
+    """
+    Spectrum image stored on disk and accessed through numpy.memmap. A HEADER_SIZE bytes JSON header (shape, dtype and
+    calibrations) is followed by the (y, x, channels) cube, so the event index is also the file index. SpimFile(path)
+    opens an existing file.
+    """
+    MAGIC = 'TP3SPIM'
+    HEADER_SIZE = 4096
+
+    def __init__(self, path, mode='r+'):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header = json.loads(f.read(self.HEADER_SIZE).decode('utf-8'))
+        assert self.header.get('magic') == self.MAGIC, f'***TP3***: {path} is not a spim file.'
+        self.shape = (self.header['y_size'], self.header['x_size'], self.header['channels'])
+        self.data = numpy.memmap(path, dtype=numpy.dtype(self.header['dtype']), mode=mode, offset=self.HEADER_SIZE,
+                                 shape=self.shape)
+
+    @classmethod
+    def create(cls, path, x_size, y_size, channels=1025, dtype=numpy.uint32, **calibration):
+        header = {'magic': cls.MAGIC, 'x_size': x_size, 'y_size': y_size, 'channels': channels,
+                  'dtype': numpy.dtype(dtype).str, 'order': 'yxe', 'created': time.time()}
+        header.update(calibration)
+        header_bytes = json.dumps(header).encode('utf-8')
+        assert len(header_bytes) <= cls.HEADER_SIZE, '***TP3***: Spim file header is too big.'
+        with open(path, 'wb') as f:
+            f.write(header_bytes.ljust(cls.HEADER_SIZE, b' '))
+            f.truncate(cls.HEADER_SIZE + x_size * y_size * channels * numpy.dtype(dtype).itemsize)
+        return cls(path)
+
+    @property
+    def flat(self):
+        return self.data.reshape(-1)
+
+    def read_lines(self, first, last):
+        return numpy.array(self.data[first:last])
+
+    def read_spectrum(self, x, y):
+        return numpy.array(self.data[y, x])
+
+    def sum_image(self, lines_per_chunk=64):
+        """
+        Total counts per pixel, computed by chunks of lines so the whole cube is never in memory.
+        """
+        image = numpy.zeros(self.shape[:2], dtype=numpy.uint64)
+        for first in range(0, self.shape[0], lines_per_chunk):
+            image[first:first + lines_per_chunk] = self.data[first:first + lines_per_chunk].sum(axis=2)
+        return image
+
+    def flush(self):
+        self.data.flush()
+
+
+class TimeResolvedHistogram():
+    """
+    Energy versus delay histogram built from time-resolved events (tp3mode 8), see TIME_EVENT_DTYPE. Events are binned
+    in bins delays of bin_width ns from offset. If keep_events is True, up to max_events events are kept so gate and
+    rebin work after the acquisition.
+    """
+
+    TICK = 1.5625  # ns
+    MAX_KEPT_EVENTS = 1 << 26
+
+    def __init__(self, bins=1000, bin_width=1.5625, offset=0., channels=1024, keep_events=False,
+                 max_events=MAX_KEPT_EVENTS):
+        self.bins = bins
+        self.bin_width = bin_width
+        self.offset = offset
+        self.channels = channels
+        self.keep_events = keep_events
+        self.max_events = max_events
+        self.data = numpy.zeros((bins, channels), dtype=numpy.uint32)
+        self.received_events = 0
+        self.__accumulator = SpimAccumulator(self.data.reshape(-1), backend='bincount')
+        self.__events = list()
+
+    @property
+    def delays(self):
+        return self.offset + self.bin_width * numpy.arange(self.bins)
+
+    def accumulate(self, events):
+        events = events[events['pixel'] != TIME_EVENT_TDC]
+        self.received_events += len(events)
+        if self.keep_events and self.received_events > self.max_events:
+            logging.info(f'***TP3***: More than {self.max_events} time-resolved events. Events are no longer kept.')
+            self.keep_events = False
+            self.__events = list()
+        if self.keep_events:
+            self.__events.append(events.copy())
+        delay_bin = numpy.floor((events['delta'] * self.TICK - self.offset) / self.bin_width).astype(numpy.int64)
+        valid = (delay_bin >= 0) & (delay_bin < self.bins)
+        channel = events['pixel'][valid] % self.channels
+        self.__accumulator.accumulate((delay_bin[valid] * self.channels + channel).astype(numpy.uint32))
+
+    def events(self):
+        if not self.__events:
+            return numpy.zeros(0, dtype=TIME_EVENT_DTYPE)
+        if len(self.__events) > 1:
+            self.__events = [numpy.concatenate(self.__events)]
+        return self.__events[0]
+
+    def gate(self, start, stop):
+        """
+        Spectrum of the histogram bins that are entirely inside [start, stop[ (ns), whether or not events are kept.
+        For a window that does not fall on bin edges, rebin the kept events first.
+        """
+        first = int(numpy.clip(numpy.ceil((start - self.offset) / self.bin_width), 0, self.bins))
+        last = int(numpy.clip(numpy.floor((stop - self.offset) / self.bin_width), 0, self.bins))
+        return self.data[first:last].sum(axis=0)
+
+    def rebin(self, bins, bin_width, offset=0.):
+        """
+        New TimeResolvedHistogram of the kept events with another delay binning.
+        """
+        assert self.keep_events, "***TP3***: Events were not kept. Rebin is not possible."
+        histogram = TimeResolvedHistogram(bins, bin_width, offset, self.channels, keep_events=False)
+        histogram.accumulate(self.events())
+        return histogram
+
+
+class CoincidenceEngine():
+    """
+    Streaming correlation of electron events with photon (TDC) timestamps. TDCs are kept sorted in a sliding window and
+    an electron is matched by a binary search within window ns, once the latest time seen minus latency is window ns
+    past it. Pairs are binned in histogram, photon minus electron time versus energy channel. Times are in ns.
+    """
+
+    def __init__(self, window=50., bins=200, channels=1024, latency=None):
+        self.window = window
+        self.bins = bins
+        self.channels = channels
+        self.latency = window if latency is None else latency
+        self.histogram = numpy.zeros((bins, channels), dtype=numpy.uint32)
+        self.correlated_spectrum = numpy.zeros(channels, dtype=numpy.uint32)
+        self.electrons = 0
+        self.photons = 0
+        self.pairs = 0
+        self.__histogramAccumulator = SpimAccumulator(self.histogram.reshape(-1), backend='bincount')
+        self.__spectrumAccumulator = SpimAccumulator(self.correlated_spectrum, backend='bincount')
+        self.__tdc = numpy.zeros(0, dtype=numpy.float64)
+        self.__pendingToa = numpy.zeros(0, dtype=numpy.float64)
+        self.__pendingChannel = numpy.zeros(0, dtype=numpy.uint32)
+        self.__watermark = -numpy.inf
+        self.__lock = threading.Lock()
+
+    @property
+    def time_histogram(self):
+        return self.histogram.sum(axis=1)
+
+    @property
+    def delays(self):
+        return -self.window + 2 * self.window / self.bins * (numpy.arange(self.bins) + 0.5)
+
+    def push_tdc(self, times):
+        times = numpy.sort(numpy.asarray(times, dtype=numpy.float64))
+        if not len(times):
+            return
+        with self.__lock:
+            self.photons += len(times)
+            if not len(self.__tdc) or times[0] >= self.__tdc[-1]:
+                self.__tdc = numpy.concatenate((self.__tdc, times))
+            else:
+                self.__tdc = numpy.sort(numpy.concatenate((self.__tdc, times)), kind='mergesort')
+            self.__watermark = max(self.__watermark, times[-1] - self.latency)
+
+    def push_electrons(self, toa, channel):
+        """
+        Adds electrons of time toa (ns) and energy channel and correlates the ones that are old enough.
+        """
+        toa = numpy.asarray(toa, dtype=numpy.float64)
+        if not len(toa):
+            return
+        with self.__lock:
+            self.electrons += len(toa)
+            self.__pendingToa = numpy.concatenate((self.__pendingToa, toa))
+            self.__pendingChannel = numpy.concatenate((self.__pendingChannel, numpy.asarray(channel, numpy.uint32)))
+            self.__watermark = max(self.__watermark, toa.max() - self.latency)
+            self.__correlate(self.__watermark - self.window)
+
+    def push_events(self, events):
+        """
+        Adds time-resolved events (TIME_EVENT_DTYPE). TDC records (pixel TIME_EVENT_TDC) go to the TDC window and the
+        others are electrons.
+        """
+        tdc = events['pixel'] == TIME_EVENT_TDC
+        self.push_tdc(events['toa'][tdc] * TimeResolvedHistogram.TICK)
+        electrons = events[~tdc]
+        self.push_electrons(electrons['toa'] * TimeResolvedHistogram.TICK, electrons['pixel'] % self.channels)
+
+    def flush(self):
+        with self.__lock:
+            self.__correlate(numpy.inf)
+
+    def __correlate(self, limit):
+        ready = self.__pendingToa <= limit
+        if not ready.any():
+            return
+        toa, channel = self.__pendingToa[ready], self.__pendingChannel[ready]
+        self.__pendingToa, self.__pendingChannel = self.__pendingToa[~ready], self.__pendingChannel[~ready]
+        tdc = self.__tdc
+        pair_indexes, correlated = self.__match(tdc, toa, channel)
+        self.pairs += len(pair_indexes)
+        self.__histogramAccumulator.accumulate(pair_indexes)
+        self.__spectrumAccumulator.accumulate(correlated)
+        oldest = self.__pendingToa.min() if len(self.__pendingToa) else limit
+        self.__tdc = tdc[numpy.searchsorted(tdc, min(oldest, self.__watermark) - self.window):]
+
+    def __match(self, tdc, toa, channel):
+        first = numpy.searchsorted(tdc, toa - self.window, 'left')
+        last = numpy.searchsorted(tdc, toa + self.window, 'right')
+        counts = last - first
+        matched = counts > 0
+        total = int(counts.sum())
+        starts = numpy.repeat(first[matched], counts[matched])
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts[matched]) - counts[matched], counts[matched])
+        delay = tdc[starts + offsets] - numpy.repeat(toa[matched], counts[matched])
+        delay_bin = ((delay + self.window) * (self.bins / (2 * self.window))).astype(numpy.int64)
+        numpy.clip(delay_bin, 0, self.bins - 1, out=delay_bin)
+        pair_indexes = (delay_bin * self.channels + numpy.repeat(channel[matched], counts[matched])).astype(numpy.uint32)
+        return pair_indexes, channel[matched].astype(numpy.uint32)
+
+
+class SpimEventPipeline():
+    """
+    Producer/consumer pipeline for the event stream of StartSpimFromScan. receive fills one of queue_depth preallocated
+    buffers and workers threads accumulate them, each in its own uint32 shard when there is more than one; reduce adds
+    the shards to the spim, saturating. metrics returns the backpressure counters. If a SpimLineTracker is given, every
+    buffer is also added to it.
+    """
+
+    ALIGNMENT = 32
+    SHARD_MEMORY = 2 * 1024 ** 3
+    REDUCE_CHUNK = 1 << 22  # Bins added at once by reduce, to bound its temporary arrays.
+
+    def __init__(self, accumulator, workers=1, queue_depth=64, buffer_size=2 * 64000, tracker=None):
+        self.__accumulator = accumulator
+        self.__tracker = tracker
+        self.__buffer_size = buffer_size - buffer_size % self.ALIGNMENT
+        self.__buffers = [bytearray(self.__buffer_size) for _ in range(queue_depth)]
+        self.__free = queue.Queue()
+        self.__work = queue.Queue()
+        for index in range(queue_depth):
+            self.__free.put(index)
+
+        if workers > 1 and isinstance(accumulator, SpimAccumulator):
+            max_workers = max(1, self.SHARD_MEMORY // (accumulator.data.size * numpy.dtype(numpy.uint32).itemsize))
+            if workers > max_workers:
+                logging.info(f'***TP3***: {workers} workers would need more than {self.SHARD_MEMORY / 1e9:.1f} GB of '
+                             f'shards. Using {max_workers}.')
+                workers = max_workers
+        if workers > 1 and isinstance(accumulator, SpimAccumulator):
+            self.__shards = [SpimAccumulator(numpy.zeros(accumulator.data.size, dtype=numpy.uint32),
+                                             accumulator.backend, accumulator.coalesce) for _ in range(workers)]
+        else:
+            self.__shards = [accumulator]
+        self.__locks = [threading.Lock() for _ in self.__shards]
+        self.__reduce_lock = threading.Lock()
+
+        self.__received_bytes = 0
+        self.__processed_buffers = 0
+        self.__saturated_bins = 0
+        self.__metrics_lock = threading.Lock()
+        self.__reader_waits = 0
+        self.__reader_wait_time = 0.
+        self.__max_queued = 0
+
+        self.__threads = [threading.Thread(target=self.__worker, args=(index,), daemon=True)
+                          for index in range(len(self.__shards))]
+        for thread in self.__threads:
+            thread.start()
+
+    def receive(self, sock):
+        """
+        Receives up to a buffer of events from sock, always a multiple of ALIGNMENT bytes, and queues it. Returns the
+        number of bytes received (0 if the connection was closed).
+        """
+        try:
+            index = self.__free.get_nowait()
+        except queue.Empty:
+            self.__reader_waits += 1
+            start = time.perf_counter()
+            index = self.__free.get()
+            self.__reader_wait_time += time.perf_counter() - start
+        view = memoryview(self.__buffers[index])
+        nbytes = sock.recv_into(view)
+        while nbytes % self.ALIGNMENT:
+            missing = sock.recv_into(view[nbytes:], self.ALIGNMENT - nbytes % self.ALIGNMENT)
+            if missing == 0: break
+            nbytes += missing
+        if nbytes == 0:
+            self.__free.put(index)
+            return 0
+        self.__received_bytes += nbytes
+        self.__work.put((index, nbytes - nbytes % self.ALIGNMENT))
+        self.__max_queued = max(self.__max_queued, self.__work.qsize())
+        return nbytes
+
+    def __worker(self, shard_index):
+        dt = numpy.dtype(numpy.uint32).newbyteorder('<')
+        shard = self.__shards[shard_index]
+        while True:
+            item = self.__work.get()
+            if item is None:
+                return
+            index, nbytes = item
+            event_list = numpy.frombuffer(self.__buffers[index], dtype=dt, count=nbytes // dt.itemsize)
+            with self.__locks[shard_index]:
+                try:
+                    shard.accumulate(event_list.copy() if shard.coalesce else event_list)
+                except (ValueError, IndexError) as e:
+                    logging.info(f'***TP3***: Error accumulating events: {e}.')
+            if self.__tracker is not None:
+                self.__tracker.add(event_list)
+            with self.__metrics_lock:
+                self.__processed_buffers += 1
+            self.__free.put(index)
+
+    def reduce(self, start=0, stop=None):
+        """
+        Adds the partial histograms of the workers to the spim, only in bins [start, stop) if given. Can be called
+        during the acquisition. Workers accumulate events before reporting their lines to the tracker, so reducing the
+        lines given by SpimLineTracker.take_lines misses no count.
+        """
+        if self.__shards[0] is self.__accumulator:
+            return
+        data = self.__accumulator.data
+        stop = data.size if stop is None else min(stop, data.size)
+        limit = numpy.iinfo(data.dtype).max
+        for shard, lock in zip(self.__shards, self.__locks):
+            with self.__reduce_lock, lock:
+                shard.flush()
+                for begin in range(start, stop, self.REDUCE_CHUNK):
+                    end = min(begin + self.REDUCE_CHUNK, stop)
+                    counts = shard.data[begin:end]
+                    if limit < numpy.iinfo(counts.dtype).max:
+                        room = limit - data[begin:end]
+                        saturated = int(numpy.count_nonzero(counts > room))
+                        if saturated:
+                            self.__saturated_bins += saturated
+                            numpy.minimum(counts, room, out=counts)
+                    numpy.add(data[begin:end], counts, out=data[begin:end], casting='unsafe')
+                    counts[:] = 0
+
+    def stop(self):
+        """
+        Waits until all queued buffers are accumulated, stops the workers and reduces the shards.
+        """
+        for _ in self.__threads:
+            self.__work.put(None)
+        for thread in self.__threads:
+            thread.join()
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                shard.flush()
+        self.reduce()
+
+    @property
+    def metrics(self):
+        return {"received_bytes": self.__received_bytes, "processed_buffers": self.__processed_buffers,
+                "saturated_bins": self.__saturated_bins,
+                "queued_buffers": self.__work.qsize(), "max_queued_buffers": self.__max_queued,
+                "reader_waits": self.__reader_waits, "reader_wait_time": self.__reader_wait_time}
+
+
+class SpimLineTracker():
+    """
+    Follows a spim while it is accumulated: which lines received events and the total counts of each pixel (the summed
+    image). take_lines gives the lines that received events since its last call, so only these lines of the cube have
+    to be displayed again, and summed_image is kept up to date without reading the cube.
+    """
+    BINCOUNT_RATIO = 16  # bincount is used if there are more than size / BINCOUNT_RATIO events, otherwise unique.
+
+    def __init__(self, x_size, y_size, channels=1025):
+        self.x_size = x_size
+        self.y_size = y_size
+        self.channels = channels
+        self.summed = numpy.zeros(x_size * y_size, dtype=numpy.uint32)
+        self.__lines = numpy.zeros(y_size, dtype=bool)
+        self.__lock = threading.Lock()
+
+    def add(self, event_list):
+        pixels = event_list // self.channels
+        pixels = pixels[pixels < self.summed.size]
+        if len(pixels) * self.BINCOUNT_RATIO > self.summed.size:
+            counts = numpy.bincount(pixels, minlength=self.summed.size).astype(numpy.uint32, copy=False)
+            with self.__lock:
+                self.summed += counts
+                self.__lines[:] |= counts.reshape((self.y_size, self.x_size)).any(axis=1)
+        else:
+            unique, counts = numpy.unique(pixels, return_counts=True)
+            with self.__lock:
+                self.summed[unique] += counts.astype(numpy.uint32)
+                self.__lines[unique // self.x_size] = True
+
+    def take_lines(self):
+        """
+        First line and end line (excluded) of the lines that received events since the last call. (0, 0) if none did.
+        """
+        with self.__lock:
+            lines = numpy.flatnonzero(self.__lines)
+            self.__lines[:] = False
+        return (int(lines[0]), int(lines[-1]) + 1) if len(lines) else (0, 0)
+
+    @property
+    def summed_image(self):
+        """
+        Copy of the summed counts, (y, x), taken under the lock so it is not changed by the accumulation.
+        """
+        with self.__lock:
+            return self.summed.reshape((self.y_size, self.x_size)).copy()
+
 
 class TimePix3():
 
@@ -36,9 +1275,31 @@ class TimePix3():
         self.success = False
         self.__serverURL = url
         self.__camIP = url[fst_string+7:sec_string]
-        self.__dataQueue = queue.LifoQueue()
+        self.__frameSlot = LatestFrameSlot()
+        self.__decodePool = FrameDecodePool()
+        self.__decodedFrame = None
+        self.__decodedSequence = 0
+        self.__readSequence = 0
+        self.__decodeScheduled = False
+        self.__decodeLock = threading.Lock()
+        self.__chrono = None
+        self.__chronoFolder = None
         self.__eventQueue = queue.Queue()
         self.__spimData = None
+        self.__spimAccumulator = None
+        self.__spimBackend = 'auto'
+        self.__spimCoalesce = 0
+        self.__spimPipeline = None
+        self.__spimLines = None
+        self.__spimWorkers = 1
+        self.__spimAdaptive = False
+        self.__spimFolder = None
+        self.__spimFile = None
+        self.__spimQueueDepth = 64
+        self.__timeHistogram = None
+        self.__timeKeepEvents = False
+        self.__coincidence = None
+        self.__coincidenceSettings = None
         self.__isPlaying = False
         self.__softBinning = False
         self.__isCumul = False
@@ -54,6 +1315,22 @@ class TimePix3():
         self.__simul = simul
         self.__isReady = threading.Event()
         self.sendmessage = message
+        self.__session = ServalSession(url)
+        self.__clientTask = None
+        self.__clientThread = None
+        self.__status = None
+        self.__statusTime = 0.
+        self.__statusTTL = 0.2
+        self.__pollerStatusTTL = None  # TTL set before the poller started, restored when it stops.
+        self.__statusChanged = None
+        self.__statusPoller = None
+        self.status_changed_event = Event.Event()
+        self.__notifications = queue.Queue()
+        self.__notifierThread = threading.Thread(target=self.__notify_loop, daemon=True)
+        self.__notifierThread.start()
+        self.__loop = asyncio.new_event_loop()
+        self.__loopThread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__loopThread.start()
 
         if not simul:
             try:
@@ -75,18 +1352,73 @@ class TimePix3():
                 logging.info('***TP3***: Problem initializing Timepix3. Cannot load files.')
         else:
             logging.info('***TP3***: Timepix3 in simulation mode.')
+            from ..virtual_instruments import tp3_vi
+            self.__dataServer = tp3_vi.Tp3DataServer()
+            try:
+                self.__dataServer.start()
+            except OSError:
+                logging.info('***TP3***: Port 8088 is already in use. Simulated data comes from the existing server.')
+
+    def run_coroutine(self, coroutine):
+        """
+        Runs coroutine in the TimePix3 event loop thread and waits for its result. Synchronous methods are thin wrappers
+        of their coroutine versions using this function, so calling them from the event loop raises RuntimeError.
+        """
+        if threading.current_thread() is self.__loopThread:
+            coroutine.close()
+            raise RuntimeError('***TP3***: Synchronous call from the TimePix3 event loop. Await the coroutine instead.')
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    async def run_blocking(self, function, *args):
+        """
+        Runs a blocking call (scan hardware, Swift) in the default executor, so the event loop is not held by it.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+    def notify(self, function, *args):
+        """
+        Calls function(*args) in the notifier thread, in order. Used for sendmessage and status_changed_event from the
+        event loop, as listeners may call the synchronous methods.
+        """
+        self.__notifications.put((function, args))
+
+    def __notify_loop(self):
+        while True:
+            function, args = self.__notifications.get()
+            try:
+                function(*args)
+            except Exception:
+                logging.exception('***TP3***: Notification failed.')
+
+    def set_tdc_lines(self, lines, failure):
+        """
+        Calls the orsay scan SetTdcLine for each (args, kwargs) of lines. failure is logged if there is no scan.
+        """
+        try:
+            scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
+                "orsay_scan_device")
+            for args, kwargs in lines:
+                scanInstrument.scan_device.orsayscan.SetTdcLine(*args, **kwargs)
+        except AttributeError:
+            logging.info(failure)
 
     def request_get(self, url):
+        return self.run_coroutine(self.request_get_async(url))
+
+    def request_put(self, url, data):
+        return self.run_coroutine(self.request_put_async(url, data))
+
+    async def request_get_async(self, url):
         if not self.__simul:
-            resp = requests.get(url=url)
+            resp = await self.__session.request('GET', url)
             return resp
         else:
             resp = Response()
             return resp
 
-    def request_put(self, url, data):
+    async def request_put_async(self, url, data):
         if not self.__simul:
-            resp = requests.put(url=url, data=data)
+            resp = await self.__session.request('PUT', url, data)
             return resp
         else:
             resp = Response()
@@ -98,7 +1430,7 @@ class TimePix3():
         """
         try:
             resp = self.request_get(url=self.__serverURL)
-        except requests.exceptions.RequestException as e:  # Exceptions handling example
+        except (OSError, asyncio.TimeoutError) as e:  # Exceptions handling example
             return -1
         status_code = resp.status_code
         return status_code
@@ -312,28 +1644,28 @@ class TimePix3():
         pass
 
     def startFocus(self, exposure, displaymode, accumulate):
+        return self.run_coroutine(self.startFocusAsync(exposure, displaymode, accumulate))
+
+    async def startFocusAsync(self, exposure, displaymode, accumulate):
         """
         Start acquisition. Displaymode can be '1d' or '2d' and regulates the global attribute self.__softBinning.
         accumulate is 1 if Cumul and 0 if Focus. You use it to chose to which port the client will be listening on.
         Message=1 because it is the normal data_locker.
         """
         #if not self.__simul:
-        try:
-            scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                "orsay_scan_device")
-            scanInstrument.scan_device.orsayscan.SetTdcLine(1, 7, 0, period=exposure)
-            scanInstrument.scan_device.orsayscan.SetTdcLine(0, 2, 13)  # Copy Line 05
-            # scanInstrument.scan_device.orsayscan.SetTdcLine(0, 2, 3, period=0.000050, on_time=0.000045) # Copy Line 05
-        except AttributeError:
-            logging.info("***TP3***: Cannot find orsay scan hardware. Tdc is not properly setted.")
+        await self.run_blocking(self.set_tdc_lines, [((1, 7, 0), {'period': exposure}),
+                                                     ((0, 2, 13), {})],  # Copy Line 05
+                                "***TP3***: Cannot find orsay scan hardware. Tdc is not properly setted.")
+        # SetTdcLine(0, 2, 3, period=0.000050, on_time=0.000045) # Copy Line 05
         port = 8088
         self.__softBinning = True if displaymode == '1d' else False
         message = 1
         self.__isCumul = bool(accumulate)
-        if self.getCCDStatus() == "DA_RECORDING":
-            self.stopFocus()
-        if self.getCCDStatus() == "DA_IDLE" and (self.__tp3mode == 0 or self.__tp3mode == 1):
-            resp = self.request_get(url=self.__serverURL + '/measurement/start')
+        if await self.getCCDStatusAsync() == "DA_RECORDING":
+            await self.stopFocusAsync()
+        if await self.getCCDStatusAsync() == "DA_IDLE" and (self.__tp3mode == 0 or self.__tp3mode == 1):
+            resp = await self.request_get_async(url=self.__serverURL + '/measurement/start')
+            self.invalidate_status()
             data = resp.text
             self.start_listening(port, message=message)
             return True
@@ -341,20 +1673,19 @@ class TimePix3():
             logging.info('***TP3***: Check if experiment type matches mode selection.')
 
     def startChrono(self, exposure, displaymode, mode):
+        return self.run_coroutine(self.startChronoAsync(exposure, displaymode, mode))
+
+    async def startChronoAsync(self, exposure, displaymode, mode):
         """
         Start acquisition. Displaymode can be '1d' or '2d' and regulates the global attribute self.__softBinning.
         accumulate is 1 if Cumul and 0 if Focus. You use it to chose to which port the client will be listening on.
         Message=1 because it is the normal data_locker.
         """
         #if not self.__simul:
-        try:
-            scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                "orsay_scan_device")
-            scanInstrument.scan_device.orsayscan.SetTdcLine(1, 7, 0, period=exposure)
-            scanInstrument.scan_device.orsayscan.SetTdcLine(0, 2, 13)  # Copy Line 05
-            # scanInstrument.scan_device.orsayscan.SetTdcLine(0, 2, 3, period=0.000050, on_time=0.000045) # Copy Line 05
-        except AttributeError:
-            logging.info("***TP3***: Cannot find orsay scan hardware. Tdc is not properly setted.")
+        await self.run_blocking(self.set_tdc_lines, [((1, 7, 0), {'period': exposure}),
+                                                     ((0, 2, 13), {})],  # Copy Line 05
+                                "***TP3***: Cannot find orsay scan hardware. Tdc is not properly setted.")
+        # SetTdcLine(0, 2, 3, period=0.000050, on_time=0.000045) # Copy Line 05
         port = 8088
         self.__softBinning = True if displaymode == '1d' else False
         message = 3
@@ -365,16 +1696,85 @@ class TimePix3():
         else:
             logging.info('***TP3***: No Chrono mode detected.')
             return
-        if self.getCCDStatus() == "DA_RECORDING":
-            self.stopFocus()
-        if self.getCCDStatus() == "DA_IDLE":
-            resp = self.request_get(url=self.__serverURL + '/measurement/start')
+        self.create_chrono_buffer()
+        if await self.getCCDStatusAsync() == "DA_RECORDING":
+            await self.stopFocusAsync()
+        if await self.getCCDStatusAsync() == "DA_IDLE":
+            resp = await self.request_get_async(url=self.__serverURL + '/measurement/start')
+            self.invalidate_status()
             data = resp.text
             self.start_listening(port, message=message)
             return True
         else:
             logging.info('***TP3***: Check if experiment type matches mode selection.')
 
+    def startTimeResolved(self, exposure, displaymode, bins):
+        return self.run_coroutine(self.startTimeResolvedAsync(exposure, displaymode, bins))
+
+    async def startTimeResolvedAsync(self, exposure, displaymode, bins):
+        """
+        Start a time-resolved acquisition (tp3mode 8), binned in a TimeResolvedHistogram of bins delays from delay to
+        delay + width ns (one ToA tick per bin if width is zero). Message=4. Raises ConnectionError if the data server
+        does not send time-resolved events.
+        """
+        await self.run_blocking(self.set_tdc_lines, [((1, 7, 0), {'period': exposure}),
+                                                     ((0, 2, 13), {})],  # Copy Line 05
+                                "***TP3***: Cannot find orsay scan hardware. Tdc is not properly setted.")
+        port = 8088
+        self.__softBinning = True if displaymode == '1d' else False
+        message = 4
+        self.__isCumul = False
+        self.__tp3mode = 8
+        bin_width = self.__width / bins if self.__width else TimeResolvedHistogram.TICK
+        self.__timeHistogram = TimeResolvedHistogram(bins, bin_width, float(self.__delay),
+                                                     keep_events=self.__timeKeepEvents)
+        if self.__coincidenceSettings is not None:
+            window, coincidence_bins = self.__coincidenceSettings
+            self.__coincidence = CoincidenceEngine(window, coincidence_bins)
+        else:
+            self.__coincidence = None
+        if await self.getCCDStatusAsync() == "DA_RECORDING":
+            await self.stopFocusAsync()
+        if await self.getCCDStatusAsync() == "DA_IDLE":
+            client = await self.connect_time_resolved_client(port)
+            resp = await self.request_get_async(url=self.__serverURL + '/measurement/start')
+            self.invalidate_status()
+            try:
+                buffer, filled = await self.receive_first_time_events(client)
+            except ConnectionError:
+                client.close()
+                await self.stopFocusAsync()
+                raise
+            self.__isPlaying = True
+            self.__clientTask = self.__loop.create_task(self.acquire_time_resolved_events(client, message, buffer,
+                                                                                          filled))
+            return True
+        else:
+            logging.info('***TP3***: Check if experiment type matches mode selection.')
+
+    def setTimeResolvedKeepEvents(self, keep):
+        """
+        If True, time-resolved events are kept so the acquisition can be gated or rebinned afterwards. Memory grows by
+        16 bytes per event, up to TimeResolvedHistogram.MAX_KEPT_EVENTS.
+        """
+        self.__timeKeepEvents = bool(keep)
+
+    def setCoincidence(self, window=0., bins=200):
+        """
+        If window (ns) is not zero, time-resolved events are also correlated with the TDC times by a CoincidenceEngine,
+        created at each time-resolved start.
+        """
+        self.__coincidenceSettings = (window, bins) if window else None
+
+    def get_coincidence_engine(self):
+        return self.__coincidence
+
+    def get_time_resolved_histogram(self):
+        return self.__timeHistogram
+
+    def get_time_resolved_image(self):
+        return self.__timeHistogram.data.copy()
+
     def startSpim(self, nbspectra, nbspectraperpixel, dwelltime, is2D):
         """
         Similar to startFocus. Just to be consistent with VGCameraYves. Message=02 because of spim.
@@ -383,46 +1783,46 @@ class TimePix3():
         return
 
     def StartSpimFromScan(self):
+        return self.run_coroutine(self.StartSpimFromScanAsync())
+
+    async def StartSpimFromScanAsync(self):
         """
          This function must be called when you want to have a SPIM as a Scan Channel.
          """
         self.__isReady.clear()
-        try:
-            scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                "orsay_scan_device")
-            scanInstrument.scan_device.orsayscan.SetTdcLine(1, 2, 7)  # Copy Line Start
-            scanInstrument.scan_device.orsayscan.SetTdcLine(0, 2, 13)  # Copy line 05
-        except AttributeError:
-            logging.info("***TP3***: Could not set TDC to spim acquisition.")
+        await self.run_blocking(self.set_tdc_lines, [((1, 2, 7), {}),  # Copy Line Start
+                                                     ((0, 2, 13), {})],  # Copy line 05
+                                "***TP3***: Could not set TDC to spim acquisition.")
         port = 8088
         self.__softBinning = True
         message = 2
         self.__isCumul = False
-        if self.getCCDStatus() == "DA_RECORDING":
-            self.stopFocus()
+        status = await self.getCCDStatusAsync()
+        if status == "DA_RECORDING":
+            await self.stopFocusAsync()
             logging.info("***TPX3***: Please turn off TPX3 from camera panel. Trying to do it for you...")
-        elif self.getCCDStatus() == "DA_IDLE":
-            resp = self.request_get(url=self.__serverURL + '/measurement/start')
+        elif status == "DA_IDLE":
+            resp = await self.request_get_async(url=self.__serverURL + '/measurement/start')
+            self.invalidate_status()
             data = resp.text
             self.start_listening_from_scan(port, message=message)
             return True
 
     def stopFocus(self):
+        return self.run_coroutine(self.stopFocusAsync())
+
+    async def stopFocusAsync(self):
         """
-        Stop acquisition. Finish listening put global isPlaying to False and wait client thread to finish properly using
-        .join() method. Also replaces the old Queue with a new one with no itens on it (so next one won't use old data).
+        Stop acquisition. Finish listening put global isPlaying to False and wait the client task (or thread) to finish.
+        Also clears the frame slot (so next one won't use old data).
         """
-        try:
-            scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                "orsay_scan_device")
-            scanInstrument.scan_device.orsayscan.SetTdcLine(1, 0, 0)
-            scanInstrument.scan_device.orsayscan.SetTdcLine(0, 0, 0)
-        except AttributeError:
-            logging.info("***TP3***: Cannot find orsay scan hardware. Tdc is not properly turned down.")
-        status = self.getCCDStatus()
-        resp = self.request_get(url=self.__serverURL + '/measurement/stop')
+        await self.run_blocking(self.set_tdc_lines, [((1, 0, 0), {}), ((0, 0, 0), {})],
+                                "***TP3***: Cannot find orsay scan hardware. Tdc is not properly turned down.")
+        resp = await self.request_get_async(url=self.__serverURL + '/measurement/stop')
         data = resp.text
-        self.finish_listening()
+        self.invalidate_status()
+        await self.finish_listening_async()
+        await self.wait_status_async("DA_IDLE")
 
     def stopSpim(self, immediate):
         """
@@ -446,6 +1846,12 @@ class TimePix3():
     def isCameraThere(self):
         return True
 
+    def isTimeResolvedAvailable(self):
+        """
+        Time-resolved acquisitions need tp3mode 8 in the data server, which only the simulated one implements.
+        """
+        return self.__simul
+
     def getTemperature(self):
         pass
 
@@ -502,6 +1908,55 @@ class TimePix3():
     def setTp3Mode(self, mode):
         self.__tp3mode = mode
 
+    def setSpimAccumulation(self, backend='auto', coalesce=0):
+        """
+        Sets the SpimAccumulator backend and the number of events coalesced before accumulating. Used in the next spim.
+        """
+        assert backend in SpimAccumulator.BACKENDS
+        self.__spimBackend = backend
+        self.__spimCoalesce = coalesce
+
+    def setSpimAdaptiveDtype(self, adaptive):
+        """
+        If True, the next spim is accumulated in an AdaptiveSpimAccumulator instead of a fixed dtype array.
+        """
+        self.__spimAdaptive = bool(adaptive)
+
+    def setSpimFile(self, folder):
+        """
+        If folder is not None, the next spims are accumulated in a memory-mapped SpimFile created in this folder.
+        """
+        self.__spimFolder = folder
+
+    def get_spim_file(self):
+        return self.__spimFile
+
+    def setSpimPipeline(self, workers=1, queue_depth=64):
+        """
+        Sets the number of accumulation threads and of receiving buffers of the SpimEventPipeline. Used in the next spim.
+        """
+        self.__spimWorkers = max(1, int(workers))
+        self.__spimQueueDepth = max(1, int(queue_depth))
+
+    def get_spim_metrics(self):
+        if self.__spimPipeline is not None:
+            return self.__spimPipeline.metrics
+
+    def take_spim_lines(self):
+        """
+        First and end spim lines that received events since the last call. (0, 0) if none did.
+        """
+        if self.__spimLines is None:
+            return 0, 0
+        return self.__spimLines.take_lines()
+
+    def get_spim_summed_image(self):
+        """
+        Copy of the total counts of each spim pixel, (y, x), kept up to date while the events are accumulated.
+        """
+        if self.__spimLines is not None:
+            return self.__spimLines.summed_image
+
     def getNumofSpeeds(self, cameraport):
         pass
 
@@ -552,6 +2007,9 @@ class TimePix3():
         pass
 
     def getCCDStatus(self) -> dict():
+        return self.run_coroutine(self.getCCDStatusAsync())
+
+    async def getCCDStatusAsync(self) -> dict():
         '''
         Returns
         -------
@@ -561,16 +2019,92 @@ class TimePix3():
         -----
         DA_IDLE is idle. DA_PREPARING is busy to setup recording. DA_RECORDING is busy recording
         and output data to destinations. DA_STOPPING is busy to stop the recording process
+
+        The status is cached for the status TTL, see setStatusTTL.
         '''
+        if self.__status is not None and time.monotonic() - self.__statusTime < self.__statusTTL:
+            return self.__status
         if not self.__simul:
-            dashboard = json.loads(self.request_get(url=self.__serverURL + '/dashboard').text)
+            dashboard = json.loads((await self.request_get_async(url=self.__serverURL + '/dashboard')).text)
             if dashboard["Measurement"] is None:
-                return "DA_IDLE"
+                value = "DA_IDLE"
             else:
-                return dashboard["Measurement"]["Status"]
+                value = dashboard["Measurement"]["Status"]
         else:
             value = "DA_RECORDING" if self.__isPlaying else "DA_IDLE"
-            return value
+        self.__publish_status(value)
+        return value
+
+    def __publish_status(self, status):
+        self.__statusTime = time.monotonic()
+        if status != self.__status:
+            old_status = self.__status
+            self.__status = status
+            if self.__statusChanged is not None:
+                self.__statusChanged.set()
+            self.notify(self.status_changed_event.fire, old_status, status)
+
+    def invalidate_status(self):
+        """
+        Forces the next getCCDStatus to ask serval. Called after measurement start and stop.
+        """
+        self.__statusTime = 0.
+
+    def setStatusTTL(self, ttl):
+        """
+        Sets for how long (in seconds) the serval status is cached. Zero disables the cache.
+        """
+        self.__statusTTL = max(0., ttl)
+
+    async def wait_status_async(self, statuses, timeout=5.0):
+        """
+        Waits until the measurement status is one of statuses. Status transitions wake up this coroutine; without
+        them, status is requested once per status TTL. Returns False after timeout.
+        """
+        if isinstance(statuses, str):
+            statuses = (statuses,)
+        if self.__statusChanged is None:
+            self.__statusChanged = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            self.__statusChanged.clear()
+            if await self.getCCDStatusAsync() in statuses:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logging.info(f'***TP3***: Timeout waiting for status {statuses}. Status is {self.__status}.')
+                return False
+            try:
+                await asyncio.wait_for(self.__statusChanged.wait(), min(remaining, max(self.__statusTTL, 0.01)))
+            except asyncio.TimeoutError:
+                pass
+
+    def startStatusPoller(self, period=0.5):
+        """
+        Starts a task requesting the dashboard every period (in seconds). Status transitions are published in
+        status_changed_event with the old and new status, and the cached status is always fresh. While it runs, the
+        status TTL is at least 2 * period; stopStatusPoller sets it back.
+        """
+        self.stopStatusPoller()
+        self.__pollerStatusTTL = self.__statusTTL
+        self.setStatusTTL(max(self.__statusTTL, 2 * period))
+        self.__statusPoller = asyncio.run_coroutine_threadsafe(self.__poll_status(period), self.__loop)
+
+    def stopStatusPoller(self):
+        if self.__statusPoller is not None:
+            self.__statusPoller.cancel()
+            self.__statusPoller = None
+            self.setStatusTTL(self.__pollerStatusTTL)
+
+    async def __poll_status(self, period):
+        while True:
+            self.invalidate_status()
+            try:
+                await self.getCCDStatusAsync()
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.info(f'***TP3***: Could not poll serval status: {e}.')
+            await asyncio.sleep(period)
 
     def getReadoutSpeed(self):
         pass
@@ -626,11 +2160,10 @@ class TimePix3():
 
     def start_listening(self, port=8088, message=1):
         """
-        Starts the client Thread and sets isPlaying to True.
+        Starts the client task in the event loop and sets isPlaying to True. Must be called from the event loop.
         """
         self.__isPlaying = True
-        self.__clientThread = threading.Thread(target=self.acquire_streamed_frame, args=(port, message,))
-        self.__clientThread.start()
+        self.__clientTask = self.__loop.create_task(self.acquire_streamed_frame(port, message))
 
     def start_listening_from_scan(self, port=8088, message=1):
         """
@@ -642,68 +2175,39 @@ class TimePix3():
 
 
     def finish_listening(self):
+        self.run_coroutine(self.finish_listening_async())
+
+    async def finish_listening_async(self):
         """
-        .join() the client Thread, puts isPlaying to false and replaces old queue to a new one with no itens on it.
+        Cancels the client task (or .join() the spim client Thread), puts isPlaying to false and clears the frame slot
+        and the event queue.
         """
         if self.__isPlaying:
             self.__isPlaying = False
-            self.__clientThread.join()
-            logging.info(f'***TP3***: Stopping acquisition. There was {self.__dataQueue.qsize()} items in the Queue.')
+            if self.__clientTask is not None:
+                self.__clientTask.cancel()
+                await asyncio.gather(self.__clientTask, return_exceptions=True)
+                self.__clientTask = None
+            if self.__clientThread is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self.__clientThread.join)
+                self.__clientThread = None
+            logging.info(f'***TP3***: Stopping acquisition. {self.__frameSlot.sequence} frames were received, '
+                         f'{self.__frameSlot.superseded} were superseded and {self.__frameSlot.dropped} dropped.')
             logging.info(
                 f'***TP3***: Stopping acquisition. There was {self.__eventQueue.qsize()} electron events in the Queue.')
-            self.__dataQueue = queue.LifoQueue()
+            self.__frameSlot.clear()
+            self.__decodePool.clear()
+            if self.__chrono is not None:
+                self.__chrono.close()
+            self.__decodedFrame = None
+            self.__decodedSequence = self.__readSequence = 0
             self.__eventQueue = queue.Queue()
 
     def create_config_bytes(self):
-        pass
-
-    def acquire_streamed_frame(self, port, message):
         """
-        Main client function. Main loop is explained below.
-
-        Client is a socket connected to camera in host computer 129.175.108.52. Port depends on which kind of data you
-        are listening on. After connection, timeout is set to 5 ms, which is camera current dead time. cam_properties
-        is a dict containing all info camera sends through tcp (the header); frame_data is the frame; buffer_size is how
-        many bytes we collect within each loop interaction; frame_number is the frame counter and frame_time is when the
-        whole frame began.
-
-        check string value is a convenient function to detect the values using the header standard format for jsonimage.
+        Configuration bytes sent to the data port when a Focus, Cumul, Chrono or time-resolved client connects: soft
+        binning, bit depth, cumul, tp3mode, accumulation number (twice), scan size and TDC delay and width.
         """
-
-        if self.__port==1:
-            logging.info('***TP3***: Save locally is activated. No socket will be open. Line start and line 05 is sent to TDC.')
-            try:
-                scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-                    "orsay_scan_device")
-                scanInstrument.scan_device.orsayscan.SetTdcLine(1, 2, 7)  # Copy Line Start
-                scanInstrument.scan_device.orsayscan.SetTdcLine(0, 2, 13)  # Copy line 05
-            except AttributeError:
-                logging.info("***TP3***: Could not set TDC to spim acquisition.")
-            return
-
-        inputs = list()
-        outputs = list()
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        """
-        127.0.0.1 -> LocalHost;
-        129.175.108.58 -> Patrick;
-        129.175.81.162 -> My personal Dell PC;
-        192.0.0.11 -> My old personal (outside lps.intra);
-        192.168.199.11 -> Cheetah (to VG Lum. Outisde lps.intra);
-        129.175.108.52 -> CheeTah
-        """
-        ip = socket.gethostbyname('127.0.0.1') if self.__simul else socket.gethostbyname(self.__camIP)
-        address = (ip, port)
-        try:
-            client.connect(address)
-            logging.info(f'***TP3***: Both clients connected over {ip}:{port}.')
-            inputs.append(client)
-        except ConnectionRefusedError:
-            return False
-
-        cam_properties = dict()
-        buffer_size = 2*64000
-
         config_bytes = b''
 
         self.__tr = False  # Start always with false and will be updated if otherwise
@@ -724,7 +2228,6 @@ class TimePix3():
             config_bytes += b'\x00'  # Cumul is OFF
 
         config_bytes += bytes([self.__tp3mode])
-        assert message == 1 or message == 3 #Focus/Cumul (message=1) and Chrono (message=3)
         size = int(self.__accumulation)
         config_bytes += size.to_bytes(2, 'big')
         config_bytes += size.to_bytes(2, 'big')
@@ -748,98 +2251,211 @@ class TimePix3():
         config_bytes += struct.pack(">H", int(self.__delay))  # BE. See https://docs.python.org/3/library/struct.html
         config_bytes += struct.pack(">H", int(self.__width))  # BE. See https://docs.python.org/3/library/struct.html
 
-        client.send(config_bytes)
+        return config_bytes
 
-        def check_string_value(header, prop):
-            """
-            Check the value in the header dictionary. Some values are not number so a valueError
-            exception handles this.
-            """
-
-            start_index = header.index(prop)
-            end_index = start_index + len(prop)
-            begin_value = header.index(':', end_index, len(header)) + 1
-            if prop == 'height':
-                end_value = header.index('}', end_index, len(header))
-            else:
-                end_value = header.index(',', end_index, len(header))
-            try:
-                if prop == 'timeAtFrame':
-                    value = float(header[begin_value:end_value])
-                else:
-                    value = int(header[begin_value:end_value])
-            except ValueError:
-                value = str(header[begin_value:end_value])
-            return value
+    async def connect_time_resolved_client(self, port):
+        """
+        Connects the time-resolved client and sends the configuration (tp3mode 8).
+        """
+        loop = asyncio.get_running_loop()
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(False)
+        ip = socket.gethostbyname('127.0.0.1') if self.__simul else socket.gethostbyname(self.__camIP)
+        try:
+            await loop.sock_connect(client, (ip, port))
+        except ConnectionRefusedError:
+            client.close()
+            raise ConnectionError(f'***TP3***: Time-resolved data port {ip}:{port} refused the connection.')
+        logging.info(f'***TP3***: Time-resolved client connected over {ip}:{port}.')
+        await loop.sock_sendall(client, await self.run_blocking(self.create_config_bytes))
+        return client
 
-        def put_queue(cam_prop, frame):
-            try:
-                assert int(cam_properties['width']) * int(
-                    cam_properties['height']) * int(
-                    cam_properties['bitDepth'] / 8) == int(cam_properties['dataSize'])
-                assert cam_properties['dataSize'] + 1 == len(frame)
-                self.__dataQueue.put((cam_prop, frame))
+    async def receive_first_time_events(self, client, timeout=TIME_RESOLVED_TIMEOUT):
+        """
+        Waits for the first complete TIME_EVENT_DTYPE record and checks it is one (pixel inside the detector or TDC).
+        Returns the receive buffer and its filled size. Raises ConnectionError if the data server does not answer with
+        time-resolved events within timeout seconds, which is what a server without tp3mode 8 does.
+        """
+        loop = asyncio.get_running_loop()
+        itemsize = TIME_EVENT_DTYPE.itemsize
+        buffer = bytearray(itemsize * 8192)
+        view = memoryview(buffer)
+        filled = 0
+        deadline = time.perf_counter() + timeout
+        try:
+            while filled < itemsize:
+                nbytes = await asyncio.wait_for(loop.sock_recv_into(client, view[filled:]),
+                                                max(deadline - time.perf_counter(), 0.))
+                if nbytes == 0: break
+                filled += nbytes
+        except asyncio.TimeoutError:
+            pass
+        pixel = numpy.frombuffer(buffer, dtype=TIME_EVENT_DTYPE, count=1)['pixel'][0] if filled >= itemsize else None
+        if pixel is None or (pixel >= 1024 * 256 and pixel != TIME_EVENT_TDC):
+            raise ConnectionError(f'***TP3***: Data server did not answer with time-resolved events within {timeout} '
+                                  f's. It must implement tp3mode 8.')
+        return buffer, filled
+
+    async def acquire_time_resolved_events(self, client, message, buffer, filled):
+        """
+        Client of the time-resolved mode, on the client connected and checked by startTimeResolvedAsync. Data is a
+        stream of TIME_EVENT_DTYPE records received in buffer (holding filled bytes already); complete records are
+        queued to the accumulation thread and incomplete ones are moved to the beginning of the buffer, so the event
+        loop only receives.
+        """
+        loop = asyncio.get_running_loop()
+        itemsize = TIME_EVENT_DTYPE.itemsize
+        view = memoryview(buffer)
+        work = queue.Queue(maxsize=64)
+        worker = threading.Thread(target=self.__accumulate_time_events, daemon=True,
+                                  args=(work, message, self.__timeHistogram, self.__coincidence))
+        worker.start()
+
+        def finish():
+            work.put(None)
+            worker.join()
+
+        try:
+            while True:
+                complete = filled - filled % itemsize
+                if complete:
+                    records = bytes(view[:complete])
+                    try:
+                        work.put_nowait(records)
+                    except queue.Full:
+                        await loop.run_in_executor(None, work.put, records)
+                view[:filled - complete] = view[complete:filled]
+                filled -= complete
+                if not self.__isPlaying:
+                    return
+                nbytes = await loop.sock_recv_into(client, view[filled:])
+                if nbytes == 0: return
+                filled += nbytes
+        except ConnectionResetError:
+            logging.info("***TP3***: Socket reseted. Closing connection.")
+            return
+        finally:
+            client.close()
+            await loop.run_in_executor(None, finish)
+            logging.info(f'***TP3***: {self.__timeHistogram.received_events} time-resolved events received.')
+
+    def __accumulate_time_events(self, work, message, histogram, coincidence):
+        """
+        Accumulation thread of acquire_time_resolved_events. sendmessage is called at most every 100 ms.
+        """
+        last_message = time.perf_counter()
+        while True:
+            records = work.get()
+            if records is None:
+                break
+            events = numpy.frombuffer(records, dtype=TIME_EVENT_DTYPE)
+            histogram.accumulate(events)
+            if coincidence is not None:
+                coincidence.push_events(events)
+            if time.perf_counter() - last_message > 0.1:
                 self.sendmessage(message)
+                last_message = time.perf_counter()
+        if coincidence is not None:
+            coincidence.flush()
+
+    async def acquire_streamed_frame(self, port, message):
+        """
+        Main client function. Main loop is explained below.
+
+        Client is a non-blocking socket connected to camera in host computer 129.175.108.52 and read by the TimePix3
+        event loop. Port depends on which kind of data you are listening on. cam_properties is the JsonImageHeader given
+        by header_decoder and frame_data is a memoryview of ring_buffer, valid until the next receive.
+        """
+
+        if self.__port==1:
+            logging.info('***TP3***: Save locally is activated. No socket will be open. Line start and line 05 is sent to TDC.')
+            await self.run_blocking(self.set_tdc_lines, [((1, 2, 7), {}),  # Copy Line Start
+                                                         ((0, 2, 13), {})],  # Copy line 05
+                                    "***TP3***: Could not set TDC to spim acquisition.")
+            return
+
+        loop = asyncio.get_running_loop()
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(False)
+        """
+        127.0.0.1 -> LocalHost;
+        129.175.108.58 -> Patrick;
+        129.175.81.162 -> My personal Dell PC;
+        192.0.0.11 -> My old personal (outside lps.intra);
+        192.168.199.11 -> Cheetah (to VG Lum. Outisde lps.intra);
+        129.175.108.52 -> CheeTah
+        """
+        ip = socket.gethostbyname('127.0.0.1') if self.__simul else socket.gethostbyname(self.__camIP)
+        address = (ip, port)
+        try:
+            await loop.sock_connect(client, address)
+            logging.info(f'***TP3***: Both clients connected over {ip}:{port}.')
+        except ConnectionRefusedError:
+            client.close()
+            return False
+
+        cam_properties = None
+
+        assert message == 1 or message == 3 #Focus/Cumul (message=1) and Chrono (message=3)
+        config_bytes = await self.run_blocking(self.create_config_bytes)
+        await loop.sock_sendall(client, config_bytes)
+
+        if self.__tp3mode == 6 or self.__tp3mode == 7:
+            header_decoder = JsonImageHeaderDecoder(bitDepth=32, width=self.getImageSize()[0])
+        elif self.__softBinning:
+            header_decoder = JsonImageHeaderDecoder(bitDepth=32, width=self.getImageSize()[0], height=1)
+        else:
+            header_decoder = JsonImageHeaderDecoder(bitDepth=16, width=self.getImageSize()[0])
+
+        def put_queue(cam_prop, frame):
+            if cam_prop.dataSize + 1 == len(frame):
+                self.__frameSlot.write(cam_prop, frame)
+                self.schedule_decode(message)
                 return True
-            except AssertionError:
+            else:
+                self.__frameSlot.dropped += 1
                 logging.info(
-                    f'***TP3***: Problem in size/len assertion. Properties are {cam_properties} and data is {len(frame)}')
+                    f'***TP3***: Problem in size/len assertion. Properties are {cam_prop} and data is {len(frame)}')
                 return False
 
         if message == 1 or message == 3:
-            while True:
-                try:
-                    read, _, _ = select.select(inputs, outputs, inputs)
-                    for s in read:
-                        if s == inputs[0]:
-                            packet_data = s.recv(buffer_size)
-                            if packet_data == b'': return
-                            while (packet_data.find(b'{"time') == -1) or (packet_data.find(b'}\n') == -1):
-                                temp = s.recv(buffer_size)
-                                if temp == b'':
-                                    return
-                                else:
-                                    packet_data += temp
-
-                            begin_header = packet_data.index(b'{"time')
-                            end_header = packet_data.index(b'}\n', begin_header)
-                            header = packet_data[begin_header:end_header + 1].decode('latin-1')
-                            for properties in ["timeAtFrame", "frameNumber", "measurementID", "dataSize", "bitDepth",
-                                               "width",
-                                               "height"]:
-                                cam_properties[properties] = (check_string_value(header, properties))
-
-                            data_size = int(cam_properties['dataSize'])
-
-                            while len(packet_data) < begin_header + data_size + len(header):
-                                temp = s.recv(buffer_size)
-                                if temp == b'':
-                                    return
-                                else:
-                                    packet_data += temp
-
-                            frame_data = packet_data[end_header + 2:end_header + 2 + data_size + 1]
-                            if put_queue(cam_properties, frame_data):
-                                frame_data = b''
-
-                except ConnectionResetError:
-                    logging.info("***TP3***: Socket reseted. Closing connection.")
-                    return
-                if not self.__isPlaying:
-                    return
-        return
+            ring_buffer = FrameRingBuffer()
+            header = None
+            try:
+                while True:
+                    if await ring_buffer.receive_async(loop, client) == 0: return
+                    while True:
+                        if header is None:
+                            header = ring_buffer.read_header()
+                            if header is None: break
+                            cam_properties, valid_header = header_decoder.decode(header)
+                            if not valid_header:
+                                # Its dataSize cannot be trusted: resyncs on the next header.
+                                logging.info(f'***TP3***: Unexpected frame layout {cam_properties}.')
+                                self.__frameSlot.dropped += 1
+                                header = None
+                                continue
+
+                        frame_data = ring_buffer.read(cam_properties.dataSize + 1)
+                        if frame_data is None: break
+                        header = None
+                        put_queue(cam_properties, frame_data)
+
+                    if not self.__isPlaying:
+                        return
+            except ConnectionResetError:
+                logging.info("***TP3***: Socket reseted. Closing connection.")
+                return
+            finally:
+                client.close()
 
     def acquire_streamed_frame_from_scan(self, port, message):
         """
         Main client function. Main loop is explained below.
 
         Client is a socket connected to camera in host computer 129.175.108.52. Port depends on which kind of data you
-        are listening on. After connection, timeout is set to 5 ms, which is camera current dead time. cam_properties
-        is a dict containing all info camera sends through tcp (the header); frame_data is the frame; buffer_size is how
-        many bytes we collect within each loop interaction; frame_number is the frame counter and frame_time is when the
-        whole frame began.
-
-        check string value is a convenient function to detect the values using the header standard format for jsonimage.
+        are listening on. Data is a stream of 32-bit event indexes. This thread only receives it in the buffers of a
+        SpimEventPipeline, whose worker threads decode and accumulate the events into __spimData.
         """
 
 
@@ -863,9 +2479,6 @@ class TimePix3():
         except ConnectionRefusedError:
             return False
 
-        cam_properties = dict()
-        buffer_size = 2*64000
-
         config_bytes = b''
 
         self.__tr = False  # Start always with false and will be updated if otherwise
@@ -874,23 +2487,41 @@ class TimePix3():
         config_bytes += b'\x02'  # Bit depth 32 otherwise
         config_bytes += b'\x00'  # Cumul is OFF
         config_bytes += bytes([2]) #Mode 02 (SPIM)
-        scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
-            "orsay_scan_device")
-        if scanInstrument.scan_device.current_frame_parameters['subscan_pixel_size']:
-            x_size = int(scanInstrument.scan_device.current_frame_parameters['subscan_pixel_size'][1])
-            y_size = int(scanInstrument.scan_device.current_frame_parameters['subscan_pixel_size'][0])
-        else:
-            x_size = int(scanInstrument.scan_device.current_frame_parameters['size'][1])
-            y_size = int(scanInstrument.scan_device.current_frame_parameters['size'][0])
+        try:
+            scanInstrument = HardwareSource.HardwareSourceManager().get_hardware_source_for_hardware_source_id(
+                "orsay_scan_device")
+            frame_parameters = scanInstrument.scan_device.current_frame_parameters
+            if frame_parameters['subscan_pixel_size']:
+                x_size = int(frame_parameters['subscan_pixel_size'][1])
+                y_size = int(frame_parameters['subscan_pixel_size'][0])
+            else:
+                x_size = int(frame_parameters['size'][1])
+                y_size = int(frame_parameters['size'][0])
+        except AttributeError:
+            logging.info("***TP3***: Could not grab scan parameters. Using (64, 64) spim.")
+            frame_parameters = None
+            x_size = y_size = 64
 
         max_val = max(x_size, y_size)
-        if max_val <= 64:
+        self.__spimFile = None
+        if self.__spimFolder is not None:
+            self.__spimFile = self.create_spim_file(x_size, y_size, frame_parameters)
+            self.__spimData = self.__spimFile.flat
+        elif self.__spimAdaptive:
+            self.__spimData = None
+        elif max_val <= 64:
             self.__spimData = numpy.zeros(x_size * y_size * 1025, dtype=numpy.uint32)
         elif max_val <= 512:
             self.__spimData = numpy.zeros(x_size * y_size * 1025, dtype=numpy.uint16)
         else:
             self.__spimData = numpy.zeros(x_size * y_size * 1025, dtype=numpy.uint8)
 
+        if self.__spimAdaptive and self.__spimFile is None:
+            self.__spimAccumulator = AdaptiveSpimAccumulator(x_size, y_size)
+        else:
+            self.__spimAccumulator = SpimAccumulator(self.__spimData, self.__spimBackend, self.__spimCoalesce)
+        self.__spimLines = SpimLineTracker(x_size, y_size)
+
         #Scan and Spim are equal here
         #self.__spimData = numpy.zeros(x_size * y_size * 1025, dtype=numpy.uint8)
         self.__xspim = x_size
@@ -906,99 +2537,171 @@ class TimePix3():
         client.send(config_bytes)
 
         self.__isReady.set() #This waits until spimData is created so scan can have access to it.
-        byte_unique = 1
-        if byte_unique == 2:
-            dt_unique = numpy.dtype(numpy.uint16).newbyteorder('>')
-            mult_factor = 2
-        elif byte_unique == 1:
-            dt_unique = numpy.dtype(numpy.uint8).newbyteorder('>')
-            mult_factor = 4
         if message == 2:
-            counter = 0
+            self.__spimPipeline = SpimEventPipeline(self.__spimAccumulator, self.__spimWorkers, self.__spimQueueDepth,
+                                                    tracker=self.__spimLines)
+
+            def finish_spim():
+                self.__spimPipeline.stop()
+                self.update_spim_all()
+                if self.__spimFile is not None:
+                    self.__spimFile.flush()
+                    logging.info(f'***TP3***: SPIM saved in {self.__spimFile.path}.')
+                logging.info(f'***TP3***: SPIM pipeline metrics are {self.__spimPipeline.metrics}.')
+
             while True:
-                dt_unique = numpy.dtype(numpy.uint8).newbyteorder('<')
-                dt = numpy.dtype(numpy.uint32).newbyteorder('<')
                 try:
                     read, _, _ = select.select(inputs, outputs, inputs)
                     for s in read:
-                        counter += 1
-                        packet_data = s.recv(buffer_size)
-
-                        ### Method 01 ###
-                        """
-                        index = 0
-                        while index < len(packet_data):
-                            index = packet_data.find(b'{StartUnique}', index)
-                            if index == -1: break
-                            index2 = packet_data.find(b'{StartIndexes}', index)
-                            if index2 == -1: #If there is not, do another call.
-                                packet_data += s.recv(buffer_size)
-                                index2 = packet_data.find(b'{StartIndexes}', index)
-                            #try:
-                            unique = numpy.frombuffer(packet_data[index+13:index2], dtype=dt_unique)
-                            last_index = index2+14+(index2-index-13)*mult_factor
-                            if last_index > len(packet_data):
-                                packet_data += s.recv(last_index - len(packet_data))
-                            event_list = numpy.frombuffer(packet_data[index2+14:last_index], dtype=dt)
-
-                            index += 13
-                            try:
-                                self.__spimData[event_list] += unique
-                            except IndexError:
-                                logging.info(f'***TP3***: Indexing error.')
-                            except ValueError:
-                                logging.info(f'***TP3***: Value error.')
-                                logging.info(f'***TP3***: Incomplete data.')
-                        """
-
-                        ### Method 02 ###
-                        if len(packet_data) == 0:
+                        if self.__spimPipeline.receive(s) == 0:
                             logging.info('***TP3***: No more packets received. Finishing SPIM.')
-                            self.update_spim_all()
+                            finish_spim()
                             return
 
-                        q = len(packet_data) % 32
-                        if q:
-                            packet_data += s.recv(32 - q)
-
-                        try:
-                            event_list = numpy.frombuffer(packet_data, dtype=dt)
-                            if len(event_list) > 0:
-                                #for val in event_list:
-                                #    self.__spimData[val] += 1
-                                self.update_spim_direct(event_list)
-                        except ValueError:
-                            logging.info(f'***TP3***: Value error.')
-                        except IndexError:
-                            logging.info(f'***TP3***: Indexing error.')
-
                 except ConnectionResetError:
                     logging.info("***TP3***: Socket reseted. Closing connection.")
+                    finish_spim()
                     return
 
                 if not self.__isPlaying:
                     logging.info('***TP3***: Finishing SPIM.')
-                    self.update_spim_all()
+                    finish_spim()
                     return
         return
 
 
+    def create_spim_file(self, x_size, y_size, frame_parameters):
+        calibration = dict()
+        if frame_parameters is not None:
+            calibration['fov_nm'] = frame_parameters['fov_nm']
+            calibration['pixel_time_us'] = frame_parameters['pixel_time_us']
+        try:
+            instrument = HardwareSource.HardwareSourceManager().get_instrument_by_id("VG_Lum_controller")
+            calibration['eels_x_scale'] = instrument.TryGetVal("eels_x_scale")[1]
+            calibration['eels_x_offset'] = instrument.TryGetVal("eels_x_offset")[1]
+        except AttributeError:
+            logging.info("***TP3***: Could not grab EELS calibration for the spim file.")
+        os.makedirs(self.__spimFolder, exist_ok=True)
+        path = os.path.join(self.__spimFolder, time.strftime('spim_%Y%m%d_%H%M%S.tp3spim'))
+        logging.info(f'***TP3***: Creating spim file {path}.')
+        return SpimFile.create(path, x_size, y_size, 1025, numpy.uint32, **calibration)
+
+    def schedule_decode(self, message):
+        """
+        Called by the client task after a frame is written in the frame slot. Decoding runs in the executor of the event
+        loop, so the client goes back to the socket immediately. Only one decoding job is scheduled at a time; it
+        decodes the last frame of the slot until no new frame is there, so frames arriving meanwhile are superseded.
+        """
+        with self.__decodeLock:
+            if self.__decodeScheduled: return
+            self.__decodeScheduled = True
+        self.__loop.run_in_executor(None, self.__decode_frames, message)
+
+    def __decode_frames(self, message):
+        try:
+            while True:
+                with self.__decodeLock:
+                    if not self.__frameSlot.has_new_frame:
+                        self.__decodeScheduled = False
+                        return
+                last = self.__frameSlot.read(self.__decode_frame)
+                if last is None: continue
+                self.__decodedFrame = last[1]
+                if message == 3 and self.__chrono is not None:
+                    self.__chrono.push_frame(last[1].image, last[0].frameNumber)
+                self.__decodedSequence += 1
+                self.sendmessage(message)
+        except Exception as e:
+            with self.__decodeLock:
+                self.__decodeScheduled = False
+            logging.info(f'***TP3***: Problem decoding frame: {e}.')
+
+    def __decode_frame(self, properties, frame_data):
+        decoded = self.__decodePool.decode(properties, frame_data)
+        decoded.current = self.get_current_from_counts(decoded.counts, properties.frameNumber)
+        return decoded
+
+    def setChronoFile(self, folder):
+        """
+        Sets the folder in which Chrono spectra are recorded when they leave the chrono buffer, or None to keep only
+        the displayed ones. Used in the next Chrono.
+        """
+        self.__chronoFolder = folder
+
+    def create_chrono_buffer(self):
+        if self.__chrono is not None:
+            self.__chrono.close()
+        path = None
+        if self.__chronoFolder is not None:
+            os.makedirs(self.__chronoFolder, exist_ok=True)
+            path = os.path.join(self.__chronoFolder, time.strftime('chrono_%Y%m%d_%H%M%S.chrono'))
+            logging.info(f'***TP3***: Recording chrono in {path}.')
+        self.__chrono = ChronoBuffer(self.__accumulation, self.getImageSize()[0], spill_path=path)
+
+    def get_chrono_buffer(self):
+        return self.__chrono
+
+    def get_chrono_image(self):
+        """
+        Returns a copy of the Chrono spectra in time order. It is called by the decoding thread, so the image handed to
+        Swift is not changed by the next frame.
+        """
+        return self.__chrono.ordered().copy()
+
+    def setFrameDecodeWorkers(self, workers):
+        """
+        Sets the number of threads decoding each Focus, Cumul and Chrono frame. Used in the next acquisition.
+        """
+        self.__decodePool.shutdown()
+        self.__decodePool = FrameDecodePool(workers)
+
+    def get_last_decoded_frame(self):
+        """
+        Returns the DecodedFrame of the last decoded frame (image, vertically binned spectrum, counts and current), or
+        None if no frame was decoded yet.
+        """
+        decoded = self.__decodedFrame
+        self.__readSequence = self.__decodedSequence
+        return decoded
+
     def get_last_data(self):
-        return self.__dataQueue.get()
+        decoded = self.get_last_decoded_frame()
+        if decoded is None: return None
+        return decoded.properties, decoded.image.tobytes()
+
+    def take_image(self, decoded):
+        """
+        Detaches the image of decoded from the decode pool and returns it, so it can be kept without a copy.
+        """
+        return self.__decodePool.images.detach(decoded.image)
+
+    def get_last_image(self):
+        """
+        Returns the tuple (properties, image) of the last decoded frame. Image is an array of the decode pool.
+        """
+        decoded = self.get_last_decoded_frame()
+        if decoded is None: return None
+        return decoded.properties, decoded.image
+
+    def has_new_data(self):
+        return self.__decodedSequence > self.__readSequence
+
+    def get_frame_metrics(self):
+        decoded = self.__decodePool.decoded
+        return {'received_frames': self.__frameSlot.sequence, 'superseded_frames': self.__frameSlot.superseded,
+                'dropped_frames': self.__frameSlot.dropped, 'decoded_frames': decoded,
+                'mean_decode_ms': self.__decodePool.decode_time / decoded * 1e3 if decoded else 0.,
+                'frame_allocations': self.__decodePool.images.allocations}
 
     def get_last_event(self):
         return self.__eventQueue.get()
 
     def update_spim(self):
         event_list = self.__eventQueue.get()
-        unique, counts = numpy.unique(event_list, return_counts=True)
-        counts = counts.astype(numpy.uint32)
-        self.__spimData[unique] += counts
+        self.__spimAccumulator.accumulate(event_list)
 
     def update_spim_direct(self, event_list):
-        unique, counts = numpy.unique(event_list, return_counts=True)
-        counts = counts.astype(numpy.uint32)
-        self.__spimData[unique] += counts
+        self.__spimAccumulator.accumulate(event_list)
 
     def update_spim_all(self):
         logging.info('***TP3***: Emptying queue and closing connection.')
@@ -1007,38 +2710,32 @@ class TimePix3():
             if qs % 100 == 0:
                 logging.info(f'***TP3***: Approximate points left: {qs}')
             event_list = self.__eventQueue.get()
-            unique, counts = numpy.unique(event_list, return_counts=True)
-            counts = counts.astype(numpy.uint32)
-            self.__spimData[unique] += counts
+            self.__spimAccumulator.accumulate(event_list)
+        self.__spimAccumulator.flush()
         logging.info('***TP3***: SPIM finished.')
 
     def get_total_counts_from_data(self, frame_int):
         return numpy.sum(frame_int)
 
     def get_current(self, frame_int, frame_number):
+        return self.get_current_from_counts(numpy.sum(frame_int), frame_number)
+
+    def get_current_from_counts(self, counts, frame_number):
+        if not self.__expTime:
+            return 0.
         if self.__isCumul and frame_number:
-            eps = (numpy.sum(frame_int) / self.__expTime) / frame_number
+            eps = (counts / self.__expTime) / frame_number
         else:
-            eps = numpy.sum(frame_int) / self.__expTime
+            eps = counts / self.__expTime
         cur_pa = eps / (6.242 * 1e18) * 1e12
         return cur_pa
 
     def create_image_from_bytes(self, frame_data, bitDepth, width, height):
         """
-        Creates an image int8 (1 byte) from byte frame_data. If softBinning is True, we sum in Y axis.
+        Creates an image int8 (1 byte) from byte frame_data. If softBinning is True, we sum in Y axis. frame_data can be
+        bytes or a memoryview. The image belongs to the decode pool, see take_image.
         """
-        frame_data = numpy.array(frame_data[:-1])
-        if bitDepth == 8:
-            dt = numpy.dtype(numpy.uint8).newbyteorder('<')
-            frame_int = numpy.frombuffer(frame_data, dtype=dt)
-        elif bitDepth == 16:
-            dt = numpy.dtype(numpy.uint16).newbyteorder('<')
-            frame_int = numpy.frombuffer(frame_data, dtype=dt)
-        elif bitDepth == 32:
-            dt = numpy.dtype(numpy.uint32).newbyteorder('<')
-            frame_int = numpy.frombuffer(frame_data, dtype=dt)
-        frame_int = numpy.reshape(frame_int, (height, width))
-        return frame_int
+        return self.__decodePool.images.decode(frame_data, bitDepth, width, height)
 
     def create_spimimage_from_bytes(self, frame_data, bitDepth, width, height, xspim, yspim):
         """
@@ -1061,5 +2758,16 @@ class TimePix3():
         frame_int = numpy.reshape(frame_int, (self.__yspim, self.__xspim, width))
         return frame_int
 
-    def create_spimimage_from_events(self):
+    def create_spimimage_from_events(self, lines=None):
+        """
+        Spim (y, x, 1025) of the events received so far. If lines is given (first and end line, as returned by
+        take_spim_lines), only these lines are brought up to date, so a read during the scan does not cost a pass over
+        the whole cube.
+        """
+        first, end = (0, self.__yspim) if lines is None else lines
+        if self.__spimPipeline is not None:
+            line_size = self.__xspim * 1025
+            self.__spimPipeline.reduce(first * line_size, end * line_size)
+        if isinstance(self.__spimAccumulator, AdaptiveSpimAccumulator):
+            return self.__spimAccumulator.create_array(first, end)
         return self.__spimData.reshape((self.__yspim, self.__xspim, 1025))
@@ -0,0 +1,321 @@
+"""
+Offline reading of the raw .tpx3 files serval writes when the destination is 'Save Locally' (set_destination(1)).
+
+A .tpx3 file is a sequence of chunks. Each chunk starts with a 'TPX3' header packet (chip index in byte 4, chunk size in
+bytes in bytes 6-7) followed by 64-bit little-endian packets. Packet type is given by the 4 most significant bits: 0xb
+is a pixel hit (ToA/ToT mode) and 0x6 is a TDC timestamp, with its kind in the next 4 bits.
+
+Files are read through numpy.memmap and decoded with vectorized operations only. Hits are converted to the same 32-bit
+event indexes the live spim stream carries, (line * x_size + column) * CHANNELS + energy channel, so replayed data is
+accumulated by SpimAccumulator exactly as during acquisition. Big files are split in chunks decoded by a process pool.
+"""
+
+import os
+import logging
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+
+from nionswift_plugin.IVG.tp3.tp3func import SpimAccumulator
+
+CHANNELS = 1025
+HEADER = 0x33585054  # 'TPX3' read as little-endian uint32.
+CHIP_OFFSETS = (0, 256, 512, 768)  # Column of the first pixel of each chip, for the 1024 x 256 CheeTah.
+TOA_TICK = 1.5625  # ns. ToA counts 25 ns coarse periods divided by 16 fine periods.
+TOA_PERIOD = (1 << 34) * TOA_TICK  # ns. ToA rolls over every ~26.8 s.
+TOT_TICK = 25.  # ns
+
+TDC1_RISING = 0xf
+TDC1_FALLING = 0xa
+TDC2_RISING = 0xe
+TDC2_FALLING = 0xb
+
+HIT_DTYPE = numpy.dtype([('index', '<i8'), ('x', '<u2'), ('y', '<u2'), ('toa', '<f8'), ('tot', '<u2')])
+TDC_DTYPE = numpy.dtype([('index', '<i8'), ('kind', '<u1'), ('time', '<f8')])
+
+
+def open_packets(path):
+    """
+    Memory maps a .tpx3 file as an array of uint64 packets.
+    """
+    size = os.path.getsize(path) // 8
+    return numpy.memmap(path, dtype='<u8', mode='r', shape=(size,))
+
+
+def is_header(packets):
+    return (packets & 0xffffffff) == HEADER
+
+
+def chunk_bounds(packets, chunk_packets=1 << 24):
+    """
+    Splits packets in (start, stop) slices of at least chunk_packets packets. Each slice starts on a header packet, so
+    it can be decoded independently: the search for the next header goes on until one is found, or the last slice
+    ends the file.
+    """
+    bounds = [0]
+    start = chunk_packets
+    while start < len(packets):
+        window = packets[start:start + (1 << 16)]
+        headers = numpy.flatnonzero(is_header(window))
+        if not len(headers):
+            start += len(window)
+            continue
+        bounds.append(start + int(headers[0]))
+        start = bounds[-1] + chunk_packets
+    return list(zip(bounds, bounds[1:] + [len(packets)]))
+
+
+def chip_at(packets, position, window=1 << 16):
+    """
+    Chip index given by the last header packet before position (0 if there is none).
+    """
+    while position > 0:
+        start = max(0, position - window)
+        headers = numpy.flatnonzero(is_header(packets[start:position]))
+        if len(headers):
+            return int((int(packets[start + headers[-1]]) >> 32) & 0xff)
+        position = start
+    return 0
+
+
+def decode_packets(packets, offset=0, chip_offsets=CHIP_OFFSETS, chip=0):
+    """
+    Decodes an array of raw packets. Returns the (hits, tdcs) structured arrays (HIT_DTYPE, TDC_DTYPE), with index
+    being the packet position (plus offset) so hits and TDCs can be ordered as they were written. Times are in ns,
+    ToA modulo TOA_PERIOD and TDC at 3.125 ns plus the 260 ps fine time. chip is the chip index of the packets before
+    the first header (see chip_at), for arrays that do not start on a header.
+    """
+    packets = numpy.asarray(packets)
+    header = is_header(packets)
+    header_positions = numpy.flatnonzero(header)
+    chips = numpy.concatenate(([chip], (packets[header_positions] >> 32) & 0xff)).astype(numpy.int64)
+    chip = chips[numpy.searchsorted(header_positions, numpy.arange(len(packets)), side='right')]
+
+    kind = (packets >> 60) & 0xf
+    hit_positions = numpy.flatnonzero((kind == 0xb) & ~header)
+    tdc_positions = numpy.flatnonzero((kind == 0x6) & ~header)
+
+    pixel = packets[hit_positions]
+    dcol = (pixel >> 52) & 0xfe
+    spix = (pixel >> 45) & 0xfc
+    pix = (pixel >> 44) & 0x7
+    hits = numpy.empty(len(hit_positions), dtype=HIT_DTYPE)
+    hits['index'] = hit_positions + offset
+    hits['x'] = dcol + (pix >> 2) + numpy.asarray(chip_offsets, dtype=numpy.uint64)[chip[hit_positions]]
+    hits['y'] = spix + (pix & 0x3)
+    coarse = ((pixel & 0xffff) << 14) | ((pixel >> 30) & 0x3fff)
+    fine = (pixel >> 16) & 0xf
+    hits['toa'] = ((coarse << 4).astype(numpy.int64) - fine.astype(numpy.int64)) % (1 << 34) * TOA_TICK
+    hits['tot'] = (pixel >> 20) & 0x3ff
+
+    tdc = packets[tdc_positions]
+    tdcs = numpy.empty(len(tdc_positions), dtype=TDC_DTYPE)
+    tdcs['index'] = tdc_positions + offset
+    tdcs['kind'] = (tdc >> 56) & 0xf
+    tdc_fine = ((tdc >> 5) & 0xf).astype(numpy.int64)
+    tdcs['time'] = ((tdc >> 9) & 0x7ffffffff) * 3.125 + numpy.maximum(tdc_fine - 1, 0) * 0.26
+    return hits, tdcs
+
+
+def unwrap_toa(toa, previous=None):
+    """
+    Removes the ToA rollovers of hits in packet order. Returns the unwrapped ToA and the number of rollovers, counted
+    from previous (the last ToA of the preceding chunk) if given.
+    """
+    steps = numpy.diff(toa, prepend=toa[:1] if previous is None else previous)
+    wraps = numpy.cumsum(steps < -TOA_PERIOD / 2) - numpy.cumsum(steps > TOA_PERIOD / 2)
+    return toa + wraps * TOA_PERIOD, int(wraps[-1]) if len(wraps) else 0
+
+
+def unwrap_times(hits, tdcs, previous=None, merged=None):
+    """
+    Unwraps the ToA of hits and the times of tdcs together. Hits and TDCs are not written in time order with respect
+    to each other (chips and TDC are read out with a lag of a few ms), so each is first put on the ToA time line (TDC
+    times modulo TOA_PERIOD) and the merged sequence is unwrapped in packet order, the lag being far below half a
+    rollover. Returns the hit times, the TDC times and the number of rollovers, counted from previous (the last time of
+    the preceding chunk, see merged_times) if given. merged is the merged_times result, if it was already computed.
+    """
+    times, order = merged_times(hits, tdcs) if merged is None else merged
+    unwrapped, wraps = unwrap_toa(times, previous)
+    result = numpy.empty_like(unwrapped)
+    result[order] = unwrapped
+    return result[:len(hits)], result[len(hits):], wraps
+
+
+def merged_times(hits, tdcs):
+    """
+    Times of hits and tdcs modulo TOA_PERIOD, in packet order, and the order giving them from the hits followed by the
+    tdcs.
+    """
+    order = numpy.argsort(numpy.concatenate((hits['index'], tdcs['index'])), kind='stable')
+    return numpy.concatenate((hits['toa'], tdcs['time'] % TOA_PERIOD))[order], order
+
+
+def spectrum_indexes(hits):
+    return hits['x'].astype(numpy.uint32)
+
+
+def chrono_indexes(hits, toa, start, frame_time, frames):
+    """
+    Event indexes of a chrono stack, frame * CHANNELS + channel, with frames of frame_time ns counted from start.
+    """
+    frame = numpy.floor((toa - start) / frame_time).astype(numpy.int64)
+    inside = (frame >= 0) & (frame < frames)
+    return (frame[inside] * CHANNELS + hits['x'][inside]).astype(numpy.uint32)
+
+
+def spim_indexes(hits, toa, line_times, first_line, x_size, y_size, pixel_time):
+    """
+    Event indexes of a spectrum image. Each hit belongs to the last line start before its time (toa, unwrapped), taken
+    from line_times, the sorted unwrapped line start times whose first one is line number first_line. Its column is
+    the time elapsed since that line start divided by pixel_time (ns); hits in the flyback are discarded.
+    """
+    line = numpy.searchsorted(line_times, toa, side='right') - 1
+    valid = line >= 0
+    elapsed = toa[valid] - line_times[line[valid]]
+    column = (elapsed // pixel_time).astype(numpy.int64)
+    row = (line[valid] + first_line) % y_size
+    inside = column < x_size
+    return ((row[inside] * x_size + column[inside]) * CHANNELS + hits['x'][valid][inside]).astype(numpy.uint32)
+
+
+def _scan_chunk(path, start, stop, line_tdc, chip):
+    hits, tdcs = decode_packets(open_packets(path)[start:stop], start, chip=chip)
+    merged = merged_times(hits, tdcs)
+    times = merged[0]
+    toa, tdc_times, wraps = unwrap_times(hits, tdcs, merged=merged)
+    return {'hits': len(hits), 'lines': int(numpy.count_nonzero(tdcs['kind'] == line_tdc)),
+            'line_times': tdc_times[tdcs['kind'] == line_tdc],
+            'first_time': float(times[0]) if len(times) else None,
+            'last_time': float(times[-1]) if len(times) else None,
+            'min_toa': float(toa.min()) if len(toa) else None,
+            'max_toa': float(toa.max()) if len(toa) else None, 'wraps': wraps}
+
+
+def _replay_chunk(path, start, stop, chip, mode, parameters):
+    hits, tdcs = decode_packets(open_packets(path)[start:stop], start, chip=chip)
+    if mode == 'spectrum':
+        return spectrum_indexes(hits)
+    toa, _, _ = unwrap_times(hits, tdcs)
+    toa = toa + parameters['wraps'] * TOA_PERIOD
+    if mode == 'chrono':
+        return chrono_indexes(hits, toa, parameters['start'], parameters['frame_time'], parameters['frames'])
+    elif mode == 'spim':
+        return spim_indexes(hits, toa, parameters['line_times'], parameters['first_line'], parameters['x_size'],
+                            parameters['y_size'], parameters['pixel_time'])
+
+
+class RawTpx3File():
+    """
+    Replays a raw .tpx3 file into spectra, chrono stacks or spectrum images. Chunks are decoded by processes workers (in
+    this process if processes is 0) and accumulated with a SpimAccumulator of the given backend.
+    """
+
+    def __init__(self, path, processes=None, chunk_packets=1 << 24, backend='auto'):
+        self.path = path
+        self.processes = os.cpu_count() if processes is None else processes
+        self.backend = backend
+        self.packets = open_packets(path)
+        self.chunks = chunk_bounds(self.packets, chunk_packets)
+        self.chips = [chip_at(self.packets, start) for start, _ in self.chunks]
+        self.__scan = None
+
+    def __map(self, function, arguments):
+        if self.processes == 0 or len(arguments) == 1:
+            for args in arguments:
+                yield function(*args)
+            return
+        with ProcessPoolExecutor(self.processes) as executor:
+            yield from executor.map(function, *zip(*arguments))
+
+    def __accumulate(self, data, mode, parameters):
+        accumulator = SpimAccumulator(data.reshape(-1), backend=self.backend)
+        arguments = [(self.path, start, stop, chip, mode, parameters[chunk]) for chunk, ((start, stop), chip) in
+                     enumerate(zip(self.chunks, self.chips))]
+        for event_list in self.__map(_replay_chunk, arguments):
+            accumulator.accumulate(event_list)
+        accumulator.flush()
+        return data
+
+    def scan(self, line_tdc=TDC1_RISING):
+        """
+        Returns a list with, for each chunk, the number of hits and of line start TDCs, the line start times, the
+        first and last times in packet order, the minimum and maximum ToA and the number of rollovers. Times are
+        unwrapped within the chunk, see wraps for the rollovers preceding it.
+        """
+        if self.__scan is None or self.__scan[0] != line_tdc:
+            arguments = [(self.path, start, stop, line_tdc, chip) for (start, stop), chip in
+                         zip(self.chunks, self.chips)]
+            self.__scan = (line_tdc, list(self.__map(_scan_chunk, arguments)))
+        return self.__scan[1]
+
+    def wraps(self, line_tdc=TDC1_RISING):
+        """
+        Number of ToA rollovers preceding each chunk.
+        """
+        wraps = list()
+        total = 0
+        previous_time = None
+        for chunk in self.scan(line_tdc):
+            if chunk['first_time'] is not None and previous_time is not None:
+                _, boundary = unwrap_toa(numpy.array([chunk['first_time']]), previous_time)
+                total += boundary
+            wraps.append(total)
+            if chunk['last_time'] is not None:
+                total += chunk['wraps']
+                previous_time = chunk['last_time']
+        return wraps
+
+    def spectrum(self):
+        """
+        Sum of all hits along the detector rows.
+        """
+        data = numpy.zeros(CHANNELS, dtype=numpy.uint32)
+        return self.__accumulate(data, 'spectrum', [None] * len(self.chunks))
+
+    def chrono(self, frame_time, frames=None):
+        """
+        Stack of spectra of frame_time ns each, starting at the earliest hit. If frames is None, the stack covers the
+        whole file.
+        """
+        chunks = self.scan()
+        wraps = self.wraps()
+        first_toa = [chunk['min_toa'] + chunk_wraps * TOA_PERIOD for chunk, chunk_wraps in zip(chunks, wraps) if
+                     chunk['hits']]
+        last_toa = [chunk['max_toa'] + chunk_wraps * TOA_PERIOD for chunk, chunk_wraps in zip(chunks, wraps) if
+                    chunk['hits']]
+        start = min(first_toa, default=0.)
+        if frames is None:
+            frames = int((max(last_toa, default=0.) - start) // frame_time) + 1
+        parameters = [{'wraps': chunk_wraps, 'frame_time': frame_time, 'start': start, 'frames': frames} for
+                      chunk_wraps in wraps]
+        data = numpy.zeros((frames, CHANNELS), dtype=numpy.uint32)
+        return self.__accumulate(data, 'chrono', parameters)
+
+    def spim(self, x_size, y_size, pixel_time=None, line_tdc=TDC1_RISING):
+        """
+        Spectrum image (y_size, x_size, CHANNELS). Lines start on the line_tdc TDCs (TDC1 rising edge copies the scan
+        line start, see StartSpimFromScan) and columns last pixel_time ns. If pixel_time is None, it is the median
+        line period divided by x_size, which ignores the flyback. Hits are assigned to lines by time, so hits written
+        before their line start TDC (TDCs are read out with a lag) still fall on their line.
+        """
+        chunks = self.scan(line_tdc)
+        wraps = self.wraps(line_tdc)
+        line_times = numpy.sort(numpy.concatenate([chunk['line_times'] + chunk_wraps * TOA_PERIOD for chunk,
+                                                   chunk_wraps in zip(chunks, wraps)] + [numpy.zeros(0)]))
+        if pixel_time is None:
+            if len(line_times) < 2:
+                logging.info('***TP3***: Not enough line start TDCs to estimate the pixel time.')
+                return None
+            pixel_time = numpy.median(numpy.diff(line_times)) / x_size
+        parameters = list()
+        for chunk, chunk_wraps in zip(chunks, wraps):
+            first_line, last_line = 0, 0
+            if chunk['hits']:
+                first_line = max(int(numpy.searchsorted(line_times, chunk['min_toa'] + chunk_wraps * TOA_PERIOD,
+                                                        side='right')) - 1, 0)
+                last_line = int(numpy.searchsorted(line_times, chunk['max_toa'] + chunk_wraps * TOA_PERIOD,
+                                                   side='right'))
+            parameters.append({'x_size': x_size, 'y_size': y_size, 'pixel_time': pixel_time, 'wraps': chunk_wraps,
+                               'line_times': line_times[first_line:last_line], 'first_line': first_line})
+        data = numpy.zeros((y_size, x_size, CHANNELS), dtype=numpy.uint32)
+        return self.__accumulate(data, 'spim', parameters)
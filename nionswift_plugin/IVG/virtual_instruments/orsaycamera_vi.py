@@ -0,0 +1,456 @@
+import threading
+import time
+import numpy
+from ctypes import CFUNCTYPE, POINTER, byref, cast
+from ctypes import c_int, c_bool, c_char_p, c_void_p, c_int16, c_int32, c_uint16, c_uint32, c_float, c_double
+
+__author__ = "Yves Auad"
+
+"""
+Pure python stand-in for orsaycamera.orsayCamera (Cameras.dll), used for simulated Roper/Andor cameras when the DLL
+cannot be loaded (Linux).
+
+It has the same method surface and calls the registered lockers and unlockers from a worker thread, as the DLL does:
+in Focus and Cumul the data locker gives the frame buffer and the data unlocker is called once it is written; in spim
+(and Chrono) the spim locker gives the whole spim buffer, each spectrum is written in place and followed by the spim
+unlocker, and the spectrum locker/unlocker pair receives the current spectrum. Callback types are CFUNCTYPE versions of
+the orsaycamera ones, so the callbacks go through ctypes exactly as with the DLL.
+
+Frames are Poisson draws of an EELS-like (KURO: zero-loss peak, plasmon and edge background) or CL-like (ProEM: broad
+emission bands) spectrum spread over a vertical beam profile, with mean counts proportional to the exposure. A few
+noisy frames are drawn once per layout and cycled, so generating data costs little more than copying it. Frames come
+every exposure + readout_time seconds, or at frame_rate frames per second if it is set.
+"""
+
+LOGGERFUNC = CFUNCTYPE(None, c_char_p, c_bool)
+DATALOCKFUNC = CFUNCTYPE(c_void_p, c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int))
+DATAUNLOCKFUNC = CFUNCTYPE(None, c_int, c_bool)
+SPIMLOCKFUNC = CFUNCTYPE(c_void_p, c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int))
+SPIMUNLOCKFUNC = CFUNCTYPE(None, c_int, c_bool, c_bool)
+SPECTLOCKFUNC = CFUNCTYPE(c_void_p, c_int, POINTER(c_int), POINTER(c_int))
+SPECTUNLOCKFUNC = CFUNCTYPE(None, c_int, c_bool)
+SPIMUPDATEFUNC = CFUNCTYPE(None, c_int, c_bool)
+CONNECTIONFUNC = CFUNCTYPE(None, c_bool, c_bool)
+
+ORSAY_TYPES = {2: c_int16, 3: c_int32, 6: c_uint16, 7: c_uint32, 11: c_float, 12: c_double}
+
+SPIMSTOPPED, SPIMRUNNING, SPIMPAUSED, SPIMSTOPEOL, SPIMSTOPEOF, SPIMONLINE = range(6)
+
+MODELS = {
+    # model prefix: (ccd size, readout time (s), pixel times (ns), port names, counts per pixel and second)
+    "KURO": ((2048, 512), 0.001, (10., 20.), ("Normal",), 2e4),
+    "ProEM": ((1600, 200), 0.005, (100., 1000.), ("Electron Multiplied", "Normal"), 5e3),
+}
+
+
+def buffer_as_array(pointer, orsay_type, shape):
+    """
+    numpy view of count values of the Orsay type at pointer, as given by a locker.
+    """
+    ctype = ORSAY_TYPES[orsay_type % 100]
+    return numpy.ctypeslib.as_array(cast(pointer, POINTER(ctype)), shape)
+
+
+class orsayCamera(object):
+    """
+    Simulated orsay camera. Extra attributes: frame_rate (None follows exposure and readout time), readout_time and
+    counts (mean counts per pixel per second at the spectrum maximum).
+    """
+
+    def __init__(self, manufacturer, model, sn, simul, frame_rate=None, seed=None):
+        self.manufacturer = manufacturer
+        self.model = model
+        key = "ProEM" if model.find("ProEM") >= 0 else "KURO"
+        self.__ccd_size, self.readout_time, self.__pixel_times, self.__ports, self.counts = MODELS[key]
+        self.__is_cl = key == "ProEM"
+        self.frame_rate = frame_rate
+        self.messagesevent = threading.Event()
+        self.dataevent = threading.Event()
+        self.__rng = numpy.random.default_rng(seed)
+        self.__frames = dict()
+
+        self.__data_locker = None
+        self.__data_unlocker = None
+        self.__spim_locker = None
+        self.__spim_unlocker = None
+        self.__spectrum_locker = None
+        self.__spectrum_unlocker = None
+
+        self.__binning = (1, 1)
+        self.__area = (0, 0, self.__ccd_size[1], self.__ccd_size[0])
+        self.__overscan = (0, 0)
+        self.__mirror = False
+        self.__accumulation = 10
+        self.__exposure = 0.01
+        self.__port = 0
+        self.__speed = 0
+        self.__gain = 0
+        self.__multiplication = 1
+        self.__temperature = -50.
+        self.__target_temperature = -50.
+        self.__fan = False
+        self.__turbo = (False, 0, 0)
+        self.__video_threshold = 0
+        self.__exposure_mode = (0, 0)
+
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__mode = "idle"
+        self.__spim_mode = SPIMRUNNING
+        self.__frame_count = 0
+        self.__frames_per_second = 0.
+        self.__current_spectrum = 0
+        self.__total_spectra = 0
+        self.setAccumulationNumber(10)
+
+    def close(self):
+        self.stopFocus()
+        self.stopSpim(True)
+
+    def registerLogger(self, fn):
+        pass
+
+    def addConnectionListener(self, fn):
+        pass
+
+    @property
+    def simulation_mode(self) -> bool:
+        return True
+
+    def getImageSize(self) -> int:
+        top, left, bottom, right = self.__area
+        return (right - left + self.__overscan[0]) // self.__binning[0], (bottom - top) // self.__binning[1]
+
+    def getCCDSize(self) -> (int, int):
+        return self.__ccd_size
+
+    def registerDataLocker(self, fn):
+        self.__data_locker = fn
+
+    def registerDataUnlocker(self, fn):
+        self.__data_unlocker = fn
+
+    def registerSpimDataLocker(self, fn):
+        self.__spim_locker = fn
+
+    def registerSpimDataUnlocker(self, fn):
+        self.__spim_unlocker = fn
+
+    def registerSpectrumDataLocker(self, fn):
+        self.__spectrum_locker = fn
+
+    def registerSpectrumDataUnlocker(self, fn):
+        self.__spectrum_unlocker = fn
+
+    def setCCDOverscan(self, sx, sy):
+        self.__overscan = (sx, sy)
+
+    def displayOverscan(self, displayed):
+        pass
+
+    def getBinning(self):
+        return self.__binning
+
+    def setBinning(self, bx, by):
+        self.__binning = (max(1, int(bx)), max(1, int(by)))
+
+    def setMirror(self, mirror):
+        self.__mirror = bool(mirror)
+
+    def setAccumulationNumber(self, count):
+        self.__accumulation = max(1, int(count))
+
+    def getAccumulateNumber(self):
+        return self.__accumulation
+
+    def setSpimMode(self, mode):
+        self.__spim_mode = mode
+
+    def startSpim(self, nbspectra, nbspectraperpixel, dwelltime, is2D):
+        self.__start(self.__run_spim, int(nbspectra), max(1, int(nbspectraperpixel)), float(dwelltime), bool(is2D))
+
+    def pauseSpim(self):
+        self.__spim_mode = SPIMPAUSED
+
+    def resumeSpim(self, mode):
+        self.__spim_mode = mode
+
+    def stopSpim(self, immediate):
+        if self.__mode == "Spectrum imaging":
+            self.__halt()
+        return True
+
+    def isCameraThere(self):
+        return True
+
+    def getTemperature(self):
+        return self.__temperature, self.__temperature == self.__target_temperature
+
+    def setTemperature(self, temperature):
+        self.__target_temperature = self.__temperature = temperature
+
+    def setupBinning(self):
+        pass
+
+    def startFocus(self, exposure, displaymode, accumulate):
+        self.__exposure = exposure
+        self.__start(self.__run_focus, bool(accumulate))
+        return True
+
+    def stopFocus(self):
+        if self.__mode in ("focus", "cumul"):
+            self.__halt()
+        return True
+
+    def setExposureTime(self, exposure):
+        self.__exposure = exposure
+        return True
+
+    def getNumofSpeeds(self, cameraport):
+        return len(self.__pixel_times)
+
+    def getSpeeds(self, cameraport):
+        speeds = list()
+        for s in range(self.getNumofSpeeds(cameraport)):
+            pixeltime = self.getPixelTime(cameraport, s)
+            speed = 1000 / pixeltime
+            if speed < 1:
+                speeds.append(str(1000000 / pixeltime) + " KHz")
+            else:
+                speeds.append(str(speed) + " MHz")
+        return speeds
+
+    def getCurrentSpeed(self, cameraport):
+        return self.__speed if isinstance(cameraport, int) else 0
+
+    def getAllPortsParams(self):
+        allportsparams = ()
+        for p in range(self.getNumofPorts()):
+            gains = tuple((self.getGainName(p, g), self.getGain(p)) for g in range(self.getNumofGains(p)))
+            allportsparams = allportsparams + ((self.getPortName(p), tuple(self.getSpeeds(p)), gains),)
+        return allportsparams
+
+    def setSpeed(self, cameraport, speed):
+        self.__speed = speed
+        return True
+
+    def getNumofGains(self, cameraport):
+        return 3
+
+    def getGains(self, cameraport):
+        return [self.getGainName(cameraport, g) for g in range(self.getNumofGains(cameraport))]
+
+    def getGain(self, cameraport):
+        return self.__gain
+
+    def getGainName(self, cameraport, gain):
+        return ("Low", "Medium", "High")[gain]
+
+    def setGain(self, gain):
+        self.__gain = gain
+        return True
+
+    def getReadoutTime(self):
+        return self.readout_time
+
+    def getNumofPorts(self):
+        return len(self.__ports)
+
+    def getPortName(self, portnb):
+        return self.__ports[portnb]
+
+    def getPortNames(self):
+        return tuple(self.__ports)
+
+    def getCurrentPort(self):
+        return self.__port
+
+    def setCurrentPort(self, cameraport):
+        if isinstance(cameraport, int):
+            self.__port = cameraport
+            return True
+        print("cameraport not an integer")
+        return False
+
+    def getMultiplication(self):
+        return self.__multiplication, 1, 1000 if self.__is_cl else 1
+
+    def setMultiplication(self, multiplication):
+        self.__multiplication = multiplication
+
+    def getCCDStatus(self) -> dict():
+        status = {"mode": self.__mode}
+        if self.__mode == "idle":
+            status["actual temp"] = self.__temperature
+            status["target temp"] = self.__target_temperature
+        elif self.__mode == "focus":
+            status["frames/seconds"] = self.__frames_per_second
+        elif self.__mode == "cumul":
+            status["accumulation_count"] = self.__frame_count
+        elif self.__mode == "Spectrum imaging":
+            status["current spectrum"] = self.__current_spectrum
+            status["total spectra"] = self.__total_spectra
+        return status
+
+    def getReadoutSpeed(self):
+        return 1. / self.__frame_period()
+
+    def getPixelTime(self, cameraport, speed):
+        return self.__pixel_times[speed]
+
+    def adjustOverscan(self, sizex, sizey):
+        self.__overscan = (sizex, sizey)
+
+    def setTurboMode(self, active, sizex, sizey):
+        self.__turbo = (active, sizex, sizey)
+
+    def getTurboMode(self):
+        return self.__turbo
+
+    def setExposureMode(self, mode, edge):
+        self.__exposure_mode = (mode, edge)
+        return True
+
+    def getExposureMode(self):
+        return self.__exposure_mode
+
+    def setPulseMode(self, mode):
+        return True
+
+    def setVerticalShift(self, shift, clear):
+        return True
+
+    def setFan(self, On_Off: bool):
+        self.__fan = On_Off
+        return True
+
+    def getFan(self):
+        return self.__fan
+
+    def setArea(self, area: tuple):
+        self.__area = tuple(area)
+        return True
+
+    def getArea(self):
+        return self.__area
+
+    def setVideoThreshold(self, threshold):
+        self.__video_threshold = threshold
+
+    def getVideoThreshold(self):
+        return self.__video_threshold
+
+    def __spectrum(self, width):
+        x = numpy.linspace(0., 1., width)
+        if self.__is_cl:
+            spectrum = numpy.exp(-0.5 * ((x - 0.35) / 0.05) ** 2) + 0.6 * numpy.exp(-0.5 * ((x - 0.6) / 0.1) ** 2)
+        else:
+            spectrum = numpy.exp(-0.5 * ((x - 0.1) / 0.005) ** 2) + 0.05 * numpy.exp(-0.5 * ((x - 0.2) / 0.02) ** 2) + \
+                       0.01 * numpy.exp(-(x - 0.1).clip(0) / 0.3) * (1 + (x > 0.55))
+        if self.__mirror:
+            spectrum = spectrum[::-1]
+        return spectrum / spectrum.max()
+
+    def __get_frames(self, shape, exposure, number=4):
+        """
+        A few noisy frames of shape (rows, width), cached by shape and exposure. Rows of 1 are full vertical binning.
+        """
+        key = (shape, exposure, self.__mirror)
+        if key not in self.__frames:
+            rows, width = shape
+            y = numpy.linspace(-1., 1., self.__ccd_size[1] if rows == 1 else rows)
+            profile = numpy.exp(-0.5 * (y / 0.2) ** 2)
+            profile = profile.sum(keepdims=True) if rows == 1 else profile
+            mean = numpy.outer(profile, self.__spectrum(width)) * self.counts * exposure * \
+                   self.__binning[0] * self.__binning[1]
+            self.__frames = {key: [self.__rng.poisson(mean).astype(numpy.float32) for _ in range(number)]}
+        return self.__frames[key]
+
+    def __frame_period(self):
+        if self.frame_rate:
+            return 1. / self.frame_rate
+        return self.__exposure + self.readout_time
+
+    def __start(self, target, *args):
+        self.__halt()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=target, args=args, daemon=True)
+        self.__thread.start()
+
+    def __halt(self):
+        self.__stop.set()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+        self.__mode = "idle"
+
+    def __lock(self, locker, *sizes):
+        data_type = c_int()
+        values = [c_int() for _ in sizes]
+        pointer = locker(0, byref(data_type), *[byref(value) for value in values])
+        return pointer, data_type.value, [value.value for value in values]
+
+    def __run_focus(self, accumulate):
+        self.__mode = "cumul" if accumulate else "focus"
+        self.__frame_count = 0
+        cumul = None
+        start = time.perf_counter()
+        while not self.__stop.is_set():
+            period = self.__frame_period()
+            if self.__data_locker is not None:
+                pointer, data_type, (sx, sy, sz) = self.__lock(self.__data_locker, 1, 2, 3)
+                if pointer:
+                    frames = self.__get_frames((sy, sx), self.__exposure)
+                    frame = frames[self.__frame_count % len(frames)]
+                    if accumulate:
+                        cumul = frame.copy() if cumul is None or cumul.shape != frame.shape else cumul + frame
+                        frame = cumul
+                    buffer_as_array(pointer, data_type, (sy, sx))[:] = frame
+                if self.__data_unlocker is not None:
+                    self.__data_unlocker(0, bool(pointer))
+            self.__frame_count += 1
+            now = time.perf_counter()
+            self.__frames_per_second = self.__frame_count / max(now - start, 1e-9)
+            delay = start + self.__frame_count * period - now
+            if delay > 0: self.__stop.wait(delay)
+
+    def __run_spim(self, nbspectra, nbspectraperpixel, dwelltime, is2D):
+        self.__mode = "Spectrum imaging"
+        self.__total_spectra = nbspectra
+        self.__current_spectrum = 0
+        start = time.perf_counter()
+        count = 0
+        running = True
+        while running and not self.__stop.is_set():
+            if self.__spim_mode == SPIMPAUSED:
+                self.__stop.wait(0.01)
+                start = time.perf_counter() - count * dwelltime
+                continue
+            index = self.__current_spectrum
+            if self.__spim_locker is not None:
+                pointer, data_type, (sx, sy, sz) = self.__lock(self.__spim_locker, 1, 2, 3)
+                if pointer:
+                    if is2D:
+                        frames = self.__get_frames((sy, sx), dwelltime * nbspectraperpixel)
+                        buffer_as_array(pointer, data_type, (sz, sy, sx))[index % sz] = frames[count % len(frames)]
+                    else:
+                        frames = self.__get_frames((1, sx), dwelltime * nbspectraperpixel)
+                        buffer_as_array(pointer, data_type, (sz * sy, sx))[index % (sz * sy)] = \
+                            frames[count % len(frames)][0]
+            if self.__spectrum_locker is not None:
+                pointer, data_type, (sx,) = self.__lock(self.__spectrum_locker, 1)
+                if pointer:
+                    frames = self.__get_frames((1, sx), dwelltime * nbspectraperpixel)
+                    buffer_as_array(pointer, data_type, (sx,))[:] = frames[count % len(frames)][0]
+                if self.__spectrum_unlocker is not None:
+                    self.__spectrum_unlocker(0, bool(pointer))
+            count += 1
+            self.__current_spectrum = (index + 1) % nbspectra
+            end_of_frame = self.__current_spectrum == 0
+            running = not (self.__spim_mode == SPIMSTOPPED or
+                           (end_of_frame and self.__spim_mode in (SPIMSTOPEOL, SPIMSTOPEOF)))
+            if self.__spim_unlocker is not None:
+                self.__spim_unlocker(0, True, running)
+            delay = start + count * dwelltime * nbspectraperpixel - time.perf_counter()
+            if delay > 0: self.__stop.wait(delay)
+        self.__mode = "idle"
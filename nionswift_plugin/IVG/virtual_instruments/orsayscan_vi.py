@@ -0,0 +1,393 @@
+import collections
+import logging
+import threading
+import time
+import numpy
+from ctypes import CFUNCTYPE, POINTER, byref, cast
+from ctypes import c_int, c_bool, c_void_p, c_int16, c_int32, c_uint16, c_uint32, c_float, c_double
+
+__author__ = "Yves Auad"
+
+"""
+Pure python stand-in for orsayscan.orsayScan (Scan.dll), used when the scan library or the scan box is not there.
+
+As with the DLL, the generator 1 (imaging) object owns the scan unit and the generator 2 (spim) object is built on it
+(orsayScan(2, imaging.orsayscan)). Callbacks are registered on the unit and called from its timing thread: lines are
+scanned at pixelTime per pixel plus the flyback time per line (times linesaveraging), and every block of lines of about
+BLOCK_TIME is written in the buffer given by the locker and notified with unlockerA(gene, True, image number, rect),
+rect being x, y, width and height of the block. Only the image area (subscan) is scanned. Spim is scanned once,
+pixelTime (or clock_simulation_time, standing for the camera clock) per pixel.
+
+Inputs 1 and 0 give a HAADF and a bright field image of a simulated crystal with a few particles, in physical units so
+field of view and rotation behave as on the microscope. Noise goes down with the pixel time and the PMT voltage sets
+the gain. Written blocks are kept in ScanUnit.block_times for latency measurements.
+"""
+
+LOCKERFUNC = CFUNCTYPE(c_void_p, c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int))
+UNLOCKERFUNC = CFUNCTYPE(None, c_int, c_bool)
+UNLOCKERFUNCA = CFUNCTYPE(None, c_int, c_int, c_int, POINTER(c_int))
+
+EELS_SCAN_CLOCK = 2
+CL_SCAN_CLOCK = 4
+
+ORSAY_TYPES = {2: c_int16, 3: c_int32, 6: c_uint16, 7: c_uint32, 11: c_float, 12: c_double}
+BLOCK_TIME = 0.02  # s
+LATTICE_NM = 0.4
+PARTICLES = ((-300., 200., 250.), (500., -400., 150.), (100., 900., 80.))  # x, y and radius in nm.
+
+
+class ScanUnit:
+    """
+    State shared by the generators of a scan box: callbacks, detectors, lines and the timing thread.
+    """
+
+    def __init__(self):
+        self.locker = None
+        self.unlocker = None
+        self.unlockerA = None
+        self.pmt = [2200., 2200.]
+        self.rotation = 0.
+        self.field_size = 4e-6
+        self.probe = (0, 0)
+        self.image_size = (512, 512)
+        self.tdc_lines = dict()
+        self.blanking = dict()
+        self.vsm = 0.
+        self.scan_count = 0
+        self.block_times = collections.deque(maxlen=100000)  # (image number, first row, perf_counter time) written.
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stop_at_end = False
+        self.rng = numpy.random.default_rng()
+
+    def signal(self, input, y, x, pixel_time, averaging=1):
+        """
+        Detector input for the pixels at rows y and columns x (1D arrays, full image pixel coordinates).
+        """
+        size, angle = self.image_size, numpy.radians(self.rotation)
+        scale = self.field_size * 1e9 / max(size)
+        yy, xx = numpy.meshgrid((y - size[1] / 2.) * scale, (x - size[0] / 2.) * scale, indexing='ij')
+        u = xx * numpy.cos(angle) - yy * numpy.sin(angle)
+        v = xx * numpy.sin(angle) + yy * numpy.cos(angle)
+        haadf = 0.2 + 0.3 * ((1 + numpy.cos(2 * numpy.pi * u / LATTICE_NM)) *
+                             (1 + numpy.cos(2 * numpy.pi * v / LATTICE_NM)) / 4) ** 4
+        for px, py, radius in PARTICLES:
+            haadf = haadf + 0.5 * ((u - px) ** 2 + (v - py) ** 2 < radius ** 2)
+        value = haadf if input == 1 else 1.2 - haadf
+        counts = max(pixel_time * averaging * 1e7, 1.)  # Detected electrons per pixel.
+        value = self.rng.poisson(value * counts) / counts
+        gain = 5000. * (self.pmt[input] / 2200.) ** 4 if input < len(self.pmt) else 5000.
+        return (value * gain).clip(-32768, 32767)
+
+    def start(self, target, *args):
+        self.halt()
+        self.stop_event.clear()
+        self.stop_at_end = False
+        self.thread = threading.Thread(target=target, args=args, daemon=True)
+        self.thread.start()
+
+    def halt(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def write(self, gene, imagenb, inputs, rows, columns, values):
+        """
+        Locks the buffer, writes values (input, rows, columns) and unlocks it.
+        """
+        if self.locker is None:
+            return
+        data_type, sx, sy, sz = c_int(), c_int(), c_int(), c_int()
+        pointer = self.locker(gene, byref(data_type), byref(sx), byref(sy), byref(sz))
+        if pointer:
+            shape = (sz.value, sy.value, sx.value)
+            buffer = numpy.ctypeslib.as_array(cast(pointer, POINTER(ORSAY_TYPES[data_type.value])), shape)
+            for channel in range(min(len(inputs), sz.value)):
+                buffer[channel, rows.start:rows.stop, columns.start:columns.stop] = values[channel]
+        self.block_times.append((imagenb, rows.start, time.perf_counter()))
+        if self.unlockerA is not None:
+            rect = (c_int * 4)(columns.start, rows.start, columns.stop - columns.start, rows.stop - rows.start)
+            self.unlockerA(gene, bool(pointer), imagenb, rect)
+        if self.unlocker is not None:
+            self.unlocker(gene, bool(pointer))
+
+    def run_imaging(self, generator, averaging):
+        size, startx, endx, starty, endy = generator.area()
+        self.image_size = size
+        line_time = (size[0] * generator.pixelTime + generator.flyback) * averaging
+        lines_per_block = max(1, int(BLOCK_TIME / line_time))
+        imagenb = 0
+        start = time.perf_counter()
+        lines = 0
+        while not self.stop_event.is_set():
+            imagenb += 1
+            for first in range(starty, endy, lines_per_block):
+                rows = range(first, min(first + lines_per_block, endy))
+                lines += len(rows)
+                delay = start + lines * line_time - time.perf_counter()
+                if delay > 0 and self.stop_event.wait(delay):
+                    return
+                values = [self.signal(input, numpy.arange(rows.start, rows.stop), numpy.arange(startx, endx),
+                                      generator.pixelTime, averaging) for input in generator.inputs]
+                self.write(generator.gene, imagenb, generator.inputs, rows, range(startx, endx), values)
+            self.scan_count += 1
+            if self.stop_at_end:
+                break
+
+    def run_spim(self, generator, averaging):
+        size, startx, endx, starty, endy = generator.area()
+        self.image_size = (endx - startx, endy - starty)
+        pixel_time = generator.clock_simulation_time or generator.pixelTime
+        line_time = size[0] * pixel_time * averaging + generator.flyback
+        start = time.perf_counter()
+        for line in range(size[1]):
+            delay = start + (line + 1) * line_time - time.perf_counter()
+            if delay > 0 and self.stop_event.wait(delay):
+                return
+            self.probe = (size[0] - 1, line)
+            values = [self.signal(input, numpy.arange(line, line + 1), numpy.arange(size[0]), pixel_time, averaging)
+                      for input in generator.inputs]
+            self.write(generator.gene, 1, generator.inputs, range(line, line + 1), range(0, size[0]), values)
+        self.scan_count += 1
+        logging.info('***SCAN***: Simulated spim finished.')
+
+
+class orsayScan(object):
+    """
+    Simulated orsay scan generator (1 for imaging, 2 for spim).
+    """
+
+    def __init__(self, gene, scandllobject=0, vg=False):
+        self.gene = gene
+        self.orsayscan = scandllobject if gene > 1 and scandllobject else ScanUnit()
+        self._product = 0
+        self._revision = 0
+        self._serialnumber = 0
+        self._major = 5
+        self._minor = 0
+        self.inputs = [1, 0]
+        self.pixelTime = 1e-6
+        self.flyback = 0.
+        self.clock_simulation_time = 0.
+        self.__image_area = (512, 512, 0, 512, 0, 512)
+        self.__scan_clock = 0
+        self.__video_offsets = dict()
+        self.__eht = 100.
+        self.__drift_tube = {"offset": 0.0, "gain": 1.0 / 10.0, "range": {"min": -10.0, "max": 10.0}, "value": 0.0}
+        self.drift_tube_calibration = {"offset": 0.002, "gain": 1.0 / 5.005}
+
+    def close(self):
+        self.orsayscan.halt()
+
+    def area(self):
+        sizex, sizey, startx, endx, starty, endy = self.__image_area
+        return (sizex, sizey), startx, endx, starty, endy
+
+    def getInputsCount(self) -> int:
+        return len(self.inputs)
+
+    def getInputProperties(self, input: int) -> (int, float, str, int):
+        return True, self.__video_offsets.get(input, 0.), ("BF", "HAADF")[input] if input < 2 else "In" + str(input), \
+               input
+
+    def setInputProperties(self, input: int, unipolar: bool, offset: float) -> bool:
+        self.__video_offsets[input] = offset
+        return True
+
+    def GetImageTime(self) -> float:
+        sizex, sizey, startx, endx, starty, endy = self.__image_area
+        return (sizex * self.pixelTime + self.flyback) * (endy - starty)
+
+    def SetInputs(self, inputs: []) -> bool:
+        self.inputs = list(inputs)
+        return True
+
+    def GetInputs(self) -> (int, []):
+        return len(self.inputs), list(self.inputs)
+
+    def setImageSize(self, sizex: int, sizey: int) -> bool:
+        self.__image_area = (sizex, sizey, 0, sizex, 0, sizey)
+        return True
+
+    def getImageSize(self) -> (int, int):
+        return self.__image_area[0], self.__image_area[1]
+
+    def setImageArea(self, sizex: int, sizey: int, startx: int, endx: int, starty: int, endy: int) -> bool:
+        startx, starty = max(0, startx), max(0, starty)
+        self.__image_area = (sizex, sizey, startx, max(startx, min(endx, sizex)), starty, max(starty, min(endy, sizey)))
+        return True
+
+    def getImageArea(self) -> (bool, int, int, int, int, int, int):
+        return (True,) + tuple(self.__image_area)
+
+    def registerLocker(self, fn):
+        self.orsayscan.locker = fn
+
+    def registerUnlocker(self, fn):
+        self.orsayscan.unlocker = fn
+
+    def registerUnlockerA(self, fn):
+        self.orsayscan.unlockerA = fn
+
+    def startSpim(self, mode: int, linesaveraging: int, Nspectra=1, save2D=False) -> bool:
+        self.orsayscan.start(self.orsayscan.run_spim, self, max(1, linesaveraging))
+        return True
+
+    def setScanClock(self, trigger_input=0) -> bool:
+        self.__scan_clock = trigger_input
+        return True
+
+    def startImaging(self, mode: int, linesaveraging: int) -> bool:
+        self.orsayscan.start(self.orsayscan.run_imaging, self, max(1, linesaveraging))
+        return True
+
+    def stopImaging(self, cancel: bool) -> bool:
+        if cancel:
+            self.orsayscan.halt()
+        else:
+            self.orsayscan.stop_at_end = True
+        return True
+
+    def getScanCount(self) -> int:
+        return self.orsayscan.scan_count
+
+    def setScanRotation(self, angle: float):
+        self.orsayscan.rotation = angle
+
+    def getScanRotation(self) -> float:
+        return self.orsayscan.rotation
+
+    def setScanScale(self, plug, xamp: float, yamp: float):
+        pass
+
+    def getImagingKind(self) -> int:
+        return 0
+
+    def setVideoOffset(self, inp: int, offset: float):
+        self.__video_offsets[inp] = offset
+
+    def getVideoOffset(self, inp: int) -> float:
+        return self.__video_offsets.get(inp, 0.)
+
+    def SetProbeAt(self, px: int, py: int):
+        if not self.orsayscan.is_running():
+            self.orsayscan.probe = (px, py)
+        return True
+
+    def SetEHT(self, val):
+        self.__eht = val
+
+    def GetEHT(self):
+        return self.__eht
+
+    def GetMaxFieldSize(self):
+        return 72e-6
+
+    def GetFieldSize(self):
+        return self.orsayscan.field_size
+
+    def GetScanAngle(self, mirror):
+        return self.orsayscan.rotation
+
+    def SetFieldSize(self, field):
+        self.orsayscan.field_size = min(field, self.GetMaxFieldSize())
+        return True
+
+    def SetBottomBlanking(self, mode, source, beamontime=0, risingedge=True, nbpulses=0, delay=0):
+        self.orsayscan.blanking["bottom"] = (mode, source, beamontime, risingedge, nbpulses, delay)
+        return True
+
+    def SetTopBlanking(self, mode, source, beamontime=0, risingedge=True, nbpulses=0, delay=0):
+        self.orsayscan.blanking["top"] = (mode, source, beamontime, risingedge, nbpulses, delay)
+        return True
+
+    def SetTdcLine(self, line, mode, source, period=0.004, on_time=0.000005, rising_edge=False, nb_pulses=0, delay=0,
+                   filtered=False):
+        self.orsayscan.tdc_lines[line] = {"mode": mode, "source": source, "period": period, "on_time": on_time,
+                                          "rising_edge": rising_edge, "nb_pulses": nb_pulses, "delay": delay,
+                                          "filtered": filtered}
+        return True
+
+    def SetCameraSync(self, eels, divider, width, risingedge):
+        return True
+
+    def ObjectiveStigmateur(self, x, y):
+        pass
+
+    def ObjectiveStigmateurCentre(self, xcx, xcy, ycx, ycy):
+        pass
+
+    def CondensorStigmateur(self, x, y):
+        pass
+
+    def Grigson(self, x1, x2, y1, y2):
+        pass
+
+    def AlObjective(self, x1, x2, y1, y2):
+        pass
+
+    def AlGun(self, x1, x2, y1, y2):
+        pass
+
+    def AlStigObjective(self, x1, x2, y1, y2):
+        pass
+
+    def SetLaser(self, frequency, nbpulses, bottomblanking, sync):
+        pass
+
+    def StartLaser(self, mode, source=-1):
+        pass
+
+    def CancelLaser(self):
+        pass
+
+    def GetLaserCount(self):
+        return 0
+
+    def GetPMT(self, index):
+        return self.orsayscan.pmt[index]
+
+    def SetPMT(self, index, value):
+        self.orsayscan.pmt[index] = value
+
+    def GetVSM(self):
+        return self.orsayscan.vsm
+
+    def CountPMTs(self):
+        return len(self.orsayscan.pmt)
+
+    def GetPMTLimits(self, index, vmin, vmax):
+        return True
+
+    def SetFlybackTime(self, flyback: float) -> float:
+        self.flyback = flyback
+        return flyback
+
+    def GetFlybackTime(self) -> float:
+        return self.flyback
+
+    @property
+    def drift_tube_calibration(self) -> dict:
+        return [self.__drift_tube["offset"], self.__drift_tube["gain"]]
+
+    @drift_tube_calibration.setter
+    def drift_tube_calibration(self, calib: dict):
+        self.__drift_tube["offset"] = calib["offset"]
+        self.__drift_tube["gain"] = calib["gain"]
+        self.__drift_tube["range"]["min"] = -1 / self.__drift_tube["gain"] + self.__drift_tube["offset"]
+        self.__drift_tube["range"]["max"] = 1 / self.__drift_tube["gain"] + self.__drift_tube["offset"]
+        self.drift_tube = self.__drift_tube["value"]
+
+    @property
+    def drift_tube(self) -> float:
+        return self.__drift_tube["value"]
+
+    @drift_tube.setter
+    def drift_tube(self, value: float):
+        value = min(max(value, self.__drift_tube["range"]["min"]), self.__drift_tube["range"]["max"])
+        self.__drift_tube["value"] = value
+        self.orsayscan.vsm = 32767 * (value - self.__drift_tube["offset"]) * self.__drift_tube["gain"]
@@ -0,0 +1,237 @@
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+import numpy
+
+__author__ = "Yves Auad"
+
+"""
+Local stand-in for the TimePix3 data port (127.0.0.1:8088), used when TimePix3 is in simulation mode.
+
+As the real server, it reads the 16 configuration bytes sent by the client and then streams either jsonimage frames
+(Focus, Cumul and Chrono), 32-bit event indexes (mode 2, spim from scan) or time-resolved events (mode 8). Frame
+layout follows the configuration bytes: soft binning gives 1 line frames, bit depth is 16 or 32 bits. Frames are
+Poisson draws of a zero-loss peak over a background; events are drawn along the same spectrum while the simulated
+probe scans the spim pixels. In Chrono (modes 6 and 7) each frame is the whole chrono kept by the server, whose row
+frameNumber % accumulation number is the last spectrum.
+Time-resolved events simulate a pump-probe experiment: a TDC every tdc_period ns, sent as a record of pixel
+TIME_EVENT_TDC, and, after each, a loss peak whose energy decays with the delay on top of the static spectrum.
+
+A session received from a real server can be recorded with record_session and served again with replay_path, keeping
+the recorded pacing.
+"""
+
+WIDTH = 1024
+HEIGHT = 256
+CHANNELS = 1025
+TIME_EVENT_DTYPE = numpy.dtype([('pixel', '<u4'), ('toa', '<u8'), ('delta', '<u4')])
+TIME_EVENT_TDC = 0xffffffff
+TOA_TICK = 1.5625  # ns
+RECORD_HEADER = struct.Struct('<dI')  # Time since session start (s) and length of each recorded packet.
+
+
+def record_session(address, config_bytes, path, duration=10.0):
+    """
+    Connects to a TimePix3 data port, sends config_bytes and writes everything received during duration seconds in
+    path, each packet preceded by its time and length (RECORD_HEADER).
+    """
+    client = socket.create_connection(address)
+    client.sendall(config_bytes)
+    client.settimeout(0.1)
+    start = time.perf_counter()
+    with open(path, 'wb') as f:
+        f.write(config_bytes)
+        while time.perf_counter() - start < duration:
+            try:
+                data = client.recv(2 * 64000)
+            except socket.timeout:
+                continue
+            if not data: break
+            f.write(RECORD_HEADER.pack(time.perf_counter() - start, len(data)))
+            f.write(data)
+    client.close()
+
+
+class Tp3DataServer:
+    """
+    frame_rate is in frames per second (None streams as fast as possible), counts is the mean number of electrons per
+    frame and event_rate is the number of events per second in spim mode, with pixel_time (s) per scan pixel.
+    """
+
+    def __init__(self, port=8088, frame_rate=100., counts=20000, event_rate=5e6, pixel_time=1e-5,
+                 tdc_period=1000., replay_path=None, seed=None):
+        self.port = port
+        self.frame_rate = frame_rate
+        self.counts = counts
+        self.event_rate = event_rate
+        self.pixel_time = pixel_time
+        self.tdc_period = tdc_period
+        self.replay_path = replay_path
+        self.sent_bytes = 0
+        self.sent_frames = 0
+        self.sent_events = 0
+        self.__rng = numpy.random.default_rng(seed)
+        self.__server = None
+        self.__thread = None
+        self.__running = False
+        channels = numpy.arange(WIDTH)
+        self.spectrum = numpy.exp(-0.5 * ((channels - 100) / 4.) ** 2) + 0.02 * numpy.exp(-channels / 400.)
+        self.spectrum /= self.spectrum.sum()
+
+    def start(self):
+        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server.bind(('127.0.0.1', self.port))
+        self.__server.listen(1)
+        self.__server.settimeout(0.2)
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__serve, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__server is not None:
+            self.__server.close()
+
+    def __serve(self):
+        while self.__running:
+            try:
+                connection, _ = self.__server.accept()
+            except socket.timeout:
+                continue
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Frames are not held back by Nagle.
+            try:
+                config_bytes = self.__read_config(connection)
+                if self.replay_path is not None:
+                    self.__replay(connection)
+                elif config_bytes[3] == 2:
+                    self.__stream_events(connection, config_bytes)
+                elif config_bytes[3] == 8:
+                    self.__stream_time_events(connection)
+                else:
+                    self.__stream_frames(connection, config_bytes)
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                connection.close()
+
+    def __read_config(self, connection):
+        config_bytes = b''
+        while len(config_bytes) < 16:
+            data = connection.recv(16 - len(config_bytes))
+            if not data: raise ConnectionResetError
+            config_bytes += data
+        return config_bytes
+
+    def __frames(self, config_bytes, number=8):
+        """
+        A few payloads to cycle through, with the layout asked in the configuration bytes.
+        """
+        soft_binning, bit_depth, mode = config_bytes[0], config_bytes[1], config_bytes[3]
+        height = 1 if soft_binning else HEIGHT
+        dtype = numpy.dtype('<u4') if bit_depth == 2 or mode in (6, 7) else numpy.dtype('<u2')
+        row = self.spectrum if height == 1 else numpy.outer(numpy.exp(-0.5 * ((numpy.arange(HEIGHT) - 128) / 20.) ** 2),
+                                                            self.spectrum)
+        row = row / row.sum()
+        payloads = [self.__rng.poisson(row * self.counts).astype(dtype).tobytes() for _ in range(number)]
+        return payloads, dtype.itemsize * 8, height
+
+    def __stream_frames(self, connection, config_bytes):
+        payloads, bit_depth, height = self.__frames(config_bytes)
+        chrono = None
+        if config_bytes[3] in (6, 7):
+            rows = max(1, struct.unpack('>H', config_bytes[4:6])[0])
+            chrono = numpy.zeros((rows, WIDTH), dtype='<u4')
+            height = rows
+        start = time.perf_counter()
+        frame = 0
+        while self.__running:
+            if chrono is not None:
+                chrono[frame % rows] = self.__rng.poisson(self.spectrum * self.counts)
+                payload = chrono.tobytes()
+            else:
+                payload = payloads[frame % len(payloads)]
+            header = json.dumps({"timeAtFrame": time.time(), "frameNumber": frame, "measurementID": "null",
+                                 "dataSize": len(payload), "bitDepth": bit_depth, "width": WIDTH, "height": height},
+                                separators=(',', ':'))
+            connection.sendall(header.encode() + b'\n' + payload + b'\n')
+            self.sent_bytes += len(header) + len(payload) + 2
+            self.sent_frames += 1
+            frame += 1
+            if self.frame_rate:
+                delay = start + frame / self.frame_rate - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+
+    def __stream_events(self, connection, config_bytes):
+        x_size, y_size = struct.unpack('>HH', config_bytes[4:8])
+        pixels = x_size * y_size
+        cumulative = numpy.cumsum(self.spectrum)
+        period = 0.01  # Events are sent in packets of 10 ms.
+        pixels_per_packet = max(1, int(period / self.pixel_time))
+        events_per_pixel = self.event_rate * self.pixel_time
+        start = time.perf_counter()
+        pixel = 0
+        packet = 0
+        while self.__running:
+            positions = (pixel + numpy.arange(pixels_per_packet)) % pixels
+            counts = self.__rng.poisson(events_per_pixel, pixels_per_packet)
+            channels = numpy.searchsorted(cumulative, self.__rng.random(counts.sum()))
+            events = (numpy.repeat(positions, counts) * CHANNELS + channels).astype('<u4')
+            connection.sendall(events.tobytes())
+            self.sent_bytes += events.nbytes
+            self.sent_events += len(events)
+            pixel = (pixel + pixels_per_packet) % pixels
+            packet += 1
+            delay = start + packet * pixels_per_packet * self.pixel_time - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+
+    def __stream_time_events(self, connection):
+        cumulative = numpy.cumsum(self.spectrum)
+        period = 0.01
+        number = max(1, int(self.event_rate * period))
+        ticks_per_period = int(self.tdc_period / TOA_TICK)
+        ticks_per_packet = int(period * 1e9 / TOA_TICK)
+        start = time.perf_counter()
+        packet = 0
+        while self.__running:
+            first = packet * ticks_per_packet
+            tdcs = numpy.arange(-(-first // ticks_per_period), -(-(first + ticks_per_packet) // ticks_per_period),
+                                dtype=numpy.uint64) * ticks_per_period
+            toa = first + self.__rng.integers(0, ticks_per_packet, number)
+            delta = toa % ticks_per_period
+            channels = numpy.searchsorted(cumulative, self.__rng.random(number))
+            pumped = self.__rng.random(number) < 0.2
+            delay = delta[pumped] * TOA_TICK
+            channels[pumped] = numpy.clip(300 + 200 * numpy.exp(-delay / (self.tdc_period / 5)) +
+                                          self.__rng.normal(0, 5, pumped.sum()), 0, WIDTH - 1)
+            events = numpy.empty(number + len(tdcs), dtype=TIME_EVENT_DTYPE)
+            events['pixel'] = numpy.concatenate((channels, numpy.full(len(tdcs), TIME_EVENT_TDC)))
+            events['toa'] = numpy.concatenate((toa, tdcs))
+            events['delta'] = numpy.concatenate((delta, numpy.zeros(len(tdcs))))
+            events = events[numpy.argsort(events['toa'], kind='stable')]
+            connection.sendall(events.tobytes())
+            self.sent_bytes += events.nbytes
+            self.sent_events += number
+            packet += 1
+            delay = start + packet * period - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+
+    def __replay(self, connection):
+        start = time.perf_counter()
+        with open(self.replay_path, 'rb') as f:
+            f.read(16)
+            while self.__running:
+                record = f.read(RECORD_HEADER.size)
+                if len(record) < RECORD_HEADER.size: break
+                timestamp, length = RECORD_HEADER.unpack(record)
+                data = f.read(length)
+                delay = start + timestamp - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+                connection.sendall(data)
+                self.sent_bytes += length
+        logging.info(f'***TP3***: Replay of {self.replay_path} finished.')
@@ -1,9 +1,11 @@
-use cpython::{PyResult, Python, py_module_initializer, py_fn};
+use cpython::{PyResult, PyErr, PyObject, Python, py_module_initializer, py_fn, exc};
+use cpython::buffer::PyBuffer;
 
 py_module_initializer!(rust2swift, |py, m| {
     m.add(py, "__doc__", "This module is implemented in Rust.")?;
     m.add(py, "hello_swift", py_fn!(py, hello_swift_py()))?;
     m.add(py, "update_spim", py_fn!(py, update_spim_py(data: &[u8])))?;
+    m.add(py, "accumulate_spim", py_fn!(py, accumulate_spim_py(data: &[u8], spim: PyObject)))?;
     Ok(())
 });
 
@@ -33,4 +35,53 @@ fn update_spim_py(_: Python, data: &[u8]) -> PyResult<Vec<u32>> {
     Ok(out)
 }
 
+//Increments spim once for each event of data (little-endian u32 flat indexes, as sent by the data server), saturating
+//at u32::MAX. Returns the number of events outside spim.
+fn accumulate_spim(data: &[u8], spim: &mut [u32]) -> usize {
+    let mut lost = 0usize;
+    for event in data.chunks_exact(4) {
+        let index = u32::from_le_bytes([event[0], event[1], event[2], event[3]]) as usize;
+        match spim.get_mut(index) {
+            Some(bin) => *bin = bin.saturating_add(1),
+            None => lost += 1,
+        }
+    }
+    lost
+}
+
+//Adds the little-endian events of data into spim (a writable contiguous uint32 array) in place, without holding the
+//GIL. Returns the number of events outside spim.
+fn accumulate_spim_py(py: Python, data: &[u8], spim: PyObject) -> PyResult<usize> {
+    let spim_buffer = PyBuffer::get(py, &spim)?;
+    let (address, len) = match spim_buffer.as_mut_slice::<u32>(py) {
+        Some(slice) => (slice.as_ptr() as usize, slice.len()),
+        None => return Err(PyErr::new::<exc::ValueError, _>(py, "spim must be a writable contiguous uint32 array.")),
+    };
+    //spim_buffer keeps the array alive and its memory in place until the end of this function.
+    let lost = py.allow_threads(|| {
+        let spim_slice = unsafe { std::slice::from_raw_parts_mut(address as *mut u32, len) };
+        accumulate_spim(data, spim_slice)
+    });
+    Ok(lost)
+}
 
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn accumulate_spim_counts_little_endian_events() {
+        let mut spim = vec![0u32; 4];
+        let data: Vec<u8> = [1u32, 3, 1, 7].iter().flat_map(|event| event.to_le_bytes().to_vec()).collect();
+        assert_eq!(accumulate_spim(&data, &mut spim), 1);
+        assert_eq!(spim, vec![0, 2, 0, 1]);
+    }
+
+    #[test]
+    fn accumulate_spim_saturates() {
+        let mut spim = vec![u32::MAX - 1, 0];
+        let data: Vec<u8> = [0u32, 0, 0].iter().flat_map(|event| event.to_le_bytes().to_vec()).collect();
+        assert_eq!(accumulate_spim(&data, &mut spim), 0);
+        assert_eq!(spim, vec![u32::MAX, 0]);
+    }
+}
@@ -0,0 +1,13 @@
+"""Register the plugin packages without running their ``__init__`` so the
+pure-python modules can be imported without the hardware DLLs or config."""
+import os
+import sys
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nionswift_plugin')
+
+for name, path in [('nionswift_plugin', ROOT), ('nionswift_plugin.IVG', os.path.join(ROOT, 'IVG'))]:
+    if name not in sys.modules:
+        module = types.ModuleType(name)
+        module.__path__ = [path]
+        sys.modules[name] = module
@@ -0,0 +1,41 @@
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import ChronoBuffer
+
+
+def server_frames(height, frames, width=4):
+    """Chrono frames as sent by the server: row frame % height holds spectrum frame."""
+    chrono = numpy.zeros((height, width), dtype=numpy.float32)
+    for frame in range(frames):
+        chrono[frame % height] = frame
+        yield frame, chrono.copy()
+
+
+def test_single_line_ring_keeps_the_last_rows_in_order():
+    buffer = ChronoBuffer(3, 2)
+    for value in range(5):
+        buffer.push_frame(numpy.full((1, 2), value, dtype=numpy.float32), value)
+    assert buffer.ordered()[:, 0].tolist() == [2., 3., 4.]
+    assert buffer.last()[0] == 4.
+    assert buffer.count == 5
+
+
+def test_multi_row_frames_push_only_new_rows(tmp_path):
+    path = tmp_path / 'chrono.bin'
+    buffer = ChronoBuffer(5, 4, spill_path=str(path))
+    received = [frame for frame in server_frames(5, 23) if frame[0] % 3 != 2]  # Some frames are superseded.
+    for frame_number, image in received:
+        buffer.push_frame(image, frame_number)
+        assert buffer.last()[0] == frame_number
+    assert buffer.count == 23
+    assert buffer.ordered()[:, 0].tolist() == [18., 19., 20., 21., 22.]
+    assert buffer.read_spilled()[:, 0].tolist() == list(range(18))
+
+
+def test_frames_lost_beyond_the_server_chrono_are_skipped():
+    buffer = ChronoBuffer(4, 4)
+    frames = dict(server_frames(4, 12))
+    buffer.push_frame(frames[1], 1)
+    buffer.push_frame(frames[10], 10)
+    assert buffer.count == 6
+    assert buffer.ordered()[:, 0].tolist() == [7., 8., 9., 10.]
@@ -0,0 +1,64 @@
+import sys
+import time
+import types
+
+import numpy
+import pytest
+
+
+@pytest.fixture(scope='module')
+def averager_class():
+    # ivg_inst reads the installed instrument configuration; the averager does not need it.
+    instrument = types.ModuleType('nionswift_plugin.IVG.ivg_inst')
+    instrument.ivgInstrument = object
+    sys.modules.setdefault('nionswift_plugin.IVG.ivg_inst', instrument)
+    from nionswift_plugin.IVG.scan import VGScanYves
+    return VGScanYves.DriftCorrectedAverager
+
+
+def smooth_sample(size, seed=0):
+    rng = numpy.random.default_rng(seed)
+    fy, fx = numpy.fft.fftfreq(size)[:, None], numpy.fft.rfftfreq(size)[None, :]
+    image = numpy.fft.irfft2(numpy.fft.rfft2(rng.random((size, size))) * numpy.exp(-(fx ** 2 + fy ** 2) / 0.002),
+                             s=(size, size))
+    return (image - image.min()) / (image.max() - image.min())
+
+
+def add_and_wait(averager, images):
+    sequence = averager.sequence
+    spare = averager.add(images)
+    while averager.sequence == sequence:
+        time.sleep(0.001)
+    return spare
+
+
+def test_drift_is_tracked_and_corrected(averager_class):
+    size, margin, drift = 256, 16, (1, -2)
+    specimen = smooth_sample(size + 2 * margin)
+    rng = numpy.random.default_rng(1)
+    averager = averager_class(frames=8)
+    try:
+        for frame in range(8):
+            y, x = margin + drift[0] * frame, margin + drift[1] * frame
+            image = rng.poisson(50 * specimen[y:y + size, x:x + size]).astype(numpy.uint16)
+            add_and_wait(averager, [image])
+        assert averager.drift == pytest.approx((7., -14.), abs=1.5)
+        inside = (slice(margin, size - margin), slice(margin, size - margin))
+        truth = 50 * specimen[margin:margin + size, margin:margin + size]
+        assert numpy.std(averager.result(0)[inside] - truth[inside]) < numpy.std(image[inside] - truth[inside]) / 2
+    finally:
+        averager.shutdown()
+
+
+def test_sum_mode_is_a_true_sum_and_frames_are_not_copied(averager_class):
+    averager = averager_class(frames=4, mode='sum')
+    try:
+        frames = [numpy.full((32, 32), value, numpy.uint16) for value in (1, 2, 3)]
+        spare = add_and_wait(averager, [frames[0]])
+        assert spare[0].shape == frames[0].shape and spare[0].dtype == frames[0].dtype
+        assert add_and_wait(averager, [frames[1]])[0] is frames[0]
+        add_and_wait(averager, [frames[2]])
+        assert numpy.array_equal(averager.result(0), numpy.full((32, 32), 6.))
+        assert averager.count == 3
+    finally:
+        averager.shutdown()
@@ -0,0 +1,20 @@
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import FrameBufferPool
+
+
+def test_detached_arrays_are_never_handed_out_again():
+    pool = FrameBufferPool(depth=2)
+    first = pool.get(16, 8, 4)
+    second = pool.get(16, 8, 4)
+    assert pool.get(16, 8, 4) is first
+    assert pool.allocations == 2
+
+    first[:] = 7
+    assert pool.detach(first) is first
+    assert pool.allocations == 3
+    arrays = [pool.get(16, 8, 4) for _ in range(4)]
+    assert all(array is not first for array in arrays)
+    assert any(array is second for array in arrays)
+    assert (first == 7).all() and first.shape == (4, 8) and first.dtype == numpy.dtype('<u2')
+    assert pool.detach(first) is first and pool.allocations == 3
@@ -0,0 +1,67 @@
+import ctypes
+import sys
+import threading
+import types
+
+import numpy
+import pytest
+
+SHAPE = (64, 128)
+
+
+@pytest.fixture(scope='module')
+def ring_class():
+    # ivg_inst reads the installed instrument configuration; the ring does not need it.
+    instrument = types.ModuleType('nionswift_plugin.IVG.ivg_inst')
+    instrument.ivgInstrument = object
+    sys.modules.setdefault('nionswift_plugin.IVG.ivg_inst', instrument)
+    from nionswift_plugin.IVG.camera import VGCameraYves
+    return VGCameraYves.FrameBufferRing
+
+
+def write(ring, value):
+    index = ring.acquire_write()
+    pointer = ctypes.cast(ring.pointers[index], ctypes.POINTER(ctypes.c_float))
+    numpy.ctypeslib.as_array(pointer, SHAPE)[:] = value
+    ring.publish(index)
+
+
+def test_read_hands_the_buffer_over(ring_class):
+    ring = ring_class(SHAPE, count=2)
+    assert ring.read() is None
+    write(ring, 1)
+    image = ring.read()
+    assert ring.read() is None
+    for value in range(2, 10):
+        write(ring, value)
+    assert (image == 1).all()
+    assert all(buffer is not image for buffer in ring.buffers)
+    assert (ring.read() == 9).all()
+    assert ring.superseded == 7 and ring.allocations == 4
+
+
+def test_images_are_whole_frames_under_a_fast_writer(ring_class):
+    ring = ring_class(SHAPE)
+    running = True
+
+    def writer():
+        value = 0
+        while running:
+            value += 1
+            write(ring, value)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    images = list()
+    try:
+        while len(images) < 50:
+            image = ring.read()
+            if image is not None:
+                assert (image == image[0, 0]).all()
+                images.append((image, image[0, 0]))
+    finally:
+        running = False
+        thread.join()
+    assert all((image == value).all() for image, value in images)
+    values = [value for _, value in images]
+    assert values == sorted(set(values))
@@ -0,0 +1,41 @@
+import socket
+
+from nionswift_plugin.IVG.tp3.tp3func import FrameRingBuffer, JsonImageHeaderDecoder
+
+
+def header(frame, data_size=2048, width=1024, height=1, bit_depth=16):
+    return (f'{{"timeAtFrame":{frame * 0.1},"frameNumber":{frame},"measurementID":"m","dataSize":{data_size},'
+            f'"bitDepth":{bit_depth},"width":{width},"height":{height}}}').encode()
+
+
+def test_decoder_rejects_non_numeric_layouts():
+    decoder = JsonImageHeaderDecoder(bitDepth=16, width=1024)
+    record, valid = decoder.decode(header(1))
+    assert valid and record.dataSize == 2048 and record.frameNumber == 1
+    record, valid = decoder.decode(header(2))
+    assert valid and record.frameNumber == 2
+    for bad in [header(3).replace(b'"dataSize":2048', b'"dataSize":"x"'),
+                header(3).replace(b'"width":1024', b'"width":null'),
+                header(3).replace(b'"frameNumber":3', b'"frameNumber":"3a"'),
+                header(3).replace(b'"bitDepth":16', b'"bitDepth":\xff'),
+                b'{"timeAtFrame":garbage}']:
+        record, valid = decoder.decode(bad)
+        assert not valid
+    record, valid = decoder.decode(header(4))
+    assert valid and record.frameNumber == 4
+
+
+def test_ring_buffer_resyncs_on_the_next_header():
+    ring = FrameRingBuffer(64)
+    first, second = socket.socketpair()
+    try:
+        garbage = b'{"time' + b'x' * (2 * FrameRingBuffer.MAX_HEADER_SIZE)
+        first.sendall(garbage + header(7) + b'\n')
+        first.close()
+        found = None
+        while found is None:
+            assert ring.receive(second) > 0 or ring.available
+            found = ring.read_header()
+        assert bytes(found) == header(7)
+    finally:
+        second.close()
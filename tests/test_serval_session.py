@@ -0,0 +1,115 @@
+import asyncio
+
+from nionswift_plugin.IVG.tp3.tp3func import ServalSession
+
+
+def serve(handler, scenario):
+    async def main():
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        session = ServalSession(f'http://127.0.0.1:{port}', timeout=0.2)
+        try:
+            return await scenario(session, f'http://127.0.0.1:{port}')
+        finally:
+            await session.close()
+            server.close()
+    return asyncio.run(main())
+
+
+async def read_request(reader):
+    line = await reader.readline()
+    while line and (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    return line
+
+
+def reply(writer, body):
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+
+
+def test_late_reply_is_not_read_by_the_next_request():
+    count = 0
+
+    async def handler(reader, writer):
+        nonlocal count
+        while await read_request(reader):
+            count += 1
+            if count == 1:
+                await asyncio.sleep(0.5)
+            reply(writer, b'resp%d' % count)
+            await writer.drain()
+
+    async def scenario(session, url):
+        try:
+            await session.request('GET', url + '/dashboard')
+            assert False, 'first request should time out'
+        except asyncio.TimeoutError:
+            pass
+        return (await session.request('GET', url + '/dashboard')).text, session.connections
+
+    text, connections = serve(handler, scenario)
+    assert text == 'resp2'
+    assert connections == 2
+
+
+def test_malformed_and_cancelled_requests_reconnect():
+    async def handler(reader, writer):
+        while True:
+            line = await read_request(reader)
+            if not line:
+                break
+            if line.startswith(b'GET /bad'):
+                writer.write(b'garbage\r\n\r\n')
+            elif line.startswith(b'GET /slow'):
+                await asyncio.sleep(0.1)
+                reply(writer, b'slow')
+            else:
+                reply(writer, b'ok')
+            await writer.drain()
+
+    async def scenario(session, url):
+        try:
+            await session.request('GET', url + '/bad')
+            assert False, 'malformed status line should raise'
+        except (ValueError, IndexError):
+            pass
+        assert (await session.request('GET', url + '/dashboard')).text == 'ok'
+        task = asyncio.ensure_future(session.request('GET', url + '/slow'))
+        await asyncio.sleep(0.02)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return (await session.request('GET', url + '/dashboard')).text, session.connections
+
+    text, connections = serve(handler, scenario)
+    assert text == 'ok'
+    assert connections == 3
+
+
+def test_measurement_requests_are_not_resent():
+    paths = []
+
+    async def handler(reader, writer):
+        while True:
+            line = await read_request(reader)
+            if not line:
+                break
+            paths.append(line.split()[1])
+            if line.startswith(b'GET /measurement'):
+                break  # Drop the connection without answering.
+            reply(writer, b'ok')
+            await writer.drain()
+        writer.close()
+
+    async def scenario(session, url):
+        await session.request('GET', url + '/dashboard')
+        try:
+            await session.request('GET', url + '/measurement/start')
+            return 'sent'
+        except ConnectionError:
+            return 'failed'
+
+    assert serve(handler, scenario) == 'failed'
+    assert paths == [b'/dashboard', b'/measurement/start']
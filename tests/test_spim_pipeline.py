@@ -0,0 +1,77 @@
+import socket
+import threading
+import time
+
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import SpimAccumulator, SpimEventPipeline
+
+BINS = 4 * 5 * 1025
+
+
+def send(sock, events):
+    thread = threading.Thread(target=sock.sendall, args=(events.astype('<u4').tobytes(),))
+    thread.start()
+    return thread
+
+
+def receive(pipeline, sock, nbytes):
+    buffers = 0
+    while nbytes > 0:
+        received = pipeline.receive(sock)
+        nbytes -= received
+        buffers += 1
+    return buffers
+
+
+def wait_processed(pipeline, buffers):
+    deadline = time.monotonic() + 5.
+    while pipeline.metrics['processed_buffers'] < buffers and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_sharded_pipeline_counts_every_event():
+    rng = numpy.random.default_rng(0)
+    first, second = rng.integers(0, BINS, 50000), rng.integers(0, BINS, 30000)
+    accumulator = SpimAccumulator(numpy.zeros(BINS, dtype=numpy.uint32), backend='add_at')
+    pipeline = SpimEventPipeline(accumulator, workers=3, queue_depth=4, buffer_size=1024)
+    reader, writer = socket.socketpair()
+    try:
+        sender = send(writer, first)
+        buffers = receive(pipeline, reader, first.size * 4)
+        sender.join()
+        wait_processed(pipeline, buffers)
+        pipeline.reduce(1000, 9000)
+        expected = numpy.bincount(first, minlength=BINS)
+        assert numpy.array_equal(accumulator.data[1000:9000], expected[1000:9000])
+        assert not accumulator.data[:1000].any() and not accumulator.data[9000:].any()
+
+        sender = send(writer, second)
+        receive(pipeline, reader, second.size * 4)
+        sender.join()
+        pipeline.stop()
+    finally:
+        reader.close()
+        writer.close()
+    expected += numpy.bincount(second, minlength=BINS)
+    assert numpy.array_equal(accumulator.data, expected)
+    assert pipeline.metrics['received_bytes'] == (first.size + second.size) * 4
+    assert pipeline.metrics['saturated_bins'] == 0
+
+
+def test_reduce_saturates_at_the_spim_dtype():
+    events = numpy.full(70000, 7)
+    accumulator = SpimAccumulator(numpy.zeros(BINS, dtype=numpy.uint16), backend='bincount')
+    pipeline = SpimEventPipeline(accumulator, workers=2, queue_depth=8, buffer_size=4096)
+    reader, writer = socket.socketpair()
+    try:
+        sender = send(writer, events)
+        receive(pipeline, reader, events.size * 4)
+        sender.join()
+        pipeline.stop()
+    finally:
+        reader.close()
+        writer.close()
+    assert accumulator.data[7] == numpy.iinfo(numpy.uint16).max
+    assert accumulator.data.sum() == accumulator.data[7]
+    assert pipeline.metrics['saturated_bins'] >= 1
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import numpy
+
+from nionswift_plugin.IVG.tp3.tp3func import TIME_EVENT_DTYPE, TIME_EVENT_TDC, TimePix3, TimeResolvedHistogram
+
+
+def make_events(count, seed=0):
+    rng = numpy.random.default_rng(seed)
+    events = numpy.zeros(count, dtype=TIME_EVENT_DTYPE)
+    events['pixel'] = rng.integers(0, 1024 * 256, count)
+    events['toa'] = numpy.sort(rng.integers(0, 1 << 30, count))
+    events['delta'] = rng.integers(0, 1000, count)
+    events['pixel'][::50] = TIME_EVENT_TDC
+    return events
+
+
+def test_gate_is_the_same_with_and_without_kept_events():
+    events = make_events(20000)
+    kept = TimeResolvedHistogram(100, 10., 50., keep_events=True)
+    binned = TimeResolvedHistogram(100, 10., 50.)
+    kept.accumulate(events)
+    binned.accumulate(events)
+    assert kept.received_events == binned.received_events == 20000 - 400
+    for start, stop in [(50., 1050.), (123., 456.), (0., 60.), (300., 300.)]:
+        assert numpy.array_equal(kept.gate(start, stop), binned.gate(start, stop))
+    delay = events['delta'] * TimeResolvedHistogram.TICK
+    inside = (events['pixel'] != TIME_EVENT_TDC) & (delay >= 130.) & (delay < 450.)
+    expected = numpy.bincount(events['pixel'][inside] % 1024, minlength=1024)
+    assert numpy.array_equal(kept.gate(130., 450.), expected)
+
+
+def test_rebin_matches_a_direct_histogram():
+    events = make_events(5000, seed=1)
+    kept = TimeResolvedHistogram(10, 100., keep_events=True)
+    kept.accumulate(events)
+    direct = TimeResolvedHistogram(37, 7.5, 20.)
+    direct.accumulate(events)
+    assert numpy.array_equal(kept.rebin(37, 7.5, 20.).data, direct.data)
+
+
+def test_simulated_acquisition_accumulates_off_the_event_loop():
+    threads = []
+    camera = TimePix3('http://127.0.0.1:8080', True, lambda message: threads.append(threading.current_thread()))
+    assert camera.isTimeResolvedAvailable()
+    assert camera.startTimeResolved(0.01, '1d', 100)
+    time.sleep(0.5)
+    camera.stopFocus()
+    histogram = camera.get_time_resolved_histogram()
+    assert histogram.received_events > 0
+    assert histogram.data.sum() > 0
+    assert threads and camera._TimePix3__loopThread not in threads
@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+from nionswift_plugin.IVG.tp3.tp3func import TimePix3
+
+
+@pytest.fixture(scope='module')
+def camera():
+    return TimePix3('http://127.0.0.1:8080', True, lambda message: None)
+
+
+def test_status_listener_can_call_synchronous_methods(camera):
+    answered = threading.Event()
+    statuses = []
+
+    def listener(old_status, status):
+        statuses.append(camera.getCCDStatus())
+        answered.set()
+
+    listener_handle = camera.status_changed_event.listen(listener)
+    try:
+        camera.invalidate_status()
+        camera.getCCDStatus()
+        assert answered.wait(5.0)
+    finally:
+        listener_handle.close()
+    assert statuses == ['DA_IDLE']
+
+
+def test_synchronous_call_from_the_event_loop_raises(camera):
+    async def nested():
+        with pytest.raises(RuntimeError):
+            camera.getCCDStatus()
+        return await camera.getCCDStatusAsync()
+
+    assert camera.run_coroutine(nested()) == 'DA_IDLE'
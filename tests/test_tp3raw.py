@@ -0,0 +1,52 @@
+import numpy
+
+from nionswift_plugin.IVG.tp3 import tp3raw
+
+X, Y, PIXEL_TIME, LINE_PERIOD = 4, 3, 1000., 5000.
+
+
+def header(chip):
+    return tp3raw.HEADER | (chip << 32)
+
+
+def hit(x, y, time):
+    coarse = int(round(time / 25.)) % (1 << 30)
+    pix = ((x % 2) << 2) | (y % 4)
+    return ((0xb << 60) | ((x // 2 * 2) << 52) | ((y // 4 * 4) << 45) | (pix << 44) | ((coarse & 0x3fff) << 30)
+            | (coarse >> 14))
+
+
+def tdc(time):
+    return (0x6 << 60) | (tp3raw.TDC1_RISING << 56) | ((int(round(time / 3.125)) % (1 << 35)) << 9)
+
+
+def test_chunks_start_on_headers_past_long_stretches_without_one():
+    packets = numpy.zeros(200000, dtype='<u8')
+    packets[[0, 150000, 150010]] = [header(0), header(1), header(2)]
+    assert tp3raw.chunk_bounds(packets, 10) == [(0, 150000), (150000, 150010), (150010, 200000)]
+    assert tp3raw.chunk_bounds(packets, 150005) == [(0, 150010), (150010, 200000)]
+    assert tp3raw.chunk_bounds(packets[:100000], 10) == [(0, 100000)]
+
+
+def test_spim_replay_counts_every_hit_across_a_rollover(tmp_path):
+    start = tp3raw.TOA_PERIOD * 3 - 7000.  # Rolls over during the second line.
+    packets = list()
+    expected = numpy.zeros((Y, X, tp3raw.CHANNELS), dtype=numpy.uint32)
+    for line in range(6):
+        packets.append(header(line % 2))
+        line_time = start + line * LINE_PERIOD
+        for column in range(X):
+            x = 10 * column + line % Y
+            packets.append(hit(x, 0, line_time + column * PIXEL_TIME + 500.))  # Written before the line TDC.
+            expected[line % Y, column, tp3raw.CHIP_OFFSETS[line % 2] + x] += 1
+        packets.append(tdc(line_time))
+        packets.append(hit(5, 0, line_time + X * PIXEL_TIME + 200.))  # Flyback, discarded.
+    path = tmp_path / 'replay.tpx3'
+    numpy.array(packets, dtype='<u8').tofile(path)
+
+    for chunk_packets in (1 << 24, 7):
+        raw = tp3raw.RawTpx3File(str(path), processes=0, chunk_packets=chunk_packets, backend='bincount')
+        assert all(tp3raw.is_header(raw.packets[start]) for start, _ in raw.chunks)
+        assert numpy.array_equal(raw.spim(X, Y, PIXEL_TIME), expected)
+        assert raw.spectrum().sum() == 30
+        assert raw.chrono(LINE_PERIOD).sum(axis=1).tolist() == [5] * 6